@@ -6,349 +6,2104 @@
 
 import re
 import os
+import glob
+import hashlib
+import ipaddress
+import locale
+import mmap
+import pickle
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import wraps
+from itertools import groupby, islice
+
+__version__ = '2.0.0'
+_CACHE_FORMAT = 4  # get_all_config结果的结构变化时递增，使缓存目录中的旧结果失效
+
+
+# 单次扫描的词法规则：空白、注释、分号、花括号、引号字符串和普通单词
+# 引号字符串和单词中可以有反斜杠转义；单词中的 ${name} 和正则量词 {n,m} 不作为块的括号
+_TOKEN_PATTERN = r"""
+    (?P<space>\s+)
+  | (?P<comment>\#[^\n]*)
+  | (?P<semicolon>;)
+  | (?P<open>\{)
+  | (?P<close>\})
+  | (?P<quoted>"[^"\\]*(?:\\[\s\S][^"\\]*)*"?|'[^'\\]*(?:\\[\s\S][^'\\]*)*'?)
+  | (?P<word>(?:[^\s;{}"'\\$]+|\\.?|\$(?:\{\w+\})?)(?:[^\s;{}"'\\$]+|\\.?|\$(?:\{\w+\})?|\{\d+(?:,\d*)?\})*)
+"""
+
+# parse_tree使用的扫描规则，词法与_TOKEN_PATTERN一致：空白并入之后的token，同一行中连续的单词和引号字符串
+# 连同结尾的;或{一次匹配 (first为第一个单词，rest为其余单词)，普通指令通常只需要一次匹配
+_ARG_PATTERN = r"""(?!\#)(?:"[^"\\]*(?:\\[\s\S][^"\\]*)*"?|'[^'\\]*(?:\\[\s\S][^'\\]*)*'?
+    |(?:[^\s;{}"'\\$]+|\\.?|\$(?:\{\w+\})?)(?:[^\s;{}"'\\$]+|\\.?|\$(?:\{\w+\})?|\{\d+(?:,\d*)?\})*)"""
+_DIRECTIVE_PATTERN = r"""
+    \s*(?:
+        (?P<comment>\#[^\n]*)
+      | (?P<semicolon>;)
+      | (?P<open>\{)
+      | (?P<close>\})
+      | (?P<first>%s)(?:[ \t]+(?P<rest>%s(?:[ \t]+%s)*))?[ \t]*(?:(?P<end_semicolon>;)|(?P<end_open>\{))?
+    )
+""" % ((_ARG_PATTERN,) * 3)
+
+# 只在括号、引号、注释和转义处停下的扫描规则 (与_TOKEN_PATTERN的括号规则一致)，
+# 第2组为块的{，第3组为}，普通指令整段跳过
+_BRACE_TOKEN_PATTERN = (r'[^{}"\'#\\]*(?:((?<=[^\s;{}"\'])\{\d+(?:,\d*)?\}|(?<=\$)\{\w+\}'
+                        r'|"[^"\\]*(?:\\[\s\S][^"\\]*)*"?|\'[^\'\\]*(?:\\[\s\S][^\'\\]*)*\'?|(?<![^\s;{}"\'])#[^\n]*|#|\\.?)|(\{)|(\}))')
+
+
+def _directive_scanner(*names):
+    """将多个 `name value;` 形式的指令正则合并为一个交替，一次findall取出所有指令
+
+    指令名前不能是单词字符或-，autoindex中的index、proxy_send_timeout中的send_timeout不会被当作指令。
+    """
+    return re.compile(r'(?<![\w-])(%s)\s+([^;]+);' % '|'.join(names))
+
+
+def _scan(scanner, content):
+    """用合并后的正则扫描一遍content，返回 {指令名: [值, ...]}，值按出现顺序排列"""
+    found = {}
+    for name, value in scanner.findall(content):
+        found.setdefault(name, []).append(value.strip())
+    return found
+
+
+class _InstrumentState(threading.local):
+    """每个线程独立的instrument状态"""
+
+    counter = None  # [正则调用次数, 扫描的字节数]，只在instrument的方法执行期间不为None (见_instrumented)
+
+
+_instrument_state = _InstrumentState()
+
+
+class _CountingPattern:
+    """正则的包装，每次匹配时累加到counter，其余属性直接转发给原正则"""
+
+    __slots__ = ('wrapped', 'counter')
+
+    def __init__(self, pattern, counter):
+        self.wrapped = pattern
+        self.counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self.wrapped, name)
+        if name not in ('search', 'match', 'fullmatch', 'findall', 'finditer', 'split', 'sub', 'subn'):
+            return attr
+
+        def call(*args, **kwargs):
+            if name in ('sub', 'subn'):
+                scanned = len(args[1])
+            else:
+                start = args[1] if len(args) > 1 else 0
+                end = args[2] if len(args) > 2 else len(args[0])
+                scanned = max(0, min(end, len(args[0])) - start)
+            self.counter[0] += 1
+            self.counter[1] += scanned
+            return attr(*args, **kwargs)
+        return call
+
+
+class _PatternTable(dict):
+    """共用正则表的计数视图，正在instrument的线程取出的是累加到该线程计数的_CountingPattern
+
+    只在有线程instrument期间换入 (见_instrumented)，其他线程从中取出的仍是原正则。
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        pattern = dict.__getitem__(self, key)
+        counter = _instrument_state.counter
+        return pattern if counter is None else _CountingPattern(pattern, counter)
+
+
+# 所有parse_*方法共用的预编译正则，避免依赖re模块内部容量有限的缓存
+_PATTERNS = {
+    'token': re.compile(_TOKEN_PATTERN, re.VERBOSE),
+    # mmap模式下直接在bytes上扫描
+    'token_bytes': re.compile(_TOKEN_PATTERN.encode('ascii'), re.VERBOSE),
+    'directive': re.compile(_DIRECTIVE_PATTERN, re.VERBOSE),
+    'directive_bytes': re.compile(_DIRECTIVE_PATTERN.encode('ascii'), re.VERBOSE),
+    # 整行注释或include指令所在的一行 (任意缩进)，第1组为include的参数
+    'conf_line': re.compile(r'^[^\S\n]*(?:#[^\n]*|include[^\S\n]+([^;\n]+);[^\n]*)\n?', re.MULTILINE),
+    'raw_newline': re.compile(rb'\r\n?|\n'),
+    'include_bytes': re.compile(rb'^[ \t]*include[ \t]+([^;\n]+);[^\n]*\n?', re.MULTILINE),
+    'comment_line_bytes': re.compile(rb'^[ \t]*#[^\n]*', re.MULTILINE),
+    'glob_magic': re.compile(r'[*?[]'),
+    'http_pool': re.compile(r'https?://([^;/]*)'),
+    'ipv4': re.compile(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}'),
+    'brace_token': re.compile(_BRACE_TOKEN_PATTERN),
+    'brace_token_bytes': re.compile(_BRACE_TOKEN_PATTERN.encode('ascii')),
+    'first_word': re.compile(r'\s*([^\s;{}"\'#]+)'),
+    'location_header': re.compile(r'\s*(=|~\*?|\^~)?\s*(.*)', re.DOTALL),
+    'backend_host': re.compile(r'https?://([^;/]+)'),
+    'limit_req_zone': re.compile(r'limit_req_zone\s+(\$[^\s]+)\s+zone=([^:]+):(\S+)\s+rate=([^;]+);'),
+    'limit_req': re.compile(r'limit_req\s+zone=([^\s]+)(?:\s+burst=(\d+))?(?:\s+nodelay)?;'),
+    'limit_conn_zone': re.compile(r'limit_conn_zone\s+(\$[^\s]+)\s+zone=([^:]+):(\S+);'),
+    'limit_conn': re.compile(r'limit_conn\s+([^\s]+)\s+(\d+);'),
+    'proxy_cache_path': re.compile(r'proxy_cache_path\s+([^\s]+)(?:\s+levels=([^\s]+))?(?:\s+keys_zone=([^:]+):([^\s]+))?'
+                                   r'(?:\s+max_size=([^\s]+))?(?:\s+inactive=([^\s;]+))?'),
+    'fastcgi_cache_path': re.compile(r'fastcgi_cache_path\s+([^\s]+)(?:\s+levels=([^\s]+))?(?:\s+keys_zone=([^:]+):([^\s]+))?'),
+    'open_file_cache': re.compile(r'open_file_cache\s+max=(\d+)(?:\s+inactive=([^\s;]+))?'),
+    'log_format': re.compile(r'log_format\s+([^\s]+)\s+([^;]+);', re.DOTALL),
+    'access_log_if': re.compile(r'access_log\s+([^\s]+)(?:\s+([^\s]+))?(?:\s+if=([^\s;]+))?'),
+    'map': re.compile(r'map\s+(\$[^\s]+)\s+(\$[^\s]+)\s*\{([^}]*)\}', re.DOTALL),
+    'geo': re.compile(r'geo\s+(\$[^\s]+)\s*\{([^}]*)\}', re.DOTALL),
+    'split_clients': re.compile(r'split_clients\s+"([^"]+)"\s+(\$[^\s]+)\s*\{([^}]*)\}', re.DOTALL),
+    'default': re.compile(r'default\s+([^;]+);'),
+    'table_entry': re.compile(r'([^\s;]+)\s+([^;]+);'),
+    'split_entry': re.compile(r'([^\s]+)\s+([^;]+);'),
+    'stream_upstream': re.compile(r'upstream\s+([^\s{]+)\s*\{([^}]*)\}', re.DOTALL),
+    'stream_upstream_server': re.compile(r'server\s+([^\s;]+)(?:\s+([^;]*))?;'),
+    'stream_server': re.compile(r'server\s*\{([^}]*)\}', re.DOTALL),
+    'weight': re.compile(r'weight=(\d+)'),
+    'grpc_location': re.compile(r'location\s+([^\{]+)\{([^\}]*grpc[^\}]*)\}', re.DOTALL),
+    'grpc_scheme': re.compile(r'^grpcs?://'),
+    'pcre_named_group': re.compile(r'\(\?<(?![=!])'),
+    'newline': re.compile(rb'\n'),
+    'escape': re.compile(r'\\(["\'\\trn])'),
+}
+
+# 每类块一个合并的指令扫描器，一次扫描取出该块关心的所有简单指令
+_SCANNERS = {
+    'caching': _directive_scanner('proxy_cache', 'proxy_cache_valid', 'proxy_cache_key', 'fastcgi_cache',
+                                  'proxy_cache_bypass', 'proxy_no_cache'),
+    'proxy': _directive_scanner('proxy_set_header', 'proxy_connect_timeout', 'proxy_read_timeout', 'proxy_send_timeout',
+                                'proxy_buffering', 'proxy_buffer_size', 'proxy_buffers', 'proxy_busy_buffers_size'),
+    'client': _directive_scanner('client_max_body_size', 'client_body_timeout', 'client_header_timeout', 'send_timeout',
+                                 'client_body_buffer_size', 'client_header_buffer_size', 'large_client_header_buffers',
+                                 'open_file_cache_valid', 'open_file_cache_min_uses', 'open_file_cache_errors'),
+    'http2': _directive_scanner('http2', 'http2_push', 'http2_push_preload', 'http2_max_field_size', 'http2_max_header_size'),
+    'stream_server': _directive_scanner('listen', 'proxy_pass', 'proxy_timeout'),
+    'grpc': _directive_scanner('grpc_pass', 'grpc_set_header', 'grpc_connect_timeout', 'grpc_read_timeout', 'grpc_send_timeout',
+                               'grpc_ssl_certificate', 'grpc_ssl_certificate_key'),
+}
+
+# 没有线程instrument时_PATTERNS/_SCANNERS是上面的普通dict，取正则只是一次dict查找；
+# 有线程instrument期间换成计数视图 (见_instrumented)
+_PLAIN_TABLES = (_PATTERNS, _SCANNERS)
+_COUNTING_TABLES = (_PatternTable(_PATTERNS), _PatternTable(_SCANNERS))
+_instrumenting = 0  # 正在instrument的线程数
+
+# parse_modules从配置树中按模块收集的简单指令 (指令名 -> 模块)，每个模块的parse_*方法只处理自己的指令的原文
+_MODULE_DIRECTIVES = dict((name, module) for module, names in (
+    ('rate_limiting', ('limit_req_zone', 'limit_req', 'limit_conn_zone', 'limit_conn')),
+    ('caching', ('proxy_cache', 'proxy_cache_path', 'proxy_cache_valid', 'proxy_cache_key', 'fastcgi_cache',
+                 'fastcgi_cache_path', 'proxy_cache_bypass', 'proxy_no_cache')),
+    ('proxy', ('proxy_set_header', 'proxy_connect_timeout', 'proxy_read_timeout', 'proxy_send_timeout', 'proxy_buffering',
+               'proxy_buffer_size', 'proxy_buffers', 'proxy_busy_buffers_size')),
+    ('client', ('client_max_body_size', 'client_body_timeout', 'client_header_timeout', 'send_timeout',
+                'client_body_buffer_size', 'client_header_buffer_size', 'large_client_header_buffers', 'open_file_cache',
+                'open_file_cache_valid', 'open_file_cache_min_uses', 'open_file_cache_errors')),
+    ('logging', ('log_format', 'access_log')),
+    ('http2', ('http2', 'http2_push', 'http2_push_preload', 'http2_max_field_size', 'http2_max_header_size')),
+) for name in names)
+# 整块交给parse_advanced_blocks的块
+_MODULE_BLOCKS = ('map', 'geo', 'split_clients')
+# 只包含数据表项的块，NGINX的配置树中不展开 (见NGINX.tree)
+_DATA_BLOCKS = ('map', 'geo', 'split_clients', 'types', 'charset_map')
+# location块中parse_locations关心的简单指令
+_LOCATION_DIRECTIVES = frozenset(['proxy_pass', 'fastcgi_pass', 'rewrite', 'try_files', 'root', 'index'])
+
+# 读取配置文件的编码，与open()的文本模式一致
+_ENCODING = locale.getpreferredencoding(False)
+
+# 进程级的配置文件缓存: abspath -> ((mtime_ns, size), chunks, 位置表)，按最近使用的顺序排列，
+# mtime或大小变化后旧内容不再命中。缓存的文件总大小 (_file_cache_bytes) 不超过_FILE_CACHE_LIMIT字节，
+# 超出时淘汰最久未使用的文件，更大的文件不缓存
+_FILE_CACHE_LIMIT = 32 * 1024 * 1024
+_file_cache = OrderedDict()
+_file_cache_bytes = 0
+_file_cache_lock = threading.Lock()
+
+
+def _decode(chunk):
+    """将mmap模式下的bytes内容解码为str，str原样返回"""
+    return chunk if isinstance(chunk, str) else str(chunk, 'utf-8', 'replace')
+
+
+_ESCAPES = {'"': '"', "'": "'", '\\': '\\', 't': '\t', 'r': '\r', 'n': '\n'}
+
+
+def _unquote(text):
+    """去掉引号字符串两端的引号，并像nginx一样处理 \\" \\' \\\\ \\t \\r \\n 转义，其余反斜杠原样保留"""
+    if text[:1] in ('"', "'"):
+        text = text[1:-1] if len(text) > 1 and text[-1] == text[0] else text[1:]
+    if '\\' in text:
+        text = _PATTERNS['escape'].sub(lambda m: _ESCAPES[m.group(1)], text)
+    return text
+
+
+def _load_conf(path):
+    """load_conf_file的实现，同时返回与chunks平行的位置表
+
+    位置表的每一项为 (starts, lines, offsets) 三个数组，每个元素对应chunk中一段与原文件
+    连续对应的内容：起始偏移 (相对chunk)、在原文件中的起始行号和字节偏移。注释行被去掉的
+    地方开始新的一段；含有\\r的文件换行符被统一为\\n后与原文件的字节不再线性对应，每行一段。
+    其余情况下段内每一行的位置在首次查询时才展开 (见NGINX.line_index)。
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _file_cache_lock:
+        cached = _file_cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            _file_cache.move_to_end(path)
+            return cached[1:]
+
+    with open(path, 'rb') as f:
+        raw = f.read()
+    text = raw.decode(_ENCODING)
+    # 与文本模式一样统一换行符；纯ASCII且没有\r时字符偏移就是字节偏移
+    per_line = '\r' in text
+    if per_line:
+        line_offsets = array('Q', [0])  # 原文件中每一行的起始字节偏移
+        line_offsets.extend(m.end() for m in _PATTERNS['raw_newline'].finditer(raw))
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    linear = raw.isascii()
+    del raw
+
+    chunks = []
+    tables = []
+    pieces = []  # 当前chunk中保留的内容
+    table = _new_line_table()
+    size = 0  # pieces中已有内容的长度
+    encoded = [0, 0]  # 已换算为字节偏移的 (位置, 字节偏移)，非ASCII时逐段累加
+
+    def byte_offset(pos, number):
+        """text中pos处 (第number行的行首) 在原文件中的字节偏移"""
+        if per_line:
+            return line_offsets[number - 1]
+        if not linear:
+            encoded[1] += len(text[encoded[0]:pos].encode(_ENCODING))
+            encoded[0] = pos
+            return encoded[1]
+        return pos
+
+    def keep(start, end, number):
+        """text[start:end]从第number行开始，保留在当前chunk中"""
+        nonlocal size
+        pieces.append(text[start:end])
+        line = start
+        while True:
+            table[0].append(size + line - start)
+            table[1].append(number)
+            table[2].append(byte_offset(line, number))
+            line = text.find('\n', line, end) + 1 if per_line else 0
+            if not line or line >= end:
+                break
+            number += 1
+        size += end - start
+
+    pos = 0
+    number = 1  # pos处的行号
+    for m in _PATTERNS['conf_line'].finditer(text):
+        if m.start() > pos:
+            keep(pos, m.start(), number)
+            number += text.count('\n', pos, m.start())
+        if m.group(1) is not None:
+            if pieces:
+                chunks.append(''.join(pieces))
+                tables.append(table)
+                pieces, table, size = [], _new_line_table(), 0
+            chunks.append((m.group(1).strip().strip('"\''), m.group()))
+            tables.append(_new_line_table([(0, number, byte_offset(m.start(), number))]))
+        if m.group().endswith('\n'):
+            number += 1
+        pos = m.end()
+    if pos < len(text):
+        keep(pos, len(text), number)
+    if pieces:
+        chunks.append(''.join(pieces))
+        tables.append(table)
+
+    global _file_cache_bytes
+    with _file_cache_lock:
+        # 同一文件的旧版本不再有用
+        stale = _file_cache.pop(path, None)
+        if stale is not None:
+            _file_cache_bytes -= stale[0][1]
+        if st.st_size <= _FILE_CACHE_LIMIT:
+            _file_cache[path] = (stamp, chunks, tables)
+            _file_cache_bytes += st.st_size
+            while _file_cache_bytes > _FILE_CACHE_LIMIT:
+                _file_cache_bytes -= _file_cache.popitem(last=False)[1][0][1]
+    return chunks, tables
+
+
+def _new_line_table(rows=()):
+    """(starts, lines, offsets) 三个平行数组，见_load_conf"""
+    table = (array('Q'), array('L'), array('Q'))
+    for row in rows:
+        for column, value in zip(table, row):
+            column.append(value)
+    return table
+
+
+def load_conf_file(path):
+    """读取配置文件，去掉注释行并拆分出include指令
+
+    返回的chunks中，str为普通配置内容，(pattern, line)为include指令。
+    结果按 (path, mtime, size) 缓存 (见_file_cache)，文件未变化时不会重新读取。
+    """
+    return _load_conf(path)[0]
+
+
+def _map_conf(path):
+    """map_conf_file的实现，同时返回与chunks平行的位置表 (见_load_conf)"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return [], []
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    for start, end in [m.span() for m in _PATTERNS['comment_line_bytes'].finditer(mm)]:
+        mm[start:end] = b' ' * (end - start)
+
+    # 注释行只是被替换为空格，每个chunk都与原文件连续对应，起始行号由之前的换行数得出
+    def table(start, line):
+        return _new_line_table([(0, line, start)])
+
+    def lines_between(start, end):
+        return len(_PATTERNS['newline'].findall(mm, start, end))
+
+    includes = list(_PATTERNS['include_bytes'].finditer(mm))
+    if not includes:
+        return [mm], [table(0, 1)]
+
+    view = memoryview(mm)
+    chunks = []
+    tables = []
+    pos = 0
+    line = 1
+    for m in includes:
+        if m.start() > pos:
+            chunks.append(view[pos:m.start()])
+            tables.append(table(pos, line))
+            line += lines_between(pos, m.start())
+        chunks.append((_decode(m.group(1)).strip().strip('"\''), m.group()))
+        tables.append(table(m.start(), line))
+        line += lines_between(m.start(), m.end())
+        pos = m.end()
+    if pos < len(mm):
+        chunks.append(view[pos:])
+        tables.append(table(pos, line))
+    return chunks, tables
+
+
+def map_conf_file(path):
+    """以写时复制的方式mmap配置文件，返回与load_conf_file相同结构的chunks
+
+    注释行在映射内存中原地替换为空格，普通配置内容以memoryview切片的形式返回，
+    没有include时返回的唯一chunk就是mmap本身。返回的内容直接引用映射内存，文件被截断后
+    再访问会触发SIGBUS，调用方应尽快复制并关闭映射：NGINX.merge_conf把各段复制为一份bytes后
+    立即关闭，所以mmap模式并不省去复制，省去的是解码为str和逐行处理 (内容以bytes扫描)。
+    """
+    return _map_conf(path)[0]
+
+
+def clear_file_cache():
+    """清空配置文件缓存"""
+    global _file_cache_bytes
+    with _file_cache_lock:
+        _file_cache.clear()
+        _file_cache_bytes = 0
+
+
+class Directive:
+    """配置树中的一个指令，block为None表示简单指令，否则为子指令列表
+
+    只保存在source中的偏移，args和value在访问时才从source中解码。
+    """
+
+    __slots__ = ('name', 'start', 'end', 'block', 'source', 'value_start', 'value_end')
+
+    def __init__(self, name, start, end, block=None, source='', value_start=0, value_end=0):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.block = block
+        self.source = source
+        self.value_start = value_start
+        self.value_end = value_end
+
+    def __repr__(self):
+        return f'Directive({self.name!r}, {self.args!r})'
+
+    @property
+    def value(self):
+        """指令名之后的原始参数文本"""
+        return _decode(self.source[self.value_start:self.value_end])
+
+    @property
+    def args(self):
+        """去掉引号后的参数列表"""
+        token_re = _PATTERNS['token' if isinstance(self.source, str) else 'token_bytes']
+        return [_unquote(_decode(m.group()))
+                for m in token_re.finditer(self.source, self.value_start, self.value_end)
+                if m.lastgroup in ('word', 'quoted')]
+
+    def find(self, name):
+        """返回第一个同名的直接子指令"""
+        for child in self.block or ():
+            if child.name == name:
+                return child
+        return None
+
+    def find_all(self, name):
+        """返回所有同名的直接子指令"""
+        return [child for child in self.block or () if child.name == name]
+
+    def walk(self):
+        """先序遍历所有后代指令"""
+        stack = list(reversed(self.block or ()))
+        while stack:
+            node = stack.pop()
+            yield node
+            if node.block:
+                stack.extend(reversed(node.block))
+
+    def group(self):
+        """按名字分组所有后代简单指令，{name: [Directive, ...]}，组内按先序遍历的顺序"""
+        groups = {}
+        stack = list(reversed(self.block or ()))
+        while stack:
+            node = stack.pop()
+            if node.block is None:
+                if node.name in groups:
+                    groups[node.name].append(node)
+                else:
+                    groups[node.name] = [node]
+            elif node.block:
+                stack.extend(reversed(node.block))
+        return groups
+
+
+def parse_tree(content, start=0, end=None, depth=None, shallow=()):
+    """一次扫描content[start:end]，返回以main为根的指令树，节点的偏移都是在content中的偏移
+
+    content可以是str，也可以是bytes/mmap/memoryview (mmap模式)。
+    未闭合的块在end处自动闭合，多余的}被忽略，缺少分号的指令在遇到}或end时结束。
+    depth不为None时只为前depth层块中的指令生成节点，更深的块 (比如depth=2时http中的server)
+    只记录起止偏移，block为空列表，需要时用同样的偏移范围再调用parse_tree展开。
+    shallow中的块 (比如map) 不论深度都只记录起止偏移。
+    """
+    end = len(content) if end is None else end
+    root = Directive('main', start, end, [], content)
+    stack = [root]
+    children = root.block  # 当前块的子指令列表
+    text = isinstance(content, str)
+    directive_re = _PATTERNS['directive' if text else 'directive_bytes']
+    first, rest = directive_re.groupindex['first'], directive_re.groupindex['rest']
+    names = {}  # 指令名的原文 -> 处理后的名字，相同的指令名共用一个str对象
+    # 当前指令的名字和参数的范围，name_start < 0 表示还没有开始新的指令
+    name_start = name_end = value_start = value_end = -1
+    name = None
+    has_value = False
+
+    def node_name(raw):
+        """没有在names中的指令名：解码、去掉引号，并记入names"""
+        name = raw if text else _decode(raw)
+        if name[:1] in ('"', "'") or '\\' in name:
+            name = _unquote(name)
+        if len(names) < 1024:  # map等数据块中的表项不计入
+            names[raw] = name
+        return name
+
+    pos = start
+    while pos is not None:
+        tokens = directive_re.finditer(content, pos, end)
+        pos = None
+        for m in tokens:
+            kind = m.lastgroup
+            if kind == 'comment':
+                continue
+            if kind != 'semicolon' and kind != 'open' and kind != 'close':
+                # 一段连续的单词，可能连同结尾的;或{
+                if name_start < 0:
+                    name_start, name_end = m.span(first)
+                    name = names.get(m.group(first)) or node_name(m.group(first))
+                    value_start = value_end = name_end
+                    if m.start(rest) >= 0:
+                        value_start, value_end = m.span(rest)
+                        has_value = True
+                    else:
+                        has_value = False
+                else:
+                    if not has_value:
+                        value_start = m.start(first)
+                        has_value = True
+                    value_end = m.end(rest) if m.start(rest) >= 0 else m.end(first)
+                if kind == 'end_semicolon':
+                    children.append(Directive(name, name_start, m.end(), None, content, value_start, value_end))
+                    name_start = -1
+                    continue
+                if kind != 'end_open':
+                    continue
+                kind = 'open'
+
+            if kind == 'semicolon':
+                if name_start >= 0:
+                    children.append(Directive(name, name_start, m.end(), None, content, value_start, value_end))
+                    name_start = -1
+            elif kind == 'open':
+                if name_start < 0:
+                    # 没有名字的块
+                    name_start = name_end = value_start = value_end = m.end() - 1
+                    name = ''
+                node = Directive(name, name_start, m.end(), [], content, value_start, value_end)
+                children.append(node)
+                name_start = -1
+                if depth is not None and len(stack) >= depth or node.name in shallow:
+                    # 更深的块只找到匹配的}，从它之后继续扫描
+                    node.end = pos = _block_end(content, m.end(), end)
+                    break
+                stack.append(node)
+                children = node.block
+            else:
+                if name_start >= 0:
+                    children.append(Directive(name, name_start, value_end, None, content, value_start, value_end))
+                    name_start = -1
+                if len(stack) > 1:
+                    stack.pop().end = m.end()
+                    children = stack[-1].block
+
+    if name_start >= 0:
+        children.append(Directive(name, name_start, value_end, None, content, value_start, value_end))
+    for node in stack[1:]:
+        node.end = end
+    return root
+
+
+def _iter_children(content, node, window=1 << 20):
+    """逐个生成块node (未展开的shell) 的子指令，每次只为约window字节的内容生成节点
+
+    用于map等可能有上百万表项的数据块，遍历时不必一次为整个块生成所有节点。每段扫描的结果中，
+    最后一个以分号或}结束的子指令之前的节点与整块扫描的结果相同，之后的内容从它之后重新扫描。
+    """
+    directive_re = _PATTERNS['directive' if isinstance(content, str) else 'directive_bytes']
+    brace = '}' if isinstance(content, str) else b'}'
+    end = node.end
+
+    def closed(a, b):
+        """子指令之间的[a, b)中是否有}：整块扫描时它结束这个块，分段扫描的根层则会忽略它"""
+        if content.find(brace, a, b) < 0:
+            return False
+        return any(m.lastgroup == 'close' for m in directive_re.finditer(content, a, b))
+
+    pos = None  # 块的{之后
+    for m in directive_re.finditer(content, node.value_end, end):
+        if m.lastgroup == 'open':
+            pos = m.end()
+            break
+    size = window
+    while pos is not None and pos < end:
+        stop = min(end, pos + size)
+        children = parse_tree(content, pos, stop).block
+        tail = stop
+        if stop < end and children and not (children[-1].end < stop and _terminated(content, children[-1])):
+            # 最后一个子指令可能被截断，留到下一段扫描
+            tail = children.pop().start
+        if stop < end and not children:
+            size *= 2
+            continue
+        for child in children:
+            if closed(pos, child.start):
+                return
+            yield child
+            pos = child.end
+        if stop == end or closed(pos, tail):
+            return
+        size = window
+
+
+def _block_end(content, pos, end):
+    """返回从pos (块的{之后) 开始的块在content中的结束偏移 (匹配的}之后)，未闭合时返回end"""
+    depth = 1
+    for m in _PATTERNS['brace_token' if isinstance(content, str) else 'brace_token_bytes'].finditer(content, pos, end):
+        if m.lastindex == 2:
+            depth += 1
+        elif m.lastindex == 3:
+            depth -= 1
+            if not depth:
+                return m.end()
+    return end
+
+
+def _common_prefix(a, b):
+    """二分查找a和b的公共前缀长度，每次比较都是一次切片比较"""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix(a, b):
+    """二分查找a和b的公共后缀长度"""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _terminated(content, node):
+    """node是否以分号或}结束 (没有分号的指令在遇到}或扫描范围末尾时才结束，之后的内容会影响它)"""
+    if node.block is None:
+        # 以分号结束时end在分号之后，否则end就是最后一个单词的结束位置
+        return node.end > node.value_end
+    last = content[node.end - 1:node.end]
+    return (last if isinstance(last, str) else _decode(last)) == '}'
+
+
+def _splice_tree(tree, old, new, lo, old_hi, new_hi, shallow=()):
+    """old中[lo, old_hi)的内容变为new中[lo, new_hi)之后，原地把old的配置树更新为new的配置树
+
+    只重新扫描完整包含变化范围的最内层块中受影响的子指令，之前的节点保持不变，之后的节点整体平移，
+    未变化的节点仍是原来的对象。返回子指令被修改过的块 (包含变化范围的各层块)，
+    变化破坏了块结构 (括号不配对、没有分号的指令跨过范围边界等) 时不修改tree，返回None，
+    需要重新构建整个配置树。shallow与构建tree时传给parse_tree的相同，这些块整体重新扫描。
+    """
+    token_re = _PATTERNS['token' if isinstance(new, str) else 'token_bytes']
+    delta = new_hi - old_hi
+
+    # 从根开始，向下找到子指令范围完整包含变化范围的最内层块
+    ancestors = []
+    parent, body_start, body_end = tree, 0, len(old)
+    while True:
+        inner = None
+        for child in parent.block:
+            if child.end <= lo:
+                continue
+            # 未闭合的块延伸到内容末尾，它的结束位置不可靠
+            if (child.block is not None and child.name not in shallow and child.start < lo and old_hi < child.end < len(old)
+                    and _terminated(old, child)):
+                for m in token_re.finditer(old, child.value_end, lo):
+                    if m.lastgroup == 'open':
+                        inner = (child, m.end(), child.end - 1)
+                        break
+                    if m.lastgroup not in ('space', 'comment'):
+                        break
+            break
+        if inner is None:
+            break
+        ancestors.append(parent)
+        parent, body_start, body_end = inner
+
+    # 受影响的子指令children[i:j]：与变化范围重叠，或者是它前面没有结束的指令
+    children = parent.block
+    i = 0
+    while i < len(children) and children[i].end <= lo:
+        i += 1
+    while i and not _terminated(old, children[i - 1]):
+        i -= 1
+    j = i
+    while j < len(children) and children[j].start < old_hi:
+        j += 1
+    start = children[i - 1].end if i else body_start
+    end = children[j].start + delta if j < len(children) else body_end + delta
+
+    # 新内容中的这一段必须是完整的若干条指令：括号配对，最后一个单词或注释没有延伸到段外，最后一条指令已经结束
+    depth = 0
+    m = None
+    for m in token_re.finditer(new, start, end):
+        if m.lastgroup == 'open':
+            depth += 1
+        elif m.lastgroup == 'close':
+            depth -= 1
+            if depth < 0:
+                return None
+    if depth or (m is not None and token_re.match(new, m.start()).end() != m.end()):
+        return None
+    region = parse_tree(new, start, end, shallow=shallow)
+    if region.block and not _terminated(new, region.block[-1]):
+        return None
+
+    # 变化范围之后的节点整体平移，包含变化范围的各层块只移动结束位置
+    for node in tree.walk():
+        node.source = new
+        if node.start >= old_hi:
+            node.start += delta
+            node.end += delta
+            node.value_start += delta
+            node.value_end += delta
+        elif node.end > old_hi:
+            node.end += delta
+    children[i:j] = region.block
+    tree.end = len(new)
+    tree.source = new
+    return ancestors + [parent]
+
+
+def match_blocks(content, name):
+    """用括号栈一次扫描content，按出现顺序返回最外层的name块 [(start, open, close), ...]
+
+    start为指令名的偏移，open和close为块的 `{` 和 `}` 的偏移，块内容即content[open + 1:close]。
+    支持任意嵌套深度，嵌套在name块中的同名块包含在外层块的内容里，不单独返回；
+    与parse_tree的词法规则一致，引号、注释、转义、${name} 和正则量词中的括号不计入。
+    未闭合的块的close为len(content)。
+    """
+    blocks = []
+    depth = 0
+    statement = 0  # 当前指令的起始偏移：上一个分号、括号或整行注释之后
+    target = None  # 正在匹配的name块的 (start, open, 打开时的深度)
+
+    # 只在括号、引号、注释和转义处停下，普通指令由正则整段跳过
+    for m in _PATTERNS['brace_token'].finditer(content):
+        kind = m.lastindex
+        token = m.start(kind)
+        end = m.end()
+        semicolon = content.rfind(';', m.start(), token)
+        if semicolon >= 0:
+            statement = semicolon + 1
+        if kind == 2:
+            if target is None:
+                word = _PATTERNS['first_word'].match(content, statement, token)
+                if word is not None and word.group(1) == name:
+                    target = (word.start(1), token, depth)
+            depth += 1
+            statement = end
+        elif kind == 3:
+            if depth:
+                depth -= 1
+            if target is not None and depth == target[2]:
+                blocks.append((target[0], target[1], token))
+                target = None
+            statement = end
+        elif content[token] == '#' and not content[statement:token].strip():
+            statement = end
+
+    if target is not None:
+        blocks.append((target[0], target[1], len(content)))
+    return blocks
+
+
+class Record(Mapping):
+    """以__slots__保存字段的轻量记录，可以像dict一样读写
+
+    未赋值的可选字段不会出现在键中，键的顺序即__slots__的顺序，to_dict()返回与原来相同结构的dict。
+    """
+
+    __slots__ = ()
+    _nested = {}  # 字段名 -> 列表元素的Record类型，用于from_dict
+
+    def __init__(self, **fields):
+        for key, value in fields.items():
+            setattr(self, key, value)
+
+    def __getitem__(self, key):
+        if key in self.__slots__ and not key.startswith('_'):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__ or key.startswith('_'):
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __iter__(self):
+        # 下划线开头的slot是内部缓存，不作为字段
+        return (key for key in self.__slots__ if not key.startswith('_') and hasattr(self, key))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+    def to_dict(self):
+        """转换为普通dict（递归转换嵌套的Record）"""
+        return {key: _to_plain(getattr(self, key)) for key in self}
+
+    @classmethod
+    def from_dict(cls, data):
+        """从to_dict()的结果重建Record"""
+        record = cls(**data)
+        for key, item_cls in cls._nested.items():
+            if key in data:
+                setattr(record, key, [item_cls.from_dict(item) for item in data[key]])
+        return record
+
+
+def _to_plain(value):
+    """将Record及其列表转换为普通dict/list"""
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [_to_plain(item) for item in value]
+    return value
+
+
+class Location(Record):
+    """location块的解析结果，locations为嵌套在其中的location"""
+
+    __slots__ = ('path', 'modifier', 'proxy_pass', 'backend_ip', 'backend_path',
+                 'fastcgi_pass', 'rewrites', 'try_files', 'root', 'index', 'locations')
+
+
+Location._nested = {'locations': Location}
+
+
+def _location_scope(node):
+    """返回块中属于它自己的location相关指令 {name: [value, ...]} 和直接嵌套的location块
+
+    if等块中的指令算作所在块的指令，嵌套的location中的指令属于嵌套的location。
+    """
+    found = {}
+    nested = []
+    stack = list(reversed(node.block))
+    while stack:
+        child = stack.pop()
+        if child.block is None:
+            if child.name in _LOCATION_DIRECTIVES:
+                found.setdefault(child.name, []).append(child.value)
+        elif child.name == 'location':
+            nested.append(child)
+        elif child.block:
+            stack.extend(reversed(child.block))
+    return found, nested
+
+
+def iter_locations(locations):
+    """先序遍历location及其中嵌套的location，嵌套的location紧跟在外层location之后"""
+    stack = list(reversed(locations))
+    while stack:
+        location = stack.pop()
+        yield location
+        stack.extend(reversed(location.get('locations', ())))
+
+
+class Server(Record):
+    """server块的解析结果，backend为Location列表"""
+
+    __slots__ = ('port', 'listen', 'server_name', 'server_names', 'root', 'index', 'access_log', 'error_log',
+                 'ssl_certificate', 'ssl_certificate_key', 'ssl_protocols', 'ssl_ciphers',
+                 'include', 'backend', 'security_headers', 'acl', 'authentication', '_router')
+    _nested = {'backend': Location}
+
+    def router(self):
+        """返回backend对应的LocationRouter，backend被替换后重新构建"""
+        backend = self.get('backend', [])
+        router = getattr(self, '_router', None)
+        if router is None or router.source is not backend:
+            router = self._router = LocationRouter(backend)
+        return router
+
+    def match(self, uri):
+        """返回处理该URI的Location，没有匹配时返回None"""
+        return self.router().match(uri)
+
+
+class UpstreamServer(Record):
+    """upstream中的一个后端server"""
+
+    __slots__ = ('address', 'weight', 'max_fails', 'fail_timeout', 'backup', 'down')
+
+
+class Upstream(Record):
+    """upstream块的解析结果，servers为UpstreamServer列表"""
+
+    __slots__ = ('poolname', 'ip', 'servers', 'load_balancing')
+    _nested = {'servers': UpstreamServer}
+
+
+def _compile_pcre(pattern, flags=0):
+    """编译nginx配置中的PCRE正则，(?<name>...)命名分组转换为python的(?P<name>...)"""
+    return re.compile(_PATTERNS['pcre_named_group'].sub('(?P<', pattern), flags)
+
+
+class LocationRouter:
+    """按nginx的规则把请求URI路由到location
+
+    顺序与nginx相同：先查=精确匹配，再找最长的前缀匹配，最长前缀是^~时直接使用，
+    否则按配置顺序尝试~和~*正则，都不匹配时使用最长前缀。@命名location不参与匹配。
+    嵌套的location与nginx的ngx_http_core_find_location一样逐层查找：匹配到前缀location后
+    在它嵌套的location中继续查找，嵌套的location只匹配到前缀时外层的正则仍然优先；
+    匹配到正则location后也在它嵌套的location中继续查找。
+
+    序号为location在iter_locations先序遍历中的序号，没有嵌套的location时即backend中的序号。
+    每层嵌套的location有自己的LocationRouter (nested)，与外层共用locations列表。
+    """
+
+    def __init__(self, locations, flat=None):
+        self.source = locations
+        self.locations = [] if flat is None else flat  # 先序遍历的所有location
+        self.exact = {}  # path -> 序号
+        self.prefixes = {}  # path -> (序号, 是否为^~)
+        self.regexes = []  # (编译后的正则, 序号)，按配置顺序
+        self.nested = {}  # 序号 -> 该location中嵌套的location的LocationRouter
+        for location in locations:
+            i = len(self.locations)
+            self.locations.append(location)
+            if location.get('locations'):
+                self.nested[i] = LocationRouter(location['locations'], self.locations)
+            modifier = location.get('modifier')
+            path = location.get('path', '')
+            if modifier == '=':
+                self.exact.setdefault(path, i)
+            elif modifier in ('~', '~*'):
+                try:
+                    self.regexes.append((_compile_pcre(path, re.IGNORECASE if modifier == '~*' else 0), i))
+                except re.error:
+                    # PCRE特有的语法python无法编译，跳过该location
+                    continue
+            elif not path.startswith('@'):
+                self.prefixes.setdefault(path, (i, modifier == '^~'))
+        # 最长前缀匹配：按前缀长度从长到短逐个查哈希表
+        self.prefix_lengths = sorted({len(path) for path in self.prefixes}, reverse=True)
+
+    def longest_prefix(self, uri):
+        """返回最长的匹配前缀 (序号, 是否为^~)，没有时返回None"""
+        for length in self.prefix_lengths:
+            if length <= len(uri):
+                prefix = self.prefixes.get(uri[:length])
+                if prefix is not None:
+                    return prefix
+        return None
+
+    def find(self, uri):
+        """在这一层location中查找，返回 (序号, 是否已确定)，没有匹配时序号为None
+
+        =精确匹配或正则匹配到的结果已确定；只匹配到前缀时，外层location的正则仍然优先。
+        """
+        index = self.exact.get(uri)
+        if index is not None:
+            return index, True
+
+        found, noregex = None, False
+        prefix = self.longest_prefix(uri)
+        if prefix is not None:
+            found, noregex = prefix
+            if found in self.nested:
+                inner, done = self.nested[found].find(uri)
+                if inner is not None:
+                    found = inner
+                if done:
+                    return found, True
+
+        if not noregex:
+            for regex, index in self.regexes:
+                if regex.search(uri):
+                    if index in self.nested:
+                        inner = self.nested[index].find(uri)[0]
+                        if inner is not None:
+                            index = inner
+                    return index, True
+        return found, False
+
+    def match_index(self, uri):
+        """返回处理该URI的location序号，没有匹配时返回None"""
+        return self.find(uri.split('?', 1)[0])[0]
+
+    def match(self, uri):
+        """返回处理该URI的location，没有匹配时返回None"""
+        index = self.match_index(uri)
+        return None if index is None else self.locations[index]
+
+    def match_many(self, uris):
+        """批量路由，返回与uris一一对应的location序号列表，没有匹配的为None
+
+        uris可以是任意可迭代对象 (包括NumPy字符串数组)。相同的URI只路由一次，
+        精确匹配和前缀匹配先对整批完成，每个正则只对剩下的URI执行一遍。
+        """
+        paths = []
+        for uri in uris:
+            if isinstance(uri, bytes):
+                uri = uri.decode('utf-8', 'replace')
+            paths.append(str(uri).split('?', 1)[0])
+
+        resolved = self.find_many(set(paths))
+        return [resolved[path][0] for path in paths]
+
+    def find_many(self, paths):
+        """批量的find，返回 {path: (序号, 是否已确定)}"""
+        resolved = {}
+        fallback = {}  # 等待正则匹配的URI -> 最长前缀的序号
+        nested = {}  # 前缀 (序号, 是否为^~) -> 需要在它嵌套的location里继续查找的URI
+        for path in paths:
+            index = self.exact.get(path)
+            if index is not None:
+                resolved[path] = (index, True)
+                continue
+            prefix = self.longest_prefix(path)
+            if prefix is not None and prefix[0] in self.nested:
+                nested.setdefault(prefix, []).append(path)
+            elif prefix is not None and prefix[1]:
+                resolved[path] = (prefix[0], False)
+            else:
+                fallback[path] = prefix[0] if prefix is not None else None
+
+        for (index, noregex), inner_paths in nested.items():
+            for path, (inner, done) in self.nested[index].find_many(inner_paths).items():
+                found = index if inner is None else inner
+                if done or noregex:
+                    resolved[path] = (found, done)
+                else:
+                    fallback[path] = found
+
+        remaining = list(fallback)
+        matched = {}  # 正则location的序号 -> 匹配到的URI
+        for regex, index in self.regexes:
+            if not remaining:
+                break
+            search = regex.search
+            unmatched = []
+            for path in remaining:
+                if search(path):
+                    matched.setdefault(index, []).append(path)
+                else:
+                    unmatched.append(path)
+            remaining = unmatched
+        for path in remaining:
+            resolved[path] = (fallback[path], False)
+
+        for index, matched_paths in matched.items():
+            inner = self.nested[index].find_many(matched_paths) if index in self.nested else {}
+            for path in matched_paths:
+                found = inner[path][0] if path in inner else None
+                resolved[path] = (index if found is None else found, True)
+
+        return resolved
+
+
+def _normalize_address(host):
+    """通配地址统一为'*'，IP地址使用规范形式 (IPv6带方括号)"""
+    if host in ('*', '0.0.0.0', ''):
+        return '*'
+    bracketed = host.startswith('[') and host.endswith(']')
+    try:
+        address = ipaddress.ip_address(host[1:-1] if bracketed else host)
+    except ValueError:
+        return host.lower()
+    return f'[{address.compressed}]' if address.version == 6 else address.compressed
+
+
+def parse_listen(listen):
+    """把listen指令的值规范化为 (socket列表, 参数集合)
+
+    socket为 (地址, 端口)：80、*:80、0.0.0.0:80 都是 ('*', 80)，[::]:80 是 ('[::]', 80)，
+    [::]:80 ipv6only=off 同时监听IPv4，额外包含 ('*', 80)。unix socket的端口为None。
+    """
+    tokens = listen.split()
+    if not tokens:
+        return [('*', 80)], set()
+    address, params = tokens[0], set(tokens[1:])
+    if address.startswith('unix:'):
+        return [(address, None)], params
+    if address.startswith('['):
+        host, _, port = address.partition(']')
+        host, port = host + ']', port.lstrip(':') or '80'
+    elif ':' in address:
+        host, port = address.rsplit(':', 1)
+    elif address.isdigit():
+        host, port = '*', address
+    else:
+        host, port = address, '80'
+    host = _normalize_address(host)
+    port = int(port) if port.isdigit() else port
+    sockets = [(host, port)]
+    if host == '[::]' and 'ipv6only=off' in params:
+        sockets.append(('*', port))
+    return sockets, params
+
+
+def _format_socket(socket):
+    """把 (地址, 端口) 格式化为 地址:端口"""
+    host, port = socket
+    return host if port is None else f'{host}:{port}'
+
+
+def split_server_names(value):
+    """把server_name的值拆分为名字列表：去重、去掉IP，正则 (~开头) 以外的名字转为小写
+
+    nginx中server_name不区分大小写，Example.com和example.com是同一个名字。
+    """
+    return list(dict.fromkeys(name if name.startswith('~') else name.lower()
+                              for name in value.split() if not _PATTERNS['ipv4'].search(name)))
+
+
+def _server_summary(node):
+    """server块中与监听有关的字段 {listen, server_name, server_names}，不需要解析整个块"""
+    server_name = node.find('server_name')
+    value = server_name.value if server_name is not None else ''
+    return {'listen': [d.value for d in node.find_all('listen')], 'server_name': value,
+            'server_names': split_server_names(value)}
+
+
+def detect_listen_conflicts(servers):
+    """在规范化后的监听socket上检测冲突，servers可以来自多个配置
+
+    servers中的每一项只需要listen和server_names。返回的冲突中servers为在servers中的序号：同一socket上重复的server_name (duplicate_server)、
+    同一socket上多个default_server (duplicate_default_server)、一个server重复监听同一socket (duplicate_listen)。
+    按 (socket, 名字) 排序后分组，复杂度O(n log n)。
+    """
+    conflicts = []
+    names = []  # (socket, 名字, 序号)
+    defaults = []  # (socket, 序号)
+    for idx, server in enumerate(servers):
+        seen = set()
+        for listen in server.get('listen') or ['80']:
+            sockets, params = parse_listen(listen)
+            for socket in sockets:
+                if socket in seen:
+                    conflicts.append({
+                        'type': 'duplicate_listen',
+                        'server': idx,
+                        'listen': _format_socket(socket),
+                        'message': f'Server {idx} listens on {_format_socket(socket)} more than once',
+                        'severity': 'error'
+                    })
+                    continue
+                seen.add(socket)
+                if 'default_server' in params or 'default' in params:
+                    defaults.append((socket, idx))
+                names.extend((socket, name, idx) for name in server.get('server_names', ()))
+
+    def socket_key(socket):
+        return socket[0], str(socket[1])
+
+    names.sort(key=lambda entry: (socket_key(entry[0]), entry[1], entry[2]))
+    for (socket, name), group in groupby(names, key=lambda entry: entry[:2]):
+        indexes = [entry[2] for entry in group]
+        if len(indexes) > 1:
+            conflicts.append({
+                'type': 'duplicate_server',
+                'server_name': name,
+                'listen': _format_socket(socket),
+                'servers': indexes,
+                'message': f'Duplicate server_name "{name}" on {_format_socket(socket)}',
+                'severity': 'error'
+            })
+
+    defaults.sort(key=lambda entry: (socket_key(entry[0]), entry[1]))
+    for socket, group in groupby(defaults, key=lambda entry: entry[0]):
+        indexes = [entry[1] for entry in group]
+        if len(indexes) > 1:
+            conflicts.append({
+                'type': 'duplicate_default_server',
+                'listen': _format_socket(socket),
+                'servers': indexes,
+                'message': f'Multiple default_server on {_format_socket(socket)}',
+                'severity': 'error'
+            })
+
+    return conflicts
+
+
+class VhostIndex:
+    """按nginx的规则，根据监听的 (地址, 端口) 和Host头选择server
+
+    每个监听socket上依次查找：精确的server_name、最长的前置通配 (*.example.com/.example.com)、
+    最长的后置通配 (www.example.*)、按配置顺序的正则 (~开头)，都不匹配时使用default_server，
+    没有default_server时使用该socket上的第一个server。
+    """
+
+    def __init__(self, servers):
+        self.sockets = {}  # (地址, 端口) -> 该socket上的名字表
+        for server in servers:
+            names = (server.get('server_name') or '').split()
+            for listen in server.get('listen') or ['80']:
+                sockets, params = parse_listen(listen)
+                for socket in sockets:
+                    table = self.sockets.get(socket)
+                    if table is None:
+                        table = self.sockets[socket] = {'exact': {}, 'leading': {}, 'trailing': {},
+                                                        'regex': [], 'default': None, 'first': server}
+                    if ('default_server' in params or 'default' in params) and table['default'] is None:
+                        table['default'] = server
+                    for name in names:
+                        self._add_name(table, name, server)
+
+    @staticmethod
+    def _add_name(table, name, server):
+        if name.startswith('~'):
+            # 正则原样编译 (转为小写会把\S变成\s)，与nginx一样不区分大小写
+            try:
+                table['regex'].append((_compile_pcre(name[1:], re.IGNORECASE), server))
+            except re.error:
+                pass
+            return
+        name = name.lower()
+        if name.startswith('*.'):
+            table['leading'].setdefault(name[2:], server)
+        elif name.startswith('.'):
+            # .example.com 同时匹配 example.com 和 *.example.com
+            table['exact'].setdefault(name[1:], server)
+            table['leading'].setdefault(name[1:], server)
+        elif name.endswith('.*'):
+            table['trailing'].setdefault(name[:-2], server)
+        else:
+            table['exact'].setdefault(name, server)
+
+    def resolve(self, host, port=80, address='*'):
+        """返回处理该请求的server，没有server监听该端口时返回None"""
+        table = self.sockets.get((_normalize_address(address), port)) or self.sockets.get(('*', port))
+        if table is None:
+            return None
+
+        host = host.lower().rstrip('.')
+        if host.startswith('['):
+            host = host[:host.find(']') + 1]
+        elif host.count(':') == 1:
+            host = host.split(':', 1)[0]
+
+        server = table['exact'].get(host)
+        if server is not None:
+            return server
+
+        labels = host.split('.')
+        if table['leading']:
+            for i in range(1, len(labels)):
+                server = table['leading'].get('.'.join(labels[i:]))
+                if server is not None:
+                    return server
+        if table['trailing']:
+            for i in range(len(labels) - 1, 0, -1):
+                server = table['trailing'].get('.'.join(labels[:i]))
+                if server is not None:
+                    return server
+        for regex, server in table['regex']:
+            if regex.search(host):
+                return server
+        return table['default'] if table['default'] is not None else table['first']
+
+
+def _memoized(method):
+    """无参数方法的结果按实例缓存在self._results中，parse()时清空"""
+    @wraps(method)
+    def wrapper(self):
+        if method.__name__ not in self._results:
+            self._results[method.__name__] = method(self)
+        return self._results[method.__name__]
+    return wrapper
+
+
+class _lazy:
+    """首次访问时计算的属性，结果保存在实例的__dict__中，之后直接读取实例属性
+
+    与functools.cached_property (python 3.8+) 相同，是非数据描述符：可以直接给实例赋值，
+    从__dict__中删除后下次访问重新计算。
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.name] = self.func(instance)
+        return value
+
+
+def _block_label(node):
+    """配置块的简短描述，用于按块统计，比如 `server example.com`、`upstream backend`"""
+    if node.name == 'server':
+        server_name = node.find('server_name')
+        return 'server %s' % (server_name.value if server_name is not None else '')
+    return '%s %s' % (node.name, _decode(node.value))
+
+
+# 多个线程instrument同一个实例时保护self.stats的更新，以及_PATTERNS/_SCANNERS的切换
+_stats_lock = threading.Lock()
+
+
+def _count_patterns(delta):
+    """当前线程开始 (delta=1) 或结束 (delta=-1) instrument：第一个线程开始时换入计数视图，最后一个结束时换回"""
+    global _PATTERNS, _SCANNERS, _instrumenting
+    with _stats_lock:
+        _instrumenting += delta
+        _PATTERNS, _SCANNERS = _COUNTING_TABLES if _instrumenting else _PLAIN_TABLES
+
+
+def _instrumented(method):
+    """instrument=True时把方法的耗时、正则扫描的字节数和正则调用次数累加到self.stats
+
+    统计包含嵌套调用的方法；解析单个配置块的方法 (parse_server、parse_upstream) 还会按块记录一条。
+    最外层的方法在当前线程上开始计数，期间从_PATTERNS/_SCANNERS取出的正则都累加到这个计数。
+    共用的正则本身不被修改，多个线程同时instrument时互不影响。
+    """
+    @wraps(method)
+    def wrapper(self, *args):
+        if not self.instrument:
+            return method(self, *args)
+
+        outermost = _instrument_state.counter is None
+        if outermost:
+            _instrument_state.counter = [0, 0]
+            _count_patterns(1)
+        counter = _instrument_state.counter
+        calls, scanned = counter
+        start = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            seconds = time.perf_counter() - start
+            calls, scanned = counter[0] - calls, counter[1] - scanned
+            if outermost:
+                _instrument_state.counter = None
+                _count_patterns(-1)
+
+            block = None
+            if args and isinstance(args[0], Directive) and method.__name__ == 'parse_' + args[0].name:
+                source = self.source_position(args[0].start)
+                block = {
+                    'stage': method.__name__,
+                    'block': _block_label(args[0]),
+                    'file': source[0],
+                    'line': source[1],
+                    'offset': args[0].start,
+                    'seconds': seconds,
+                    'bytes': scanned,
+                    'regex_calls': calls,
+                }
+            with _stats_lock:
+                stage = self.stats['stages'].setdefault(
+                    method.__name__, {'calls': 0, 'seconds': 0.0, 'bytes': 0, 'regex_calls': 0})
+                stage['calls'] += 1
+                stage['seconds'] += seconds
+                stage['bytes'] += scanned
+                stage['regex_calls'] += calls
+                if block is not None:
+                    self.stats['blocks'].append(block)
+    return wrapper
+
+
+def format_profile(stats, top=10):
+    """把NGINX.stats格式化为文本报表：各阶段按耗时排序，并列出最慢的top个配置块"""
+    lines = ['%-28s %6s %10s %12s %8s' % ('stage', 'calls', 'seconds', 'bytes', 'regex')]
+    for name, stage in sorted(stats['stages'].items(), key=lambda item: -item[1]['seconds']):
+        lines.append('%-28s %6d %10.4f %12d %8d' % (
+            name, stage['calls'], stage['seconds'], stage['bytes'], stage['regex_calls']))
+    blocks = sorted(stats['blocks'], key=lambda block: -block['seconds'])[:top]
+    if blocks:
+        lines.append('')
+        lines.append('slowest blocks:')
+        for block in blocks:
+            lines.append('  %.4fs %s (%s:%d, %d regex calls)' % (
+                block['seconds'], block['block'], block['file'], block['line'], block['regex_calls']))
+    return '\n'.join(lines)
 
 
 class NGINX:
 
-    def __init__(self, conf_path):
+    instrument = False  # 进程池中用__new__创建的实例没有经过__init__
+
+    def __init__(self, conf_path, cache_dir=None, use_mmap=False, compact=False, workers=None, instrument=False):
         self.conf_path = conf_path
-        self.backend = list()  # 保存后端ip和pool name
-        self.serverBlock = list()  # 保存解析后端每个server块
-        self.servers = list()
-        self.global_config = {}  # 保存全局配置
-        self.events_config = {}  # 保存events配置
-        self.http_config = {}    # 保存http配置
-        self.tmp_conf = '/tmp/tmp_nginx.conf'
-        self.all_conf = '/tmp/nginx.conf'
+        self.instrument = instrument  # 为True时按阶段和配置块记录耗时等统计 (见_instrumented)
+        self.stats = {'stages': {}, 'blocks': []}
+        self.workers = workers  # 大于1时用多进程并行解析server块
+        self.compact = compact  # 以Server/Upstream等__slots__对象保存解析结果，默认为dict
+        self.cache_dir = cache_dir  # 可选的解析结果缓存目录
+        self.use_mmap = use_mmap  # 以mmap方式读取配置文件，合并时复制为bytes (self.content) 后关闭映射
+        self.content = ''  # 合并include并去掉注释后的完整配置 (mmap模式下为bytes)
+        self.segments = list()  # 每段合并内容的来源文件 (path, start, end)
+        self._upstream_cache = {}  # upstream块原文 -> 解析结果
+        self._server_cache = {}  # 配置树中的server块节点 -> 解析结果，相同内容的两个块各自有自己的结果
+        self._server_pools = None  # 解析server时使用的upstream名 -> ip
+        self._cached_config = None  # get_all_config的结果，可能从缓存目录加载
+        self._results = {}  # 校验等方法的结果，每次parse后重新计算 (见_memoized)
         self.merge_conf()
+        self.parse()
+
+    # 各部分在首次访问时才解析，结果保存在实例上 (见parse)
+    _SECTIONS = ('global_config', 'events_config', 'http_config',
+                 'backend', 'upstreams_by_name', 'serverBlock', 'servers', 'servers_by_name')
+
+    @_lazy
+    def global_config(self):
+        """全局配置"""
         self.parse_global_block()
+        return self.global_config
+
+    @_lazy
+    def events_config(self):
+        """events配置"""
         self.parse_events_block()
+        return self.events_config
+
+    @_lazy
+    def http_config(self):
+        """http配置"""
         self.parse_http_block()
+        return self.http_config
+
+    @_lazy
+    def backend(self):
+        """后端ip和pool name，每个upstream一项"""
+        self.parse_backend_ip()
+        return self.backend
+
+    @_lazy
+    def upstreams_by_name(self):
+        """poolname -> upstream，同名时以第一个为准"""
         self.parse_backend_ip()
+        return self.upstreams_by_name
+
+    @_lazy
+    def tree(self):
+        """合并后配置的完整指令树，在首次使用时才构建
+
+        解析各部分只需要outline，server等块用expand()逐个展开，不必构建整个配置树。
+        map、types等只有数据表项的块 (_DATA_BLOCKS) 不展开，需要时用expand()展开，walk_nodes会自动展开。
+        """
+        return parse_tree(self.content, shallow=_DATA_BLOCKS)
+
+    @_lazy
+    def outline(self):
+        """配置树的前两层：main中的指令和http、events等块中的指令
+
+        更深的块 (http中的server、upstream等) 只有起止偏移，子指令在expand()时才解析。
+        完整的配置树已经构建时直接使用它。
+        """
+        if 'tree' in self.__dict__:
+            return self.tree
+        return parse_tree(self.content, depth=2)
+
+    def expand(self, node):
+        """返回带有全部子指令的node：outline中没有展开的块单独扫描它的偏移范围"""
+        if node.block == []:
+            return parse_tree(self.content, node.start, node.end).block[0]
+        return node
+
+    def walk_nodes(self, skip=()):
+        """先序遍历配置中的所有指令，块在遍历到时才展开，不构建整个配置树
+
+        skip中的块 (比如server) 本身会生成，但不展开也不遍历其中的指令。
+        """
+        # 完整的配置树已经构建时只需要展开其中的map等数据块，数据块分段扫描 (见_iter_children)
+        stack = [iter((self.tree if 'tree' in self.__dict__ else self.outline).block)]
+        while stack:
+            for node in stack[-1]:
+                children = None
+                if node.name not in skip:
+                    if node.block == [] and node.name in _DATA_BLOCKS:
+                        children = _iter_children(self.content, node)
+                    else:
+                        if node.block == []:
+                            node = self.expand(node)
+                        if node.block:
+                            children = iter(node.block)
+                yield node
+                if children is not None:
+                    stack.append(children)
+                    break
+            else:
+                stack.pop()
+
+    @_lazy
+    def serverBlock(self):
+        """每个server块的原文，proxy_pass中的upstream名替换为后端ip
+
+        解析server不需要原文，只在首次访问时生成。
+        """
+        return [self.server_block_text(node) for node in self.iter_server_nodes()]
+
+    @_lazy
+    def servers(self):
+        """解析后的server列表"""
         self.parse_server_block()
+        return self.servers
+
+    @_lazy
+    def servers_by_name(self):
+        """server_names中的每个名字 (正则以外为小写) -> 使用该名字的server列表，按配置顺序"""
+        index = {}
+        for server in self.servers:
+            for name in server.get('server_names', ()):
+                index.setdefault(name, []).append(server)
+        return index
+
+    @_instrumented
+    def parse(self):
+        """解析合并后的配置，启用缓存目录且命中时直接使用缓存的结果
+
+        未命中缓存时不扫描配置，各部分在首次访问时再解析：解析全部server时构建完整的配置树，
+        逐个生成server (iter_servers、iter_records) 时只构建outline，server块逐个展开。
+        命中时各部分直接使用缓存的结果，需要配置树的方法 (iter_server_nodes、serverBlock等) 在首次使用时构建。
+        """
+        for name in self._SECTIONS + ('tree', 'outline'):
+            self.__dict__.pop(name, None)
+        self._results = {}
+
+        self._cached_config = self.load_cache()
+        if self._cached_config is not None:
+            # 缓存命中时不构建配置树，outline和serverBlock在首次访问时再生成
+            self.global_config = self._cached_config['global']
+            self.events_config = self._cached_config['events']
+            self.http_config = self._cached_config['http']
+            self.backend = self._cached_config['upstreams']
+            self.servers = self._cached_config['servers']
+            if self.compact:
+                self.backend = [Upstream.from_dict(pool) for pool in self.backend]
+                self.servers = [Server.from_dict(server) for server in self.servers]
+            self.build_upstream_index()
+
+    def cache_path(self):
+        """返回当前配置在缓存目录中的文件路径，未启用缓存时返回None
+
+        缓存按解析器版本、合并后的完整配置内容和位置映射 (source_files、source_runs) 的sha256区分，
+        validation中的警告带有文件和行号，内容相同但注释行或文件路径不同的配置不共用缓存。
+        """
+        if not self.cache_dir:
+            return None
+        digest = hashlib.sha256(f'{__version__}.{_CACHE_FORMAT}\0'.encode('utf-8'))
+        digest.update(self.content.encode('utf-8') if isinstance(self.content, str) else self.content)
+        digest.update('\0'.join(self.source_files).encode('utf-8', 'surrogateescape'))
+        for column in self.source_runs:
+            digest.update(b'\0')
+            digest.update(column.tobytes())
+        return os.path.join(self.cache_dir, f'{digest.hexdigest()}.pickle')
+
+    def load_cache(self):
+        """从缓存目录读取get_all_config的结果，没有可用缓存时返回None"""
+        path = self.cache_path()
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as fp:
+                return pickle.load(fp)
+        except Exception:
+            # 缓存文件损坏时忽略，重新解析
+            return None
+
+    def save_cache(self, config):
+        """将get_all_config的结果原子地写入缓存目录"""
+        path = self.cache_path()
+        if path is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump(config, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    def refresh(self):
+        """重新加载配置文件，只重新解析内容发生变化的server和upstream块
+
+        未修改的文件直接从文件缓存读取。已经构建了配置树时只重新扫描变化的范围并拼接到配置树中
+        (见changed_range和_splice_tree)，配置树中未变化的server块节点复用上一次的解析结果。
+        返回配置是否发生了变化。
+        """
+        old_content, old_segments = self.content, self.segments
+        tree = self.__dict__.get('tree')
+        self.segments = list()
+        self.merge_conf()
+        if self.content == old_content:
+            return False
+
+        self.parse()
+        if self._cached_config is None and tree is not None:
+            # 只重新扫描变化的部分，把它拼接到原来的配置树中，未变化的server块节点保持不变
+            modified = _splice_tree(tree, old_content, self.content, *self.changed_range(old_content, old_segments),
+                                    shallow=_DATA_BLOCKS)
+            if modified is not None:
+                self.tree = tree
+                for node in modified:
+                    self._server_cache.pop(node, None)
+        return True
+
+    def changed_range(self, old_content, old_segments):
+        """比较refresh前后合并的内容，返回变化的范围 (lo, old_hi, new_hi)
+
+        old_content[lo:old_hi]变为了self.content[lo:new_hi]，两端的内容相同。
+        先按segments整段跳过两端未变化的文件，再在变化的段中二分查找公共前缀和后缀。
+        """
+        new_content, new_segments = self.content, self.segments
+        lo = 0
+        for old, new in zip(old_segments, new_segments):
+            if old != new or old_content[old[1]:old[2]] != new_content[new[1]:new[2]]:
+                break
+            lo = old[2]
+        lo += _common_prefix(old_content[lo:], new_content[lo:])
+
+        old_hi, new_hi = len(old_content), len(new_content)
+        for old, new in zip(reversed(old_segments), reversed(new_segments)):
+            if (old[0] != new[0] or old[2] != old_hi or new[2] != new_hi or min(old[1], new[1]) < lo
+                    or old_content[old[1]:old[2]] != new_content[new[1]:new[2]]):
+                break
+            old_hi, new_hi = old[1], new[1]
+        suffix = _common_suffix(old_content[lo:old_hi], new_content[lo:new_hi])
+        return lo, old_hi - suffix, new_hi - suffix
+
+    @_lazy
+    def line_index(self):
+        """合并内容中每一行的来源 (starts, files, lines, offsets)，四个平行数组按合并后的偏移排序
+
+        首次查询位置时由source_runs逐行展开，之后每次查询都是一次二分查找。
+        """
+        run_starts, run_files, run_lines, run_offsets = self.source_runs
+        starts, files, lines, offsets = array('Q'), array('L'), array('L'), array('Q')
+        content = self.content
+        newline = '\n' if isinstance(content, str) else b'\n'
+        for i, pos in enumerate(run_starts):
+            end = run_starts[i + 1] if i + 1 < len(run_starts) else len(content)
+            line, offset = run_lines[i], run_offsets[i]
+            while pos < end:
+                starts.append(pos)
+                files.append(run_files[i])
+                lines.append(line)
+                offsets.append(offset)
+                next_line = content.find(newline, pos, end) + 1
+                if not next_line:
+                    break
+                chunk = content[pos:next_line]
+                offset += len(chunk.encode(_ENCODING)) if isinstance(chunk, str) else len(chunk)
+                line += 1
+                pos = next_line
+        return starts, files, lines, offsets
 
-    # 将所有include的配置，合并到一个配置文件里
+    def source_position(self, offset):
+        """返回合并后内容中offset处在原配置文件中的位置 (file, line, column, byte_offset)
+
+        line和column从1开始，column按字符计，byte_offset为在原文件中的字节偏移。
+        用二分查找line_index，不需要重新读取配置文件。
+        """
+        starts, files, lines, offsets = self.line_index
+        index = bisect_right(starts, offset) - 1
+        if index < 0:
+            return (self.conf_path, 1, 1, 0)
+        prefix = self.content[starts[index]:offset]
+        if isinstance(prefix, str):
+            column, size = len(prefix), len(prefix.encode(_ENCODING))
+        else:
+            column, size = len(_decode(prefix)), len(prefix)
+        return (self.source_files[files[index]], lines[index], column + 1, offsets[index] + size)
+
+    def source_file(self, offset):
+        """返回合并后内容中offset处的内容来自哪个配置文件"""
+        return self.source_position(offset)[0]
+
+    # 将所有include的配置（支持递归和通配符），在内存中合并到self.content里
+    @_instrumented
     def merge_conf(self):
-        # 切换到self.conf.path的当前目录
+        # include的相对路径以主配置文件所在目录为准
         conf_dir = os.path.dirname(self.conf_path)
 
-        # 判断是否是nginx.py的当前目录
-        if len(conf_dir) != 0:
-            os.chdir(conf_dir)
-
-        include_regex = r'^[^#]nclude\s*([^;]*);'
-
-        # 现将include的文件的内容整合一个文件，并且去掉注释行
-        fm = open(self.tmp_conf, 'w+')
-        with open(self.conf_path, 'r') as f:
-            for line in f.readlines():
-                r = re.findall(include_regex, line)
-                # 如果存在include行
-                if len(r) > 0:
-                    include_path = r[0]
-                    if os.path.exists(include_path):
-                        with open(include_path, 'r') as ff:
-                            include_con = ff.read()
-                            fm.write(include_con)
-                else:
-                    fm.write(line)
-        fm.close()
-
-        fm = open(self.tmp_conf, 'r')
-        # 去掉注释行
-        with open(self.all_conf, 'w+') as fp:
-            for xx in fm.readlines():
-                # 判断是否是注释标识符#开头
-                if len(re.findall(r'^\s*#', xx)) == 0:
-                    fp.write(xx)
-        fm.close()
-
-        # 删除临时配置文件
-        if os.path.exists(self.tmp_conf):
-            os.remove(self.tmp_conf)
+        parts = []
+        offset = 0
+        active = set()  # 正在展开的文件，用于检测循环include
+
+        # 合并内容中每段与原文件连续对应的内容的来源：合并后的起始偏移、文件序号、起始行号和字节偏移
+        self.source_runs = (array('Q'), array('L'), array('L'), array('Q'))
+        starts, files, lines, offsets = self.source_runs
+        self.source_files = []  # 文件序号 -> 路径
+        file_ids = {}
+        self.__dict__.pop('line_index', None)
+
+        def append(path, text, table):
+            nonlocal offset
+            parts.append(text)
+            # 同一文件的连续内容合并为一段
+            if self.segments and self.segments[-1][0] == path and self.segments[-1][2] == offset:
+                self.segments[-1] = (path, self.segments[-1][1], offset + len(text))
+            else:
+                self.segments.append((path, offset, offset + len(text)))
+            if path not in file_ids:
+                file_ids[path] = len(self.source_files)
+                self.source_files.append(path)
+            starts.extend(offset + start for start in table[0])
+            files.extend([file_ids[path]] * len(table[0]))
+            lines.extend(table[1])
+            offsets.extend(table[2])
+            offset += len(text)
+
+        def expand(path):
+            real = os.path.realpath(path)
+            if real in active:
+                return
+            active.add(real)
+            chunks, tables = _map_conf(path) if self.use_mmap else _load_conf(path)
+            for chunk, table in zip(chunks, tables):
+                if not isinstance(chunk, tuple):
+                    append(path, chunk, table)
+                    continue
 
+                pattern, line = chunk
+                pattern = os.path.join(conf_dir, pattern)
+                if _PATTERNS['glob_magic'].search(pattern):
+                    matches = sorted(glob.glob(pattern))
+                else:
+                    matches = [pattern] if os.path.isfile(pattern) else []
+
+                # 找不到被include的文件时保留原include行
+                if not matches:
+                    append(path, line, table)
+                for include_path in matches:
+                    expand(include_path)
+            active.discard(real)
+
+        expand(self.conf_path)
+        if not self.use_mmap:
+            self.content = ''.join(parts)
+            return
+
+        # 映射内容复制一次为bytes后立即关闭映射：映射保留下来时，文件被截断后访问会触发SIGBUS，
+        # 原地修改文件也会改变已加载的内容，refresh就无法发现变化
+        self.content = b''.join(parts)
+        mappings = []
+        for part in parts:
+            if isinstance(part, memoryview):
+                mappings.append(part.obj)
+                part.release()
+            elif isinstance(part, mmap.mmap):
+                mappings.append(part)
+        for mapping in mappings:
+            mapping.close()
+
+    @_instrumented
     def parse_global_block(self):
         """解析全局配置块 (Global Block)"""
-        with open(self.all_conf, 'r') as fp:
-            alllines = fp.read()
-
-        # 定义全局指令的正则表达式
-        global_directives = {
-            'user': r'^\s*user\s+([^;]+);',
-            'worker_processes': r'^\s*worker_processes\s+([^;]+);',
-            'worker_cpu_affinity': r'^\s*worker_cpu_affinity\s+([^;]+);',
-            'error_log': r'^\s*error_log\s+([^;]+);',
-            'pid': r'^\s*pid\s+([^;]+);',
-            'worker_rlimit_nofile': r'^\s*worker_rlimit_nofile\s+([^;]+);'
-        }
+        self.global_config = {}
+        global_directives = ['user', 'worker_processes', 'worker_cpu_affinity', 'error_log', 'pid', 'worker_rlimit_nofile']
 
-        # 解析每个全局指令
-        for directive_name, regex in global_directives.items():
-            match = re.search(regex, alllines, re.MULTILINE)
-            if match:
-                self.global_config[directive_name] = match.group(1).strip()
+        for directive_name in global_directives:
+            node = self.outline.find(directive_name)
+            if node is not None and node.block is None:
+                self.global_config[directive_name] = node.value
 
+    @_instrumented
     def parse_events_block(self):
         """解析events配置块 (Events Block)"""
-        with open(self.all_conf, 'r') as fp:
-            alllines = fp.read()
-
-        # 提取events块内容
-        events_regex = r'events\s*\{([^}]*)\}'
-        events_match = re.search(events_regex, alllines, re.DOTALL)
-
-        if events_match:
-            events_content = events_match.group(1)
-
-            # 定义events指令的正则表达式
-            events_directives = {
-                'use': r'^\s*use\s+([^;]+);',
-                'worker_connections': r'^\s*worker_connections\s+([^;]+);',
-                'multi_accept': r'^\s*multi_accept\s+([^;]+);',
-                'accept_mutex': r'^\s*accept_mutex\s+([^;]+);'
-            }
+        self.events_config = {}
+        events = self.outline.find('events')
+        if events is None or events.block is None:
+            return
+
+        events_directives = ['use', 'worker_connections', 'multi_accept', 'accept_mutex']
 
-            # 解析每个events指令
-            for directive_name, regex in events_directives.items():
-                match = re.search(regex, events_content, re.MULTILINE)
-                if match:
-                    self.events_config[directive_name] = match.group(1).strip()
+        for directive_name in events_directives:
+            node = events.find(directive_name)
+            if node is not None and node.block is None:
+                self.events_config[directive_name] = node.value
 
+    @_instrumented
     def parse_http_block(self):
         """解析http配置块 (HTTP Block) - 提取http级别的指令"""
-        with open(self.all_conf, 'r') as fp:
-            alllines = fp.read()
-
-        # 提取http块内容 (注意：这个正则不够完美，但对大多数情况有效)
-        http_regex = r'http\s*\{(.*)'
-        http_match = re.search(http_regex, alllines, re.DOTALL)
-
-        if http_match:
-            # 获取http块的开始位置
-            http_start = http_match.start()
-            http_content = alllines[http_start:]
-
-            # 定义http指令的正则表达式
-            http_directives = {
-                'default_type': r'^\s*default_type\s+([^;]+);',
-                'sendfile': r'^\s*sendfile\s+([^;]+);',
-                'keepalive_timeout': r'^\s*keepalive_timeout\s+([^;]+);',
-                'gzip': r'^\s*gzip\s+([^;]+);'
-            }
+        self.http_config = {}
+        http = self.outline.find('http')
+        if http is None or http.block is None:
+            return
+
+        http_directives = ['default_type', 'sendfile', 'keepalive_timeout', 'gzip']
 
-            # 解析每个http指令
-            for directive_name, regex in http_directives.items():
-                match = re.search(regex, http_content, re.MULTILINE)
-                if match:
-                    self.http_config[directive_name] = match.group(1).strip()
+        for directive_name in http_directives:
+            node = http.find(directive_name)
+            if node is not None and node.block is None:
+                self.http_config[directive_name] = node.value
 
+    @_instrumented
     def parse_backend_ip(self):
         # 获取后端的poolname和对应的ip，放在一个dict的list里
-        with open(self.all_conf, 'r') as fp:
-            alllines = fp.read()
-
-            # 获取每个upstream块
-            regex_1 = r'upstream\s+([^{ ]+)\s*\{([^}]*)\}'
-            upstreams = re.findall(regex_1, alllines, re.DOTALL)
-
-            for up in upstreams:
-                poolname = up[0].strip()
-                upstream_content = up[1]
-
-                # 检测负载均衡方法
-                load_balancing = 'round_robin'  # 默认
-                if re.search(r'least_conn\s*;', upstream_content):
-                    load_balancing = 'least_conn'
-                elif re.search(r'ip_hash\s*;', upstream_content):
-                    load_balancing = 'ip_hash'
-                elif re.search(r'hash\s+', upstream_content):
-                    hash_match = re.search(r'hash\s+([^;]+);', upstream_content)
-                    if hash_match:
-                        load_balancing = f"hash {hash_match.group(1).strip()}"
-
-                # 获取每个server行的详细信息
-                # 匹配完整的server行，包括所有参数
-                server_regex = r'server\s+([^\s;]+)([^;]*);'
-                servers = re.findall(server_regex, upstream_content)
-
-                server_list = []
-                backend_ips = []
-
-                for srv in servers:
-                    server_addr = srv[0].strip()
-                    params_str = srv[1].strip()
-
-                    # 解析参数
-                    server_info = {
-                        'address': server_addr
-                    }
-
-                    # 提取weight
-                    weight_match = re.search(r'weight=(\d+)', params_str)
-                    if weight_match:
-                        server_info['weight'] = int(weight_match.group(1))
+        # 内容未变化的upstream块直接复用上一次的解析结果 (见refresh)
+        self.backend = list()
+        previous, self._upstream_cache = self._upstream_cache, {}
+        # 只取http的upstream (没有http块的配置片段中顶层的upstream也属于http)，
+        # stream块中的upstream与http的是两个命名空间，由parse_stream_module单独解析。
+        # upstream不会出现在server块中，不必展开server
+        for up in self.walk_nodes(skip=('server', 'stream') + _DATA_BLOCKS):
+            if up.name != 'upstream' or up.block is None or not up.args:
+                continue
 
-                    # 提取max_fails
-                    max_fails_match = re.search(r'max_fails=(\d+)', params_str)
-                    if max_fails_match:
-                        server_info['max_fails'] = int(max_fails_match.group(1))
+            text = _decode(self.content[up.start:up.end])
+            pool_data = previous.pop(text) if text in previous else self.parse_upstream(up)
+            self._upstream_cache[text] = pool_data
+            if pool_data is not None:
+                self.backend.append(pool_data)
+
+        self.build_upstream_index()
+
+    def build_upstream_index(self):
+        """建立poolname到upstream的索引，所有proxy_pass/grpc_pass解析都通过它查找"""
+        self.upstreams_by_name = {}
+        for pool in self.backend:
+            self.upstreams_by_name.setdefault(pool['poolname'], pool)
+
+    @_instrumented
+    def parse_upstream(self, up):
+        """解析单个upstream块，没有后端server时返回None"""
+        poolname = up.args[0]
+
+        # 检测负载均衡方法
+        load_balancing = 'round_robin'  # 默认
+        if up.find('least_conn') is not None:
+            load_balancing = 'least_conn'
+        elif up.find('ip_hash') is not None:
+            load_balancing = 'ip_hash'
+        else:
+            hash_node = up.find('hash')
+            if hash_node is not None and hash_node.args:
+                load_balancing = f"hash {hash_node.value}"
 
-                    # 提取fail_timeout
-                    fail_timeout_match = re.search(r'fail_timeout=([^\s]+)', params_str)
-                    if fail_timeout_match:
-                        server_info['fail_timeout'] = fail_timeout_match.group(1)
+        server_list = []
+        backend_ips = []
 
-                    # 检查backup标志
-                    if 'backup' in params_str:
-                        server_info['backup'] = True
+        # 获取每个server行的详细信息
+        for srv in up.find_all('server'):
+            args = srv.args
+            if srv.block is not None or not args:
+                continue
+            server_addr = args[0]
+            params = args[1:]
+
+            # 解析参数
+            server_info = {'address': server_addr}
+
+            for param in params:
+                key, _, val = param.partition('=')
+                # 提取weight和max_fails
+                if key in ('weight', 'max_fails') and val.isdigit():
+                    server_info[key] = int(val)
+                # 提取fail_timeout
+                elif key == 'fail_timeout' and val:
+                    server_info['fail_timeout'] = val
+
+            # 检查backup和down标志
+            if 'backup' in params:
+                server_info['backup'] = True
+            if 'down' in params:
+                server_info['down'] = True
+
+            server_list.append(self.record(UpstreamServer, **server_info))
+            backend_ips.append(server_addr)
+
+        # 判断是否有后端的ip设置
+        if len(server_list) > 0:
+            return self.record(
+                Upstream,
+                poolname=poolname,
+                ip=' '.join(backend_ips),
+                servers=server_list,
+                load_balancing=load_balancing
+            )
+        return None
 
-                    # 检查down标志
-                    if 'down' in params_str:
-                        server_info['down'] = True
+    def iter_server_nodes(self, root=None):
+        """遍历root (默认为已构建的配置树或outline) 中所有http server块 (跳过upstream和stream中的server)
 
-                    server_list.append(server_info)
-                    backend_ips.append(server_addr)
-
-                # 判断是否有后端的ip设置
-                if len(server_list) > 0:
-                    pool_data = {
-                        'poolname': poolname,
-                        'ip': ' '.join(backend_ips),
-                        'servers': server_list,
-                        'load_balancing': load_balancing
-                    }
-                    self.backend.append(pool_data)
-
-    def parse_server_block(self):
-        flag = False
-        serverblock = ''
-        num_of_quote = 0
-
-        with open(self.all_conf, 'r') as fp:
-            for line in fp.readlines():
-                x = line.replace(' ', '')
-                if x.startswith('server{'):
-                    num_of_quote += 1
-                    flag = True
-                    serverblock += line
+        使用outline时server块在生成时才展开，不构建整个配置树。
+        """
+        if root is None:
+            root = self.tree if 'tree' in self.__dict__ else self.outline
+        stack = [iter(root.block)]
+        while stack:
+            for child in stack[-1]:
+                if child.block is None or child.name in ('upstream', 'stream'):
                     continue
-                # 发现{，计数加1。发现}，计数减1，直到计数为0
-                if flag and '{' in line:
-                    num_of_quote += 1
-
-                # 将proxy_pass的别名换成ip
-                if flag and 'proxy_pass' in line:
-                    r = re.findall(r'proxy_pass\s+https?://([^;/]*)[^;]*;', line)
-                    if len(r) > 0:
-                        for pool in self.backend:
-                            if r[0] == pool['poolname']:
-                                line = line.replace(r[0], pool['ip'])
-
-                if flag and num_of_quote != 0:
-                    serverblock += line
-
-                if flag and '}' in line:
-                    num_of_quote -= 1
-
-                if flag and num_of_quote == 0:
-                    self.serverBlock.append(serverblock)
-                    flag = False
-                    serverblock = ''
-                    num_of_quote = 0
-
-        for singleServer in self.serverBlock:
-            # TASK_022: 支持多个listen指令
-            listen_matches = re.findall(r'listen\s+([^;]+);', singleServer)
-            listen_directives = []
-            for listen_match in listen_matches:
-                listen_directives.append(listen_match.strip())
-
-            # 保持向后兼容，提取第一个listen作为port
-            port = listen_directives[0] if listen_directives else ''
-
-            r = re.findall(r'server_name\s+([^;]*);', singleServer)  # server_name只有一个
-
-            # 可能存在没有server_name的情况
-            if len(r) > 0:
-                servername = r[0]
+                if root is not self.__dict__.get('tree'):
+                    child = self.expand(child)
+                if child.name == 'server':
+                    yield child
+                else:
+                    stack.append(iter(child.block))
+                    break
             else:
+                stack.pop()
+
+    def server_block_text(self, node):
+        """返回server块的原始文本，并将proxy_pass中的upstream名替换为后端ip"""
+        pools = self.upstreams_by_name
+        if not pools:
+            return _decode(self.content[node.start:node.end])
+
+        # 按指令边界切分后再替换，偏移在str和bytes(mmap)模式下都有效
+        pieces = []
+        pos = node.start
+        for directive in node.walk():
+            if directive.name != 'proxy_pass':
                 continue
+            args = directive.args
+            r = _PATTERNS['http_pool'].match(args[0]) if args else None
+            if r and r.group(1) in pools:
+                pieces.append(_decode(self.content[pos:directive.start]))
+                pieces.append(_decode(self.content[directive.start:directive.end]).replace(r.group(1), pools[r.group(1)]['ip']))
+                pos = directive.end
+        pieces.append(_decode(self.content[pos:node.end]))
+        return ''.join(pieces)
+
+    @_instrumented
+    def parse_server_block(self):
+        # refresh后配置树中保留下来的server块节点复用上一次的解析结果 (见refresh)
+        self.servers = list()
+        previous, self._server_cache = self._server_cache, {}
+        # 解析全部server时构建完整的配置树，之后解析upstream、校验等遍历不必再逐个展开块
+        blocks = list(self.iter_server_nodes(self.tree))
+        pools = {name: pool['ip'] for name, pool in self.upstreams_by_name.items()}
+        if pools != self._server_pools:
+            # 解析结果中的upstream名已经替换为ip，upstream变化后需要重新解析
+            previous = {}
+        self._server_pools = pools
+        pending = [node for node in blocks if node not in previous]
+
+        if self.workers and self.workers > 1 and len(pending) > 1:
+            parsed = self.parse_servers_parallel([_decode(self.content[node.start:node.end]) for node in pending])
+        else:
+            parsed = [self.parse_server(node) for node in pending]
+        parsed = dict(zip(pending, parsed))
 
-            # 判断servername是否有ip，有ip就不存。比如servername 127.0.0.1这样的配置
-            if len(re.findall(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', servername)) > 0:
-                continue
-
-            # TASK_025: 解析root和index指令
-            root_match = re.search(r'root\s+([^;]+);', singleServer)
-            root = root_match.group(1).strip() if root_match else None
-
-            index_match = re.search(r'index\s+([^;]+);', singleServer)
-            index = index_match.group(1).strip() if index_match else None
-
-            # TASK_024: 解析server级别的access_log和error_log
-            access_log_match = re.search(r'access_log\s+([^;]+);', singleServer)
-            access_log = access_log_match.group(1).strip() if access_log_match else None
-
-            error_log_match = re.search(r'error_log\s+([^;]+);', singleServer)
-            error_log = error_log_match.group(1).strip() if error_log_match else None
-
-            # TASK_023: 解析SSL/TLS配置
-            ssl_certificate_match = re.search(r'ssl_certificate\s+([^;]+);', singleServer)
-            ssl_certificate = ssl_certificate_match.group(1).strip() if ssl_certificate_match else None
-
-            ssl_certificate_key_match = re.search(r'ssl_certificate_key\s+([^;]+);', singleServer)
-            ssl_certificate_key = ssl_certificate_key_match.group(1).strip() if ssl_certificate_key_match else None
-
-            ssl_protocols_match = re.search(r'ssl_protocols\s+([^;]+);', singleServer)
-            ssl_protocols = ssl_protocols_match.group(1).strip() if ssl_protocols_match else None
-
-            ssl_ciphers_match = re.search(r'ssl_ciphers\s+([^;]+);', singleServer)
-            ssl_ciphers = ssl_ciphers_match.group(1).strip() if ssl_ciphers_match else None
-
-            include = ' '.join(re.findall(r'include\s+([^;]*);', singleServer))  # include不止一个
-
-            # TASK_026-030: 增强location块解析
-            # TASK_027: 支持location修饰符 (=, ~, ~*, ^~)
-            # TASK_028: 支持fastcgi_pass
-            # TASK_029: 支持rewrite规则
-            # TASK_030: 支持try_files
-            locations = self.parse_locations(singleServer)
-
-            # TASK_001: 解析安全头部配置
-            security_headers_data = self.parse_security_headers(singleServer)
-
-            # TASK #3: 解析ACL
-            acl_data = self.parse_acl(singleServer)
-
-            # TASK #4: 解析认证配置
-            auth_data = self.parse_authentication(singleServer)
-
-            server = {
-                'port': port,
-                'listen': listen_directives,
-                'server_name': servername,
-                'root': root,
-                'index': index,
-                'access_log': access_log,
-                'error_log': error_log,
-                'ssl_certificate': ssl_certificate,
-                'ssl_certificate_key': ssl_certificate_key,
-                'ssl_protocols': ssl_protocols,
-                'ssl_ciphers': ssl_ciphers,
-                'include': include,
-                'backend': locations
-            }
-
-            # 合并所有解析的数据到server字典
-            server.update(security_headers_data)
-            server.update(acl_data)
-            server.update(auth_data)
+        for node in blocks:
+            server = parsed[node] if node in parsed else previous[node]
+            self._server_cache[node] = server
+            if server is not None:
+                self.servers.append(server)
 
-            self.servers.append(server)
+    def iter_servers(self):
+        """逐个生成解析后的server，不累积到self.servers
 
-    def parse_security_headers(self, server_block):
+        配置较大、只需要遍历一遍server时使用，内存占用与server数量无关。
+        """
+        if self._cached_config is not None:
+            # 从缓存目录加载时直接使用缓存的结果
+            yield from self.servers
+            return
+        for node, server in self.iter_server_pairs():
+            if server is not None:
+                yield server
+
+    def iter_server_pairs(self):
+        """逐个生成 (server块节点, 解析后的server)，没有server_name或只有IP名字的块server为None"""
+        for node in self.iter_server_nodes():
+            server = self._server_cache.get(node)
+            if server is None and node not in self._server_cache:
+                server = self.parse_server(node)
+            yield node, server
+
+    @_instrumented
+    def parse_servers_parallel(self, blocks):
+        """把server块的原文分片交给进程池解析，按原顺序返回结果"""
+        # 子进程只需要pool name到ip的映射，不传整个upstream
+        pools = {name: {'ip': up['ip']} for name, up in self.upstreams_by_name.items()}
+        chunk_size = max(1, -(-len(blocks) // (self.workers * 4)))
+        chunks = [blocks[i:i + chunk_size] for i in range(0, len(blocks), chunk_size)]
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            results = executor.map(_parse_server_chunk, chunks,
+                                   [pools] * len(chunks), [self.compact] * len(chunks))
+            return [server for chunk in results for server in chunk]
+
+    @_instrumented
+    def parse_server(self, node):
+        """解析单个server块，没有server_name或server_name为ip时返回None"""
+        # TASK_022: 支持多个listen指令
+        listen_directives = [d.value for d in node.find_all('listen')]
+
+        # 保持向后兼容，提取第一个listen作为port
+        port = listen_directives[0] if listen_directives else ''
+
+        # 可能存在没有server_name的情况
+        server_name_node = node.find('server_name')
+        if server_name_node is None:
+            return None
+        servername = server_name_node.value
+
+        # 逐个名字判断是否为ip，ip不作为名字。全部是ip时不存，比如servername 127.0.0.1这样的配置
+        server_names = split_server_names(servername)
+        if not server_names:
+            return None
+
+        # 与原来的整块正则保持一致：取server块内（含location）第一次出现的值
+        # 只遍历一次server块，分组结果交给下面的安全头部、ACL、认证解析共用
+        found = node.group()
+
+        def directive_value(name):
+            return found[name][0].value if name in found else None
+
+        # TASK_025: 解析root和index指令
+        root = directive_value('root')
+        index = directive_value('index')
+
+        # TASK_024: 解析server级别的access_log和error_log
+        access_log = directive_value('access_log')
+        error_log = directive_value('error_log')
+
+        # TASK_023: 解析SSL/TLS配置
+        ssl_certificate = directive_value('ssl_certificate')
+        ssl_certificate_key = directive_value('ssl_certificate_key')
+        ssl_protocols = directive_value('ssl_protocols')
+        ssl_ciphers = directive_value('ssl_ciphers')
+
+        include = ' '.join(d.value for d in found.get('include', ()))  # include不止一个
+
+        # TASK_026-030: 增强location块解析
+        # TASK_027: 支持location修饰符 (=, ~, ~*, ^~)
+        # TASK_028: 支持fastcgi_pass
+        # TASK_029: 支持rewrite规则
+        # TASK_030: 支持try_files
+        locations = self.parse_locations(node)
+
+        # TASK_001: 解析安全头部配置
+        security_headers_data = self.parse_security_headers(node, found)
+
+        # TASK #3: 解析ACL
+        acl_data = self.parse_acl(node, found)
+
+        # TASK #4: 解析认证配置
+        auth_data = self.parse_authentication(node, found)
+
+        return self.record(
+            Server,
+            port=port,
+            listen=listen_directives,
+            server_name=servername,
+            server_names=server_names,
+            root=root,
+            index=index,
+            access_log=access_log,
+            error_log=error_log,
+            ssl_certificate=ssl_certificate,
+            ssl_certificate_key=ssl_certificate_key,
+            ssl_protocols=ssl_protocols,
+            ssl_ciphers=ssl_ciphers,
+            include=include,
+            backend=locations,
+            # 合并所有解析的数据
+            **security_headers_data,
+            **acl_data,
+            **auth_data
+        )
+
+    def record(self, cls, **fields):
+        """构建解析结果：compact模式下为cls (Record)，否则直接构建与cls.to_dict()结构相同的dict，不再转换"""
+        if self.compact:
+            return cls(**fields)
+        return {key: fields[key] for key in cls.__slots__ if key in fields}
+
+    def proxy_target(self, value):
+        """proxy_pass的参数中http(s)://之后是upstream名时替换为该upstream的后端ip"""
+        r = _PATTERNS['http_pool'].match(value)
+        if r:
+            pool = self.upstreams_by_name.get(r.group(1))
+            if pool is not None:
+                return value[:r.start(1)] + pool['ip'] + value[r.end(1):]
+        return value
+
+    @_instrumented
+    def parse_security_headers(self, server, found=None):
         """解析安全相关的HTTP头部配置 (TASK_001)
 
+        found为server.group()的结果，已经分组时传入避免重复遍历。
+
         支持的安全头部：
         - X-Frame-Options
         - X-Content-Type-Options
@@ -381,18 +2136,17 @@ class NGINX:
             'Cross-Origin-Resource-Policy'
         ]
 
-        # 首先找出所有 add_header 指令
-        # 匹配模式：add_header Header-Name value; 或 add_header Header-Name "value" always;
-        # 支持带引号和不带引号的值
-        add_header_pattern = r'add_header\s+([A-Za-z-]+)\s+(["\']?)(.+?)\2\s*(?:always)?\s*;'
-        all_add_headers = re.findall(add_header_pattern, server_block, re.IGNORECASE | re.MULTILINE)
-
-        # 按header名称分组，保留最后一个出现的值
+        # 找出server块 (含location) 中所有 add_header 指令：add_header Header-Name value; 或
+        # add_header Header-Name "value" always;，按header名称分组，保留最后一个出现的值
+        if found is None:
+            found = server.group()
         header_map = {}
-        for match in all_add_headers:
-            header_name = match[0]
-            header_value = match[2].strip()
-            header_map[header_name.lower()] = (header_name, header_value)
+        for directive in found.get('add_header', ()):
+            args = directive.args
+            if len(args) > 2 and args[-1] == 'always':
+                args.pop()
+            if len(args) >= 2:
+                header_map[args[0].lower()] = (args[0], ' '.join(args[1:]).strip())
 
         # 从分组中提取安全相关的header
         for security_header in security_header_names:
@@ -403,82 +2157,81 @@ class NGINX:
 
         return {'security_headers': security_headers} if security_headers else {'security_headers': {}}
 
-    def parse_locations(self, server_block):
-        """解析location块，支持proxy_pass, fastcgi_pass, rewrite, try_files"""
-        location_list = []
-
-        # 匹配location块 - 支持修饰符 (=, ~, ~*, ^~)
-        # 这个正则会匹配整个location块
-        location_pattern = r'location\s*(=|~\*?|\^~)?\s*([^{]+)\{([^}]*(?:\{[^}]*\}[^}]*)*)\}'
-        location_matches = re.findall(location_pattern, server_block, re.DOTALL)
-
-        for loc_match in location_matches:
-            modifier = loc_match[0].strip() if loc_match[0] else None
-            path = loc_match[1].strip()
-            content = loc_match[2]
+    @_instrumented
+    def parse_locations(self, server):
+        """解析server中的location块，支持proxy_pass, fastcgi_pass, rewrite, try_files
 
-            location_info = {
-                'path': path,
-                'modifier': modifier
-            }
-
-            # TASK_026: 解析proxy_pass
-            proxy_pass_match = re.search(r'proxy_pass\s+(https?://[^;]+);', content)
-            if proxy_pass_match:
-                proxy_pass_url = proxy_pass_match.group(1).strip()
-                location_info['proxy_pass'] = proxy_pass_url
-
-                # 提取backend name或IP
-                backend_match = re.search(r'https?://([^;/]+)', proxy_pass_url)
-                if backend_match:
-                    poolname = backend_match.group(1)
-                    # 如果不是IP，查找对应的upstream
-                    if not re.match(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', poolname):
-                        for backend in self.backend:
-                            if poolname == backend['poolname']:
-                                location_info['backend_ip'] = backend['ip']
-                                break
-                    else:
-                        location_info['backend_ip'] = poolname
+        嵌套的location解析为外层location的locations，每个location只包含它自己的指令。
+        """
+        return [self.parse_location(node) for node in _location_scope(server)[1]]
+
+    def parse_location(self, node):
+        """解析单个location块及其中嵌套的location"""
+        # 修饰符 (=, ~, ~*, ^~) 和路径在location与{之间
+        header = _PATTERNS['location_header'].match(node.value)
+        modifier = header.group(1)
+        path = header.group(2).strip()
+
+        found, nested = _location_scope(node)
+        location_info = {'path': path, 'modifier': modifier}
+
+        # TASK_026: 解析proxy_pass，upstream名替换为后端ip
+        proxy_pass_url = None
+        for url in found.get('proxy_pass', ()):
+            url = self.proxy_target(url)
+            if url.startswith(('http://', 'https://')):
+                proxy_pass_url = url
+                break
+        if proxy_pass_url:
+            location_info['proxy_pass'] = proxy_pass_url
+
+            # 提取backend name或IP
+            backend_match = _PATTERNS['backend_host'].search(proxy_pass_url)
+            if backend_match:
+                poolname = backend_match.group(1)
+                # 如果不是IP，查找对应的upstream
+                if not _PATTERNS['ipv4'].match(poolname):
+                    backend = self.upstreams_by_name.get(poolname)
+                    if backend is not None:
+                        location_info['backend_ip'] = backend['ip']
+                else:
+                    location_info['backend_ip'] = poolname
 
-                # 保持向后兼容
-                location_info['backend_path'] = path
+            # 保持向后兼容
+            location_info['backend_path'] = path
 
-            # TASK_028: 解析fastcgi_pass
-            fastcgi_pass_match = re.search(r'fastcgi_pass\s+([^;]+);', content)
-            if fastcgi_pass_match:
-                location_info['fastcgi_pass'] = fastcgi_pass_match.group(1).strip()
+        # TASK_028: 解析fastcgi_pass
+        if 'fastcgi_pass' in found:
+            location_info['fastcgi_pass'] = found['fastcgi_pass'][0]
 
-            # TASK_029: 解析rewrite规则
-            rewrite_matches = re.findall(r'rewrite\s+([^;]+);', content)
-            if rewrite_matches:
-                location_info['rewrites'] = [r.strip() for r in rewrite_matches]
+        # TASK_029: 解析rewrite规则
+        if 'rewrite' in found:
+            location_info['rewrites'] = found['rewrite']
 
-            # TASK_030: 解析try_files
-            try_files_match = re.search(r'try_files\s+([^;]+);', content)
-            if try_files_match:
-                location_info['try_files'] = try_files_match.group(1).strip()
+        # TASK_030: 解析try_files
+        if 'try_files' in found:
+            location_info['try_files'] = found['try_files'][0]
 
-            # 解析其他常见指令
-            root_match = re.search(r'root\s+([^;]+);', content)
-            if root_match:
-                location_info['root'] = root_match.group(1).strip()
+        # 解析其他常见指令
+        if 'root' in found:
+            location_info['root'] = found['root'][0]
 
-            index_match = re.search(r'index\s+([^;]+);', content)
-            if index_match:
-                location_info['index'] = index_match.group(1).strip()
+        if 'index' in found:
+            location_info['index'] = found['index'][0]
 
-            location_list.append(location_info)
+        if nested:
+            location_info['locations'] = [self.parse_location(child) for child in nested]
 
-        return location_list
+        return self.record(Location, **location_info)
 
     # TASK #2: Parse rate limiting configuration
+    @_instrumented
     def parse_rate_limiting(self, content):
         """解析速率限制配置"""
         rate_limit_data = {}
 
         # Parse limit_req_zone (http context)
-        limit_req_zone_matches = re.findall(r'limit_req_zone\s+(\$[^\s]+)\s+zone=([^:]+):(\S+)\s+rate=([^;]+);', content)
+        limit_req_zone_matches = _PATTERNS['limit_req_zone'].findall(content)
         if limit_req_zone_matches:
             rate_limit_data['zones'] = []
             for match in limit_req_zone_matches:
@@ -490,7 +2243,7 @@ class NGINX:
                 })
 
         # Parse limit_req (server/location context)
-        limit_req_matches = re.findall(r'limit_req\s+zone=([^\s]+)(?:\s+burst=(\d+))?(?:\s+nodelay)?;', content)
+        limit_req_matches = _PATTERNS['limit_req'].findall(content)
         if limit_req_matches:
             rate_limit_data['requests'] = []
             for match in limit_req_matches:
@@ -500,7 +2253,7 @@ class NGINX:
                 rate_limit_data['requests'].append(req_data)
 
         # Parse limit_conn_zone
-        limit_conn_zone_matches = re.findall(r'limit_conn_zone\s+(\$[^\s]+)\s+zone=([^:]+):(\S+);', content)
+        limit_conn_zone_matches = _PATTERNS['limit_conn_zone'].findall(content)
         if limit_conn_zone_matches:
             rate_limit_data['conn_zones'] = []
             for match in limit_conn_zone_matches:
@@ -511,7 +2264,7 @@ class NGINX:
                 })
 
         # Parse limit_conn
-        limit_conn_matches = re.findall(r'limit_conn\s+([^\s]+)\s+(\d+);', content)
+        limit_conn_matches = _PATTERNS['limit_conn'].findall(content)
         if limit_conn_matches:
             rate_limit_data['connections'] = []
             for match in limit_conn_matches:
@@ -523,66 +2276,70 @@ class NGINX:
         return {'rate_limiting': rate_limit_data} if rate_limit_data else {}
 
     # TASK #3: Parse access control lists (ACL)
-    def parse_acl(self, content):
-        """解析访问控制列表"""
+    @_instrumented
+    def parse_acl(self, server, found=None):
+        """解析访问控制列表，found同parse_security_headers"""
         acl_rules = []
+        if found is None:
+            found = server.group()
 
         # Parse allow directives
-        allow_matches = re.findall(r'allow\s+([^;]+);', content)
-        for match in allow_matches:
-            acl_rules.append({'action': 'allow', 'address': match.strip()})
+        for directive in found.get('allow', ()):
+            acl_rules.append({'action': 'allow', 'address': directive.value})
 
         # Parse deny directives
-        deny_matches = re.findall(r'deny\s+([^;]+);', content)
-        for match in deny_matches:
-            acl_rules.append({'action': 'deny', 'address': match.strip()})
+        for directive in found.get('deny', ()):
+            acl_rules.append({'action': 'deny', 'address': directive.value})
 
         return {'acl': acl_rules} if acl_rules else {}
 
     # TASK #4: Parse authentication configuration
-    def parse_authentication(self, content):
-        """解析认证配置"""
+    @_instrumented
+    def parse_authentication(self, server, found=None):
+        """解析认证配置，found同parse_security_headers"""
         auth_config = {}
+        if found is None:
+            found = server.group()
+        found = {name: [directive.value for directive in directives]
+                 for name, directives in found.items() if name.startswith('auth_')}
 
         # Parse auth_basic
-        auth_basic_match = re.search(r'auth_basic\s+"?([^";]+)"?;', content)
-        if auth_basic_match:
-            auth_config['auth_basic'] = auth_basic_match.group(1).strip()
+        if 'auth_basic' in found:
+            auth_config['auth_basic'] = found['auth_basic'][0].strip('"').strip()
 
         # Parse auth_basic_user_file
-        auth_user_file_match = re.search(r'auth_basic_user_file\s+([^;]+);', content)
-        if auth_user_file_match:
-            auth_config['auth_basic_user_file'] = auth_user_file_match.group(1).strip()
+        if 'auth_basic_user_file' in found:
+            auth_config['auth_basic_user_file'] = found['auth_basic_user_file'][0]
 
         # Parse auth_request
-        auth_request_match = re.search(r'auth_request\s+([^;]+);', content)
-        if auth_request_match:
-            auth_config['auth_request'] = auth_request_match.group(1).strip()
+        if 'auth_request' in found:
+            auth_config['auth_request'] = found['auth_request'][0]
 
         # Parse auth_request_set
-        auth_request_set_matches = re.findall(r'auth_request_set\s+(\$[^\s]+)\s+([^;]+);', content)
-        if auth_request_set_matches:
-            auth_config['auth_request_set'] = []
-            for match in auth_request_set_matches:
-                auth_config['auth_request_set'].append({
-                    'variable': match[0],
-                    'value': match[1].strip()
+        for value in found.get('auth_request_set', ()):
+            variable = value.split(None, 1)
+            if len(variable) == 2 and variable[0].startswith('$'):
+                auth_config.setdefault('auth_request_set', []).append({
+                    'variable': variable[0],
+                    'value': variable[1].strip()
                 })
 
         return {'authentication': auth_config} if auth_config else {}
 
     # TASK #5-7: Parse caching configuration
+    @_instrumented
     def parse_caching(self, content):
         """解析缓存配置"""
         cache_config = {}
 
+        found = _scan(_SCANNERS['caching'], content)
+
         # Parse proxy_cache
-        proxy_cache_match = re.search(r'proxy_cache\s+([^;]+);', content)
-        if proxy_cache_match:
-            cache_config['proxy_cache'] = proxy_cache_match.group(1).strip()
+        if 'proxy_cache' in found:
+            cache_config['proxy_cache'] = found['proxy_cache'][0]
 
         # Parse proxy_cache_path
-        proxy_cache_path_match = re.search(r'proxy_cache_path\s+([^\s]+)(?:\s+levels=([^\s]+))?(?:\s+keys_zone=([^:]+):([^\s]+))?(?:\s+max_size=([^\s]+))?(?:\s+inactive=([^\s;]+))?', content)
+        proxy_cache_path_match = _PATTERNS['proxy_cache_path'].search(content)
         if proxy_cache_path_match:
             cache_config['proxy_cache_path'] = {
                 'path': proxy_cache_path_match.group(1),
@@ -594,22 +2351,19 @@ class NGINX:
             }
 
         # Parse proxy_cache_valid
-        proxy_cache_valid_matches = re.findall(r'proxy_cache_valid\s+([^;]+);', content)
-        if proxy_cache_valid_matches:
-            cache_config['proxy_cache_valid'] = [m.strip() for m in proxy_cache_valid_matches]
+        if 'proxy_cache_valid' in found:
+            cache_config['proxy_cache_valid'] = found['proxy_cache_valid']
 
         # Parse proxy_cache_key
-        proxy_cache_key_match = re.search(r'proxy_cache_key\s+([^;]+);', content)
-        if proxy_cache_key_match:
-            cache_config['proxy_cache_key'] = proxy_cache_key_match.group(1).strip()
+        if 'proxy_cache_key' in found:
+            cache_config['proxy_cache_key'] = found['proxy_cache_key'][0]
 
         # Parse fastcgi_cache
-        fastcgi_cache_match = re.search(r'fastcgi_cache\s+([^;]+);', content)
-        if fastcgi_cache_match:
-            cache_config['fastcgi_cache'] = fastcgi_cache_match.group(1).strip()
+        if 'fastcgi_cache' in found:
+            cache_config['fastcgi_cache'] = found['fastcgi_cache'][0]
 
         # Parse fastcgi_cache_path
-        fastcgi_cache_path_match = re.search(r'fastcgi_cache_path\s+([^\s]+)(?:\s+levels=([^\s]+))?(?:\s+keys_zone=([^:]+):([^\s]+))?', content)
+        fastcgi_cache_path_match = _PATTERNS['fastcgi_cache_path'].search(content)
         if fastcgi_cache_path_match:
             cache_config['fastcgi_cache_path'] = {
                 'path': fastcgi_cache_path_match.group(1),
@@ -619,149 +2373,100 @@ class NGINX:
             }
 
         # Parse cache bypass rules
-        proxy_cache_bypass_matches = re.findall(r'proxy_cache_bypass\s+([^;]+);', content)
-        if proxy_cache_bypass_matches:
-            cache_config['proxy_cache_bypass'] = [m.strip() for m in proxy_cache_bypass_matches]
+        if 'proxy_cache_bypass' in found:
+            cache_config['proxy_cache_bypass'] = found['proxy_cache_bypass']
 
-        proxy_no_cache_matches = re.findall(r'proxy_no_cache\s+([^;]+);', content)
-        if proxy_no_cache_matches:
-            cache_config['proxy_no_cache'] = [m.strip() for m in proxy_no_cache_matches]
+        if 'proxy_no_cache' in found:
+            cache_config['proxy_no_cache'] = found['proxy_no_cache']
 
         return {'caching': cache_config} if cache_config else {}
 
     # TASK #8-10: Parse proxy configuration
+    @_instrumented
     def parse_proxy_config(self, content):
         """解析代理配置"""
         proxy_config = {}
 
+        found = _scan(_SCANNERS['proxy'], content)
+
         # Parse proxy_set_header
-        proxy_headers_matches = re.findall(r'proxy_set_header\s+([^\s]+)\s+([^;]+);', content)
-        if proxy_headers_matches:
+        if 'proxy_set_header' in found:
             proxy_config['proxy_headers'] = {}
-            for match in proxy_headers_matches:
-                proxy_config['proxy_headers'][match[0]] = match[1].strip()
+            for value in found['proxy_set_header']:
+                header = value.split(None, 1)
+                if len(header) == 2:
+                    proxy_config['proxy_headers'][header[0]] = header[1].strip()
 
         # Parse proxy timeouts
-        proxy_connect_timeout_match = re.search(r'proxy_connect_timeout\s+([^;]+);', content)
-        if proxy_connect_timeout_match:
-            if 'proxy_timeouts' not in proxy_config:
-                proxy_config['proxy_timeouts'] = {}
-            proxy_config['proxy_timeouts']['connect'] = proxy_connect_timeout_match.group(1).strip()
-
-        proxy_read_timeout_match = re.search(r'proxy_read_timeout\s+([^;]+);', content)
-        if proxy_read_timeout_match:
-            if 'proxy_timeouts' not in proxy_config:
-                proxy_config['proxy_timeouts'] = {}
-            proxy_config['proxy_timeouts']['read'] = proxy_read_timeout_match.group(1).strip()
-
-        proxy_send_timeout_match = re.search(r'proxy_send_timeout\s+([^;]+);', content)
-        if proxy_send_timeout_match:
-            if 'proxy_timeouts' not in proxy_config:
-                proxy_config['proxy_timeouts'] = {}
-            proxy_config['proxy_timeouts']['send'] = proxy_send_timeout_match.group(1).strip()
+        timeouts = [('connect', 'proxy_connect_timeout'), ('read', 'proxy_read_timeout'), ('send', 'proxy_send_timeout')]
+        for key, name in timeouts:
+            if name in found:
+                proxy_config.setdefault('proxy_timeouts', {})[key] = found[name][0]
 
         # Parse proxy buffering
-        proxy_buffering_match = re.search(r'proxy_buffering\s+([^;]+);', content)
-        if proxy_buffering_match:
-            if 'proxy_buffering' not in proxy_config:
-                proxy_config['proxy_buffering'] = {}
-            proxy_config['proxy_buffering']['enabled'] = proxy_buffering_match.group(1).strip()
-
-        proxy_buffer_size_match = re.search(r'proxy_buffer_size\s+([^;]+);', content)
-        if proxy_buffer_size_match:
-            if 'proxy_buffering' not in proxy_config:
-                proxy_config['proxy_buffering'] = {}
-            proxy_config['proxy_buffering']['buffer_size'] = proxy_buffer_size_match.group(1).strip()
-
-        proxy_buffers_match = re.search(r'proxy_buffers\s+([^;]+);', content)
-        if proxy_buffers_match:
-            if 'proxy_buffering' not in proxy_config:
-                proxy_config['proxy_buffering'] = {}
-            proxy_config['proxy_buffering']['buffers'] = proxy_buffers_match.group(1).strip()
-
-        proxy_busy_buffers_size_match = re.search(r'proxy_busy_buffers_size\s+([^;]+);', content)
-        if proxy_busy_buffers_size_match:
-            if 'proxy_buffering' not in proxy_config:
-                proxy_config['proxy_buffering'] = {}
-            proxy_config['proxy_buffering']['busy_buffers_size'] = proxy_busy_buffers_size_match.group(1).strip()
+        buffering = [('enabled', 'proxy_buffering'), ('buffer_size', 'proxy_buffer_size'),
+                     ('buffers', 'proxy_buffers'), ('busy_buffers_size', 'proxy_busy_buffers_size')]
+        for key, name in buffering:
+            if name in found:
+                proxy_config.setdefault('proxy_buffering', {})[key] = found[name][0]
 
         return {'proxy': proxy_config} if proxy_config else {}
 
     # TASK #11-14: Parse client and performance configuration
+    @_instrumented
     def parse_client_config(self, content):
         """解析客户端配置"""
         client_config = {}
 
+        found = _scan(_SCANNERS['client'], content)
+
         # Parse client_max_body_size
-        client_max_body_size_match = re.search(r'client_max_body_size\s+([^;]+);', content)
-        if client_max_body_size_match:
-            client_config['client_max_body_size'] = client_max_body_size_match.group(1).strip()
+        if 'client_max_body_size' in found:
+            client_config['client_max_body_size'] = found['client_max_body_size'][0]
 
         # Parse timeouts
         timeouts = {}
-        client_body_timeout_match = re.search(r'client_body_timeout\s+([^;]+);', content)
-        if client_body_timeout_match:
-            timeouts['client_body'] = client_body_timeout_match.group(1).strip()
-
-        client_header_timeout_match = re.search(r'client_header_timeout\s+([^;]+);', content)
-        if client_header_timeout_match:
-            timeouts['client_header'] = client_header_timeout_match.group(1).strip()
-
-        send_timeout_match = re.search(r'send_timeout\s+([^;]+);', content)
-        if send_timeout_match:
-            timeouts['send'] = send_timeout_match.group(1).strip()
+        for key, name in [('client_body', 'client_body_timeout'), ('client_header', 'client_header_timeout'), ('send', 'send_timeout')]:
+            if name in found:
+                timeouts[key] = found[name][0]
 
         if timeouts:
             client_config['timeouts'] = timeouts
 
         # Parse buffers
         buffers = {}
-        client_body_buffer_size_match = re.search(r'client_body_buffer_size\s+([^;]+);', content)
-        if client_body_buffer_size_match:
-            buffers['client_body'] = client_body_buffer_size_match.group(1).strip()
-
-        client_header_buffer_size_match = re.search(r'client_header_buffer_size\s+([^;]+);', content)
-        if client_header_buffer_size_match:
-            buffers['client_header'] = client_header_buffer_size_match.group(1).strip()
-
-        large_client_header_buffers_match = re.search(r'large_client_header_buffers\s+([^;]+);', content)
-        if large_client_header_buffers_match:
-            buffers['large_client_header'] = large_client_header_buffers_match.group(1).strip()
+        for key, name in [('client_body', 'client_body_buffer_size'), ('client_header', 'client_header_buffer_size'),
+                          ('large_client_header', 'large_client_header_buffers')]:
+            if name in found:
+                buffers[key] = found[name][0]
 
         if buffers:
             client_config['buffers'] = buffers
 
         # Parse open_file_cache
-        open_file_cache_match = re.search(r'open_file_cache\s+max=(\d+)(?:\s+inactive=([^\s;]+))?', content)
+        open_file_cache_match = _PATTERNS['open_file_cache'].search(content)
         if open_file_cache_match:
             file_cache = {
                 'max': open_file_cache_match.group(1),
                 'inactive': open_file_cache_match.group(2) if open_file_cache_match.group(2) else None
             }
 
-            open_file_cache_valid_match = re.search(r'open_file_cache_valid\s+([^;]+);', content)
-            if open_file_cache_valid_match:
-                file_cache['valid'] = open_file_cache_valid_match.group(1).strip()
-
-            open_file_cache_min_uses_match = re.search(r'open_file_cache_min_uses\s+([^;]+);', content)
-            if open_file_cache_min_uses_match:
-                file_cache['min_uses'] = open_file_cache_min_uses_match.group(1).strip()
-
-            open_file_cache_errors_match = re.search(r'open_file_cache_errors\s+([^;]+);', content)
-            if open_file_cache_errors_match:
-                file_cache['errors'] = open_file_cache_errors_match.group(1).strip()
+            for key in ('valid', 'min_uses', 'errors'):
+                if 'open_file_cache_' + key in found:
+                    file_cache[key] = found['open_file_cache_' + key][0]
 
             client_config['file_cache'] = file_cache
 
         return {'client_config': client_config} if client_config else {}
 
     # TASK #15-16: Parse logging configuration
+    @_instrumented
     def parse_logging_config(self, content):
         """解析日志配置"""
         logging_config = {}
 
         # Parse log_format
-        log_format_matches = re.findall(r'log_format\s+([^\s]+)\s+([^;]+);', content, re.DOTALL)
+        log_format_matches = _PATTERNS['log_format'].findall(content)
         if log_format_matches:
             logging_config['log_formats'] = {}
             for match in log_format_matches:
@@ -770,7 +2475,7 @@ class NGINX:
                 logging_config['log_formats'][format_name] = format_string
 
         # Parse conditional logging (access_log with if)
-        access_log_if_matches = re.findall(r'access_log\s+([^\s]+)(?:\s+([^\s]+))?(?:\s+if=([^\s;]+))?', content)
+        access_log_if_matches = _PATTERNS['access_log_if'].findall(content)
         if access_log_if_matches:
             logging_config['access_logs'] = []
             for match in access_log_if_matches:
@@ -784,13 +2489,13 @@ class NGINX:
         return {'logging': logging_config} if logging_config else {}
 
     # TASK #17-19: Parse map, geo, and split_clients blocks
+    @_instrumented
     def parse_advanced_blocks(self, content):
         """解析高级配置块"""
         advanced_config = {}
 
         # Parse map blocks
-        map_pattern = r'map\s+(\$[^\s]+)\s+(\$[^\s]+)\s*\{([^}]*)\}'
-        map_matches = re.findall(map_pattern, content, re.DOTALL)
+        map_matches = _PATTERNS['map'].findall(content)
         if map_matches:
             advanced_config['maps'] = []
             for match in map_matches:
@@ -802,11 +2507,11 @@ class NGINX:
 
                 # Parse mappings inside the map block
                 map_content = match[2]
-                default_match = re.search(r'default\s+([^;]+);', map_content)
+                default_match = _PATTERNS['default'].search(map_content)
                 if default_match:
                     map_data['default'] = default_match.group(1).strip()
 
-                mapping_matches = re.findall(r'([^\s;]+)\s+([^;]+);', map_content)
+                mapping_matches = _PATTERNS['table_entry'].findall(map_content)
                 for mapping in mapping_matches:
                     if mapping[0] != 'default':
                         map_data['mappings'][mapping[0].strip()] = mapping[1].strip()
@@ -814,8 +2519,7 @@ class NGINX:
                 advanced_config['maps'].append(map_data)
 
         # Parse geo blocks
-        geo_pattern = r'geo\s+(\$[^\s]+)\s*\{([^}]*)\}'
-        geo_matches = re.findall(geo_pattern, content, re.DOTALL)
+        geo_matches = _PATTERNS['geo'].findall(content)
         if geo_matches:
             advanced_config['geo_blocks'] = []
             for match in geo_matches:
@@ -825,11 +2529,11 @@ class NGINX:
                 }
 
                 geo_content = match[1]
-                default_match = re.search(r'default\s+([^;]+);', geo_content)
+                default_match = _PATTERNS['default'].search(geo_content)
                 if default_match:
                     geo_data['default'] = default_match.group(1).strip()
 
-                rule_matches = re.findall(r'([^\s;]+)\s+([^;]+);', geo_content)
+                rule_matches = _PATTERNS['table_entry'].findall(geo_content)
                 for rule in rule_matches:
                     if rule[0] != 'default':
                         geo_data['rules'][rule[0].strip()] = rule[1].strip()
@@ -837,8 +2541,7 @@ class NGINX:
                 advanced_config['geo_blocks'].append(geo_data)
 
         # Parse split_clients blocks
-        split_clients_pattern = r'split_clients\s+"([^"]+)"\s+(\$[^\s]+)\s*\{([^}]*)\}'
-        split_clients_matches = re.findall(split_clients_pattern, content, re.DOTALL)
+        split_clients_matches = _PATTERNS['split_clients'].findall(content)
         if split_clients_matches:
             advanced_config['split_clients'] = []
             for match in split_clients_matches:
@@ -849,7 +2552,7 @@ class NGINX:
                 }
 
                 split_content = match[2]
-                split_matches = re.findall(r'([^\s]+)\s+([^;]+);', split_content)
+                split_matches = _PATTERNS['split_entry'].findall(split_content)
                 for split in split_matches:
                     split_data['splits'][split[0].strip()] = split[1].strip()
 
@@ -857,73 +2560,191 @@ class NGINX:
 
         return advanced_config
 
+    @_instrumented
     def get_all_config(self):
-        """获取完整的配置数据 - 包括所有解析功能 (ALL 36 TASKS)"""
-        with open(self.all_conf, 'r') as fp:
-            alllines = fp.read()
+        """获取完整的配置数据 - 包括所有解析功能 (ALL 36 TASKS)
+
+        结果保存在实例上，只有refresh()发现配置变化时才重新计算。
+        """
+        if self._cached_config is not None:
+            return self._cached_config
 
+        # 先解析server，其余部分直接使用解析server时构建的配置树，不再单独扫描outline
+        servers = _to_plain(self.servers)
         config = {
             'global': self.global_config,
             'events': self.events_config,
             'http': self.http_config,
-            'upstreams': self.backend,
-            'servers': self.servers
+            'upstreams': _to_plain(self.backend),
+            'servers': servers
         }
 
+        config.update(self.parse_modules())
+
+        # TASK #20-24: Validation
+        config['validation'] = self.validation()
+
+        # Note: ACL and auth are now parsed directly in parse_server_block()
+        self.save_cache(config)
+        self._cached_config = config
+        return config
+
+    @_instrumented
+    def parse_modules(self):
+        """解析整份配置中模块级的设置 (rate_limiting、caching、proxy等)，返回合并后的dict
+
+        遍历一遍配置树，只把相关指令和块的原文交给各parse_*方法，不在整份配置上逐个执行正则。
+        引号和注释中的文字、其他指令的参数不会被当作指令。
+        """
+        pieces = {}  # 模块 -> 该模块的指令或块的原文
+        for node in self.walk_nodes(skip=_MODULE_BLOCKS):
+            if node.name in _MODULE_BLOCKS:
+                module = 'advanced_blocks'
+            elif node.block is None:
+                module = _MODULE_DIRECTIVES.get(node.name)
+            elif node.name == 'stream':
+                module = 'stream'
+            elif node.name == 'location' and any(child.name.startswith('grpc_') for child in node.block):
+                module = 'grpc'
+            else:
+                module = None
+            if module is not None:
+                pieces.setdefault(module, []).append(_decode(self.content[node.start:node.end]))
+
+        def text(module):
+            return '\n'.join(pieces.get(module, ()))
+
+        modules = {}
+
         # TASK #2: Rate limiting
-        rate_limiting = self.parse_rate_limiting(alllines)
+        rate_limiting = self.parse_rate_limiting(text('rate_limiting'))
         if rate_limiting:
-            config.update(rate_limiting)
+            modules.update(rate_limiting)
 
         # TASK #17-19: Advanced blocks
-        advanced_blocks = self.parse_advanced_blocks(alllines)
+        advanced_blocks = self.parse_advanced_blocks(text('advanced_blocks'))
         if advanced_blocks:
-            config.update(advanced_blocks)
+            modules.update(advanced_blocks)
 
         # TASK #5-7: Caching
-        caching = self.parse_caching(alllines)
+        caching = self.parse_caching(text('caching'))
         if caching:
-            config.update(caching)
+            modules.update(caching)
 
         # TASK #8-10: Proxy config
-        proxy = self.parse_proxy_config(alllines)
+        proxy = self.parse_proxy_config(text('proxy'))
         if proxy:
-            config.update(proxy)
+            modules.update(proxy)
 
         # TASK #11-14: Client config
-        client = self.parse_client_config(alllines)
+        client = self.parse_client_config(text('client'))
         if client:
-            config.update(client)
+            modules.update(client)
 
         # TASK #15-16: Logging
-        logging = self.parse_logging_config(alllines)
+        logging = self.parse_logging_config(text('logging'))
         if logging:
-            config.update(logging)
+            modules.update(logging)
 
         # TASK #31: HTTP/2 module
-        http2 = self.parse_http2_module(alllines)
+        http2 = self.parse_http2_module(text('http2'))
         if http2:
-            config.update(http2)
+            modules.update(http2)
 
         # TASK #32: Stream module
-        stream = self.parse_stream_module(alllines)
+        stream = self.parse_stream_module(text('stream'))
         if stream:
-            config.update(stream)
+            modules.update(stream)
 
         # TASK #33: gRPC module
-        grpc = self.parse_grpc_module(alllines)
+        grpc = self.parse_grpc_module(text('grpc'))
         if grpc:
-            config.update(grpc)
+            modules.update(grpc)
 
-        # TASK #20-24: Validation
-        config['validation'] = {
+        return modules
+
+    def validation(self):
+        """返回语法检查、缺失指令和冲突检测的结果
+
+        结果中的server序号都是server块在配置中的序号 (见iter_indexed_servers)。
+        """
+        return {
             'syntax': self.validate_syntax(),
             'missing_directives': self.detect_missing_directives(),
             'conflicts': self.detect_conflicts()
         }
 
-        # Note: ACL and auth are now parsed directly in parse_server_block()
-        return config
+    def iter_records(self):
+        """逐条生成配置记录 {'type': ..., 'data': ...}，用于NDJSON等流式输出
+
+        依次为global、events、http、每个upstream、每个server (不含backend) 及其每个location、
+        模块级设置，最后是validation。server尚未解析时边解析边生成，不保存server块原文。
+        """
+        cached = self._cached_config
+        yield {'type': 'global', 'data': self.global_config}
+        yield {'type': 'events', 'data': self.events_config}
+        yield {'type': 'http', 'data': self.http_config}
+        for upstream in self.backend:
+            yield {'type': 'upstream', 'data': _to_plain(upstream)}
+
+        # server尚未解析时边解析边生成，只在需要写缓存时保留解析结果
+        streaming = cached is None and 'servers' not in self.__dict__
+        kept = [] if streaming and self.cache_dir else None
+        summaries, missing, insecure = [], [], []  # listen冲突只需要每个server块的listen和名字
+
+        def streamed():
+            for block, (node, server) in enumerate(self.iter_server_pairs()):
+                summaries.append(_server_summary(node))
+                if server is not None:
+                    yield block, server
+
+        # idx为server在servers中的序号，校验结果中使用server块的序号block
+        for idx, (block, server) in enumerate(streamed() if streaming else self.iter_indexed_servers()):
+            if kept is not None:
+                kept.append(server)
+            if streaming:
+                # 单个server的检查在生成时完成，不必之后再解析一遍
+                missing.extend(self.server_missing_directives(block, server))
+                insecure.extend(self.server_conflicts(block, server))
+            yield {'type': 'server', 'index': idx,
+                   'data': {key: _to_plain(value) for key, value in server.items() if key != 'backend'}}
+            for loc_idx, location in enumerate(server.get('backend', [])):
+                yield {'type': 'location', 'server': idx, 'index': loc_idx, 'data': _to_plain(location)}
+
+        if cached is not None:
+            modules = {key: value for key, value in cached.items()
+                       if key not in ('global', 'events', 'http', 'upstreams', 'servers', 'validation')}
+        else:
+            modules = self.parse_modules()
+        for key, value in modules.items():
+            yield {'type': key, 'data': value}
+
+        if cached is not None:
+            validation = cached['validation']
+        else:
+            if streaming:
+                self._results['detect_missing_directives'] = missing
+                self._results['detect_conflicts'] = self.listen_conflicts(summaries) + insecure
+            validation = self.validation()
+        yield {'type': 'validation', 'data': validation}
+
+        if cached is None and self.cache_dir:
+            # 写入与get_all_config相同的结果，之后的json和ndjson输出都可以直接使用
+            config = {
+                'global': self.global_config,
+                'events': self.events_config,
+                'http': self.http_config,
+                'upstreams': _to_plain(self.backend),
+                'servers': _to_plain(self.servers if kept is None else kept),
+            }
+            config.update(modules)
+            config['validation'] = validation
+            self.save_cache(config)
+            self._cached_config = config
+
+    def config_section(self, name, default=None):
+        """返回get_all_config中的某一部分，如config_section('caching')"""
+        return self.get_all_config().get(name, default)
 
     def find_server_block_content(self, server_name):
         """查找特定server块的内容"""
@@ -932,19 +2753,112 @@ class NGINX:
                 return block
         return None
 
+    def find_server(self, server_name):
+        """返回server_name中包含该名字的第一个server (不区分大小写)，找不到时返回None"""
+        servers = self.servers_by_name.get(server_name if server_name.startswith('~') else server_name.lower())
+        return servers[0] if servers else None
+
+    @_memoized
+    def server_entries(self):
+        """每个http server块一项，按配置顺序，包括解析时跳过的块
+
+        有名字的块为servers中对应的server；没有server_name或只有IP名字的块 (比如
+        `listen 80 default_server; return 444;` 这样的兜底server) 为只有listen、server_name和server_names的dict。
+        """
+        servers = iter(self.servers)
+        entries = []
+        for node in self.iter_server_nodes():
+            summary = _server_summary(node)
+            # 与parse_server的判断一致：有非IP的名字时才有对应的server
+            entries.append(next(servers) if summary['server_names'] else summary)
+        return entries
+
+    def iter_indexed_servers(self):
+        """逐个生成 (server块的序号, server)，跳过没有server_name或只有IP名字的块
+
+        校验结果 (缺失指令、冲突) 中的server序号都是server块在配置中的序号，没有名字的兜底server块
+        也占一个序号，因此与servers中的序号不一定相同。
+        """
+        servers = iter(self.servers)
+        for idx, node in enumerate(self.iter_server_nodes()):
+            # 与server_entries的判断一致
+            if _server_summary(node)['server_names']:
+                yield idx, next(servers)
+
+    @_memoized
+    def vhost_index(self):
+        """返回由所有server块 (见server_entries) 构建的VhostIndex，配置变化后重新构建"""
+        return VhostIndex(self.server_entries())
+
+    def resolve_vhost(self, host, port=80, address='*'):
+        """返回监听 address:port 时处理该Host的server，没有时返回None"""
+        return self.vhost_index().resolve(host, port, address)
+
+    def location_router(self, server_name):
+        """返回该server的LocationRouter，按server_name缓存，配置变化后重新构建"""
+        routers = self._results.setdefault('location_routers', {})
+        if server_name not in routers:
+            server = self.find_server(server_name)
+            if server is None:
+                routers[server_name] = None
+            elif isinstance(server, Server):
+                routers[server_name] = server.router()
+            else:
+                routers[server_name] = LocationRouter(server.get('backend', []))
+        return routers[server_name]
+
+    def match(self, server_name, uri):
+        """返回该server中处理URI的location (含proxy_pass和backend_ip)，没有匹配时返回None"""
+        router = self.location_router(server_name)
+        return None if router is None else router.match(uri)
+
+    def route_many(self, server_name, uris):
+        """批量路由，返回每个URI对应的location的序号 (见LocationRouter)，没有匹配的为None"""
+        router = self.location_router(server_name)
+        if router is None:
+            return [None for _ in uris]
+        return router.match_many(uris)
+
     # TASK #20-24: Validation and Error Handling
+    @_memoized
+    @_instrumented
     def validate_syntax(self):
         """验证nginx配置语法 (TASK #20)"""
         errors = []
         warnings = []
 
         try:
-            with open(self.all_conf, 'r') as fp:
-                content = fp.read()
+            # mmap模式下直接扫描bytes，不解码整份配置
+            content = self.content
+            text = isinstance(content, str)
+            nl, semicolon = ('\n', ';') if text else (b'\n', b';')
+
+            # 括号只统计词法上的{和}，引号、注释、转义、${name} 和正则量词中的不计入
+            braces = [m.lastindex for m in _PATTERNS['brace_token' if text else 'brace_token_bytes'].finditer(content)]
+            open_braces, close_braces = braces.count(2), braces.count(3)
+
+            # 配置树中没有以分号结束的简单指令是在}或文件末尾被截断的；
+            # 跨行的指令中，以普通单词 (而不是log_format那样的引号字符串) 开头的续行多半是上一行漏了分号
+            warnings_at = []  # 缺少分号的位置 (该行最后一个单词之后的偏移)
+            token_re = _PATTERNS['token' if text else 'token_bytes']
+            for node in self.walk_nodes():
+                end = node.end if node.block is None else node.value_end
+                if content.find(nl, node.start, end) >= 0:
+                    last_word = None  # (类型, 结束偏移)
+                    newline = False
+                    for m in token_re.finditer(content, node.start, end):
+                        kind = m.lastgroup
+                        if kind == 'space':
+                            newline = newline or nl in m.group()
+                        elif kind == 'word' or kind == 'quoted':
+                            if newline and kind == 'word' and last_word is not None and last_word[0] == 'word':
+                                warnings_at.append(last_word[1])
+                            last_word = (kind, m.end())
+                            newline = False
+                if node.block is None and content[node.end - 1:node.end] != semicolon:
+                    warnings_at.append(node.end)
 
             # Check for matching braces
-            open_braces = content.count('{')
-            close_braces = content.count('}')
             if open_braces != close_braces:
                 errors.append({
                     'type': 'syntax_error',
@@ -953,27 +2867,20 @@ class NGINX:
                 })
 
             # Check for semicolons on directives
-            lines = content.split('\n')
-            for line_num, line in enumerate(lines, 1):
-                stripped = line.strip()
-                # Skip comments and empty lines
-                if not stripped or stripped.startswith('#'):
-                    continue
-                # Skip lines with only braces
-                if stripped in ['{', '}']:
-                    continue
-                # Check if directive line is missing semicolon
-                if not stripped.endswith((';', '{', '}')):
-                    # Check if it's a block directive
-                    block_keywords = ['events', 'http', 'server', 'location', 'upstream', 'map', 'geo', 'split_clients', 'if']
-                    is_block = any(stripped.startswith(kw) for kw in block_keywords)
-                    if not is_block and len(stripped) > 0:
-                        warnings.append({
-                            'type': 'missing_semicolon',
-                            'line': line_num,
-                            'message': f'Possible missing semicolon: {stripped[:50]}',
-                            'severity': 'warning'
-                        })
+            for offset in sorted(warnings_at):
+                line_start = content.rfind(nl, 0, offset) + 1
+                line_end = content.find(nl, offset)
+                stripped = _decode(content[line_start:line_end if line_end >= 0 else len(content)]).strip()
+                # 行号为原配置文件中的行号
+                source = self.source_position(offset)
+                warnings.append({
+                    'type': 'missing_semicolon',
+                    'file': source[0],
+                    'line': source[1],
+                    'column': source[2],
+                    'message': f'Possible missing semicolon: {stripped[:50]}',
+                    'severity': 'warning'
+                })
 
             return {
                 'valid': len(errors) == 0,
@@ -988,86 +2895,97 @@ class NGINX:
                 'warnings': []
             }
 
+    @_memoized
+    @_instrumented
     def detect_missing_directives(self):
-        """检测缺失的必需指令 (TASK #21)"""
+        """检测缺失的必需指令 (TASK #21)，server序号为server块在配置中的序号"""
         issues = []
 
         # Check each server block
-        for idx, server in enumerate(self.servers):
-            # Check for missing server_name
-            if not server.get('server_name') or server['server_name'].strip() == '':
-                issues.append({
-                    'server': idx,
-                    'type': 'missing_directive',
-                    'directive': 'server_name',
-                    'message': f'Server block {idx} is missing server_name directive',
-                    'severity': 'warning'
-                })
+        for idx, server in self.iter_indexed_servers():
+            issues.extend(self.server_missing_directives(idx, server))
+
+        return issues
+
+    def server_missing_directives(self, idx, server):
+        """检测单个server缺失的指令，idx为server块在配置中的序号 (见iter_indexed_servers)"""
+        issues = []
 
-            # Check for missing listen directive
-            if not server.get('listen') or len(server.get('listen', [])) == 0:
+        # Check for missing server_name
+        if not server.get('server_name') or server['server_name'].strip() == '':
+            issues.append({
+                'server': idx,
+                'type': 'missing_directive',
+                'directive': 'server_name',
+                'message': f'Server block {idx} is missing server_name directive',
+                'severity': 'warning'
+            })
+
+        # Check for missing listen directive
+        if not server.get('listen') or len(server.get('listen', [])) == 0:
+            issues.append({
+                'server': idx,
+                'type': 'missing_directive',
+                'directive': 'listen',
+                'message': f'Server block {idx} is missing listen directive',
+                'severity': 'warning'
+            })
+
+        # Check locations for missing proxy_pass or root
+        # location的序号与LocationRouter相同 (iter_locations的先序)，只包含嵌套location的外层location不检查
+        for loc_idx, location in enumerate(iter_locations(server.get('backend', []))):
+            has_handler = any(k in location for k in ['proxy_pass', 'fastcgi_pass', 'root', 'return', 'rewrite', 'locations'])
+            if not has_handler:
                 issues.append({
                     'server': idx,
-                    'type': 'missing_directive',
-                    'directive': 'listen',
-                    'message': f'Server block {idx} is missing listen directive',
+                    'location': loc_idx,
+                    'path': location.get('path', 'unknown'),
+                    'type': 'missing_handler',
+                    'message': f'Location "{location.get("path")}" has no handler (proxy_pass, root, etc.)',
                     'severity': 'warning'
                 })
 
-            # Check locations for missing proxy_pass or root
-            for loc_idx, location in enumerate(server.get('backend', [])):
-                has_handler = any(k in location for k in ['proxy_pass', 'fastcgi_pass', 'root', 'return', 'rewrite'])
-                if not has_handler:
-                    issues.append({
-                        'server': idx,
-                        'location': loc_idx,
-                        'path': location.get('path', 'unknown'),
-                        'type': 'missing_handler',
-                        'message': f'Location "{location.get("path")}" has no handler (proxy_pass, root, etc.)',
-                        'severity': 'warning'
-                    })
-
         return issues
 
+    @_memoized
+    @_instrumented
     def detect_conflicts(self):
-        """检测配置冲突 (TASK #22)"""
+        """检测配置冲突 (TASK #22)，server序号为server块在配置中的序号"""
         conflicts = []
 
-        # Check for duplicate server_name + listen combinations
-        server_map = {}
-        for idx, server in enumerate(self.servers):
-            server_name = server.get('server_name', '')
-            listen_ports = server.get('listen', [])
-
-            for port in listen_ports:
-                key = f"{server_name}:{port}"
-                if key in server_map:
-                    conflicts.append({
-                        'type': 'duplicate_server',
-                        'server_name': server_name,
-                        'listen': port,
-                        'servers': [server_map[key], idx],
-                        'message': f'Duplicate server_name "{server_name}" on port {port}',
-                        'severity': 'error'
-                    })
-                else:
-                    server_map[key] = idx
+        # Check for duplicate server_name / default_server / listen on normalized sockets
+        conflicts.extend(self.listen_conflicts())
 
         # Check for conflicting SSL protocols
-        for idx, server in enumerate(self.servers):
-            ssl_protocols = server.get('ssl_protocols', '')
-            if ssl_protocols:
-                # Check for insecure protocols
-                if 'SSLv2' in ssl_protocols or 'SSLv3' in ssl_protocols or 'TLSv1 ' in ssl_protocols:
-                    conflicts.append({
-                        'type': 'insecure_protocol',
-                        'server': idx,
-                        'server_name': server.get('server_name'),
-                        'protocols': ssl_protocols,
-                        'message': f'Server uses insecure SSL/TLS protocols: {ssl_protocols}',
-                        'severity': 'warning'
-                    })
+        for idx, server in self.iter_indexed_servers():
+            conflicts.extend(self.server_conflicts(idx, server))
+
+        return conflicts
+
+    def listen_conflicts(self, summaries=None):
+        """所有server块 (包括没有server_name或只有IP名字的) 在监听socket上的冲突，序号为server块在配置中的序号
 
+        只需要每个server块的_server_summary，不解析server；summaries为None时从配置树中生成。
+        """
+        if summaries is None:
+            summaries = [_server_summary(node) for node in self.iter_server_nodes()]
+        return detect_listen_conflicts(summaries)
+
+    def server_conflicts(self, idx, server):
+        """单个server自身的冲突 (不安全的SSL/TLS协议)，idx为server块在配置中的序号 (见iter_indexed_servers)"""
+        conflicts = []
+        ssl_protocols = server.get('ssl_protocols', '')
+        if ssl_protocols:
+            # Check for insecure protocols
+            if 'SSLv2' in ssl_protocols or 'SSLv3' in ssl_protocols or 'TLSv1 ' in ssl_protocols:
+                conflicts.append({
+                    'type': 'insecure_protocol',
+                    'server': idx,
+                    'server_name': server.get('server_name'),
+                    'protocols': ssl_protocols,
+                    'message': f'Server uses insecure SSL/TLS protocols: {ssl_protocols}',
+                    'severity': 'warning'
+                })
         return conflicts
 
     def get_detailed_errors(self, error_type='all'):
@@ -1141,105 +3059,84 @@ class NGINX:
             }
 
     # TASK #31-33: Module Support
+    @_instrumented
     def parse_http2_module(self, content):
         """解析HTTP/2模块配置 (TASK #31)"""
         http2_config = {}
 
-        # Parse http2 directive
-        http2_match = re.search(r'http2\s+(on|off);', content)
-        if http2_match:
-            http2_config['http2'] = http2_match.group(1)
-
-        # Parse http2_push
-        http2_push_matches = re.findall(r'http2_push\s+([^;]+);', content)
-        if http2_push_matches:
-            http2_config['http2_push'] = [m.strip() for m in http2_push_matches]
-
-        # Parse http2_push_preload
-        http2_push_preload_match = re.search(r'http2_push_preload\s+(on|off);', content)
-        if http2_push_preload_match:
-            http2_config['http2_push_preload'] = http2_push_preload_match.group(1)
-
-        # Parse http2_max_field_size
-        http2_max_field_match = re.search(r'http2_max_field_size\s+([^;]+);', content)
-        if http2_max_field_match:
-            http2_config['http2_max_field_size'] = http2_max_field_match.group(1).strip()
+        found = _scan(_SCANNERS['http2'], content)
 
-        # Parse http2_max_header_size
-        http2_max_header_match = re.search(r'http2_max_header_size\s+([^;]+);', content)
-        if http2_max_header_match:
-            http2_config['http2_max_header_size'] = http2_max_header_match.group(1).strip()
+        # Parse http2 / http2_push / http2_push_preload / http2_max_*_size
+        for name in ('http2', 'http2_push', 'http2_push_preload', 'http2_max_field_size', 'http2_max_header_size'):
+            values = found.get(name)
+            if not values:
+                continue
+            if name == 'http2_push':
+                http2_config[name] = values
+            elif name in ('http2', 'http2_push_preload'):
+                flag = next((v for v in values if v in ('on', 'off')), None)
+                if flag:
+                    http2_config[name] = flag
+            else:
+                http2_config[name] = values[0]
 
         return {'http2': http2_config} if http2_config else {}
 
+    @_instrumented
     def parse_stream_module(self, content):
-        """解析Stream模块配置 (TASK #32)"""
-        stream_config = {'servers': []}
+        """解析Stream模块配置 (TASK #32)
 
-        # Parse stream block - improved pattern to handle nested braces
-        # First, find the stream block start
-        stream_start = content.find('stream {')
-        if stream_start == -1:
-            return {}
-
-        # Count braces to find the matching closing brace
-        brace_count = 0
-        stream_end = -1
-        for i in range(stream_start, len(content)):
-            if content[i] == '{':
-                brace_count += 1
-            elif content[i] == '}':
-                brace_count -= 1
-                if brace_count == 0:
-                    stream_end = i + 1
-                    break
-
-        if stream_end == -1:
-            return {}
-
-        stream_content = content[stream_start:stream_end]
+        content中的stream块按配置树解析，引号和注释中的括号不影响块的范围。
+        """
+        stream_config = {'servers': []}
+        stream_upstreams = []
+        # stream中的proxy_pass只引用stream中的upstream，与http的upstream是两个命名空间
+        pools = {}  # upstream名 -> 后端地址，同名时以第一个为准
 
-        if stream_content:
-            # Parse upstream blocks within stream
-            upstream_pattern = r'upstream\s+([^\s{]+)\s*\{([^}]*)\}'
-            upstreams = re.findall(upstream_pattern, stream_content, re.DOTALL)
+        streams = [node for node in parse_tree(content).walk() if node.name == 'stream' and node.block is not None]
 
-            stream_upstreams = []
-            for up_name, up_content in upstreams:
-                servers = re.findall(r'server\s+([^\s;]+)(?:\s+([^;]*))?;', up_content)
+        # Parse upstream blocks within stream (先于server解析，upstream可以定义在引用它的server之后)
+        for stream in streams:
+            for node in stream.walk():
+                if node.name != 'upstream' or node.block is None or not node.args:
+                    continue
                 server_list = []
-                for srv_addr, srv_params in servers:
-                    server_info = {'address': srv_addr.strip()}
-                    if srv_params:
-                        if 'weight' in srv_params:
-                            weight_match = re.search(r'weight=(\d+)', srv_params)
-                            if weight_match:
-                                server_info['weight'] = int(weight_match.group(1))
+                for srv in node.find_all('server'):
+                    args = srv.args
+                    if srv.block is not None or not args:
+                        continue
+                    server_info = {'address': args[0]}
+                    weight_match = _PATTERNS['weight'].search(' '.join(args[1:]))
+                    if weight_match:
+                        server_info['weight'] = int(weight_match.group(1))
                     server_list.append(server_info)
 
                 stream_upstreams.append({
-                    'name': up_name.strip(),
+                    'name': node.args[0],
                     'servers': server_list
                 })
+                pools.setdefault(node.args[0], ' '.join(srv['address'] for srv in server_list))
 
-            # Parse server blocks within stream
-            server_pattern = r'server\s*\{([^}]*)\}'
-            servers = re.findall(server_pattern, stream_content, re.DOTALL)
-
-            for server_content in servers:
+        # Parse server blocks within stream
+        for stream in streams:
+            for node in stream.walk():
+                if node.name != 'server' or node.block is None:
+                    continue
                 server_info = {}
 
-                listen_match = re.search(r'listen\s+([^;]+);', server_content)
-                if listen_match:
-                    server_info['listen'] = listen_match.group(1).strip()
+                listen = node.find('listen')
+                if listen is not None:
+                    server_info['listen'] = listen.value
 
-                proxy_pass_match = re.search(r'proxy_pass\s+([^;]+);', server_content)
-                if proxy_pass_match:
-                    server_info['proxy_pass'] = proxy_pass_match.group(1).strip()
+                proxy_pass = node.find('proxy_pass')
+                if proxy_pass is not None:
+                    server_info['proxy_pass'] = proxy_pass.value
+                    if proxy_pass.value in pools:
+                        server_info['backend_ip'] = pools[proxy_pass.value]
 
-                proxy_timeout_match = re.search(r'proxy_timeout\s+([^;]+);', server_content)
-                if proxy_timeout_match:
-                    server_info['proxy_timeout'] = proxy_timeout_match.group(1).strip()
+                proxy_timeout = node.find('proxy_timeout')
+                if proxy_timeout is not None:
+                    server_info['proxy_timeout'] = proxy_timeout.value
 
                 stream_config['servers'].append(server_info)
 
@@ -1248,52 +3145,95 @@ class NGINX:
 
         return {'stream': stream_config} if stream_config['servers'] or stream_config.get('upstreams') else {}
 
+    @_instrumented
     def parse_grpc_module(self, content):
         """解析gRPC模块配置 (TASK #33)"""
         grpc_locations = []
 
         # Find all locations with grpc directives
-        location_pattern = r'location\s+([^\{]+)\{([^\}]*grpc[^\}]*)\}'
-        location_matches = re.findall(location_pattern, content, re.DOTALL)
+        location_matches = _PATTERNS['grpc_location'].findall(content)
 
         for path, loc_content in location_matches:
             grpc_config = {'path': path.strip()}
 
+            found = _scan(_SCANNERS['grpc'], loc_content)
+
             # Parse grpc_pass
-            grpc_pass_match = re.search(r'grpc_pass\s+([^;]+);', loc_content)
-            if grpc_pass_match:
-                grpc_config['grpc_pass'] = grpc_pass_match.group(1).strip()
+            if 'grpc_pass' in found:
+                grpc_config['grpc_pass'] = found['grpc_pass'][0]
+                backend = self.upstreams_by_name.get(_PATTERNS['grpc_scheme'].sub('', grpc_config['grpc_pass']))
+                if backend is not None:
+                    grpc_config['backend_ip'] = backend['ip']
 
             # Parse grpc_set_header
-            grpc_headers = re.findall(r'grpc_set_header\s+([^\s]+)\s+([^;]+);', loc_content)
+            grpc_headers = [value.split(None, 1) for value in found.get('grpc_set_header', ())]
+            grpc_headers = [h for h in grpc_headers if len(h) == 2]
             if grpc_headers:
                 grpc_config['grpc_headers'] = {h[0]: h[1].strip() for h in grpc_headers}
 
-            # Parse grpc timeouts
-            grpc_connect_timeout = re.search(r'grpc_connect_timeout\s+([^;]+);', loc_content)
-            if grpc_connect_timeout:
-                grpc_config['grpc_connect_timeout'] = grpc_connect_timeout.group(1).strip()
+            # Parse grpc timeouts and SSL
+            for name in ('grpc_connect_timeout', 'grpc_read_timeout', 'grpc_send_timeout',
+                         'grpc_ssl_certificate', 'grpc_ssl_certificate_key'):
+                if name in found:
+                    grpc_config[name] = found[name][0]
+
+            grpc_locations.append(grpc_config)
+
+        return {'grpc_locations': grpc_locations} if grpc_locations else {}
 
-            grpc_read_timeout = re.search(r'grpc_read_timeout\s+([^;]+);', loc_content)
-            if grpc_read_timeout:
-                grpc_config['grpc_read_timeout'] = grpc_read_timeout.group(1).strip()
 
-            grpc_send_timeout = re.search(r'grpc_send_timeout\s+([^;]+);', loc_content)
-            if grpc_send_timeout:
-                grpc_config['grpc_send_timeout'] = grpc_send_timeout.group(1).strip()
+def _parse_server_chunk(blocks, pools, compact):
+    """进程池中执行：重新构建每个server块的配置树并解析"""
+    parser = NGINX.__new__(NGINX)
+    parser.upstreams_by_name = pools
+    parser.compact = compact
+    servers = []
+    for text in blocks:
+        servers.append(parser.parse_server(parse_tree(text).find('server')))
+    return servers
 
-            # Parse grpc SSL
-            grpc_ssl_cert = re.search(r'grpc_ssl_certificate\s+([^;]+);', loc_content)
-            if grpc_ssl_cert:
-                grpc_config['grpc_ssl_certificate'] = grpc_ssl_cert.group(1).strip()
 
-            grpc_ssl_cert_key = re.search(r'grpc_ssl_certificate_key\s+([^;]+);', loc_content)
-            if grpc_ssl_cert_key:
-                grpc_config['grpc_ssl_certificate_key'] = grpc_ssl_cert_key.group(1).strip()
+def _parse_file(path, cache_dir=None):
+    """解析一个配置文件，出错时返回错误信息而不是抛出异常"""
+    try:
+        return {'file': path, 'config': NGINX(path, cache_dir=cache_dir).get_all_config()}
+    except Exception as e:
+        return {'file': path, 'error': str(e)}
 
-            grpc_locations.append(grpc_config)
 
-        return {'grpc_locations': grpc_locations} if grpc_locations else {}
+def expand_conf_paths(patterns):
+    """展开文件路径和glob模式，保持顺序并去重"""
+    paths = {}
+    for pattern in patterns:
+        if _PATTERNS['glob_magic'].search(pattern):
+            paths.update(dict.fromkeys(sorted(glob.glob(pattern, recursive=True))))
+        else:
+            paths[pattern] = None
+    return list(paths)
+
+
+def iter_parse_many(paths, jobs=1, cache_dir=None, window=4):
+    """解析多个独立的配置文件，每个解析完成时生成 {'file', 'config'} 或 {'file', 'error'}
+
+    jobs大于1时使用进程池，结果按完成顺序生成；否则在当前进程中按顺序解析。
+    paths可以是任意可迭代对象，进程池中同时最多有jobs * window个任务，
+    结果生成后即释放，内存占用与文件数无关。
+    """
+    if jobs <= 1:
+        for path in paths:
+            yield _parse_file(path, cache_dir)
+        return
+    paths = iter(paths)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = set()
+        while True:
+            for path in islice(paths, jobs * window - len(pending)):
+                pending.add(executor.submit(_parse_file, path, cache_dir))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            while done:
+                yield done.pop().result()
 
 
 def main():
@@ -1312,14 +3252,30 @@ def main():
     # Parse command
     parse_parser = subparsers.add_parser('parse', help='Parse nginx configuration file')
     parse_parser.add_argument('config_file', help='Path to nginx configuration file')
-    parse_parser.add_argument('--output', '-o', choices=['json', 'yaml', 'toml', 'xml'],
-                             default='json', help='Output format (default: json)')
+    parse_parser.add_argument('--output', '-o', choices=['json', 'ndjson', 'yaml', 'toml', 'xml'],
+                             default='json', help='Output format (default: json; ndjson streams one record per line)')
     parse_parser.add_argument('--pretty', '-p', action='store_true',
                              help='Pretty print output')
+    parse_parser.add_argument('--cache-dir', help='Directory for cached parse results (disabled by default)')
+    parse_parser.add_argument('--profile', action='store_true',
+                             help='Print per-stage and per-block timing to stderr')
+    parse_parser.add_argument('--mmap', action='store_true',
+                             help='Read configuration files with mmap and scan them as undecoded bytes '
+                             '(the merged content is still copied once)')
+
+    # Parse-many command
+    many_parser = subparsers.add_parser('parse-many', help='Parse many nginx configurations, one JSON line per file')
+    many_parser.add_argument('config_files', nargs='+', help='Configuration files or glob patterns')
+    many_parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                             help='Number of worker processes (default: CPU count)')
+    many_parser.add_argument('--cache-dir', help='Directory for cached parse results (disabled by default)')
 
     # Validate command
     validate_parser = subparsers.add_parser('validate', help='Validate nginx configuration')
     validate_parser.add_argument('config_file', help='Path to nginx configuration file')
+    validate_parser.add_argument('--mmap', action='store_true',
+                                 help='Read configuration files with mmap and scan them as undecoded bytes '
+                                 '(the merged content is still copied once)')
 
     # Query command
     query_parser = subparsers.add_parser('query', help='Query specific directives')
@@ -1327,6 +3283,14 @@ def main():
     query_parser.add_argument('--directive', '-d', help='Directive to query')
     query_parser.add_argument('--server', '-s', help='Filter by server name')
     query_parser.add_argument('--location', '-l', help='Filter by location path')
+    query_parser.add_argument('--cache-dir', help='Directory for cached parse results (disabled by default)')
+    query_parser.add_argument('--output', '-o', choices=['json', 'ndjson'], default='json',
+                              help='Output format (default: json; ndjson prints one server per line)')
+    query_parser.add_argument('--profile', action='store_true',
+                              help='Print per-stage and per-block timing to stderr')
+    query_parser.add_argument('--mmap', action='store_true',
+                              help='Read configuration files with mmap and scan them as undecoded bytes '
+                              '(the merged content is still copied once)')
 
     args = parser.parse_args()
 
@@ -1334,9 +3298,21 @@ def main():
         parser.print_help()
         sys.exit(1)
 
+    def print_profile(nginx):
+        if getattr(args, 'profile', False):
+            print(format_profile(nginx.stats), file=sys.stderr)
+
     if args.command == 'parse':
         try:
-            nginx = NGINX(args.config_file)
+            nginx = NGINX(args.config_file, cache_dir=args.cache_dir, use_mmap=args.mmap, instrument=args.profile)
+
+            if args.output == 'ndjson':
+                # 逐条输出，不在内存中拼出完整的JSON文本
+                for record in nginx.iter_records():
+                    print(json.dumps(record, default=str))
+                print_profile(nginx)
+                sys.exit(0)
+
             config = nginx.get_all_config()
 
             if args.output == 'json':
@@ -1378,14 +3354,23 @@ def main():
                 tree.write(sys.stdout.buffer, encoding='utf-8', xml_declaration=True)
                 print()
 
+            print_profile(nginx)
             sys.exit(0)
         except Exception as e:
             print(f"Error parsing configuration: {e}", file=sys.stderr)
             sys.exit(1)
 
+    elif args.command == 'parse-many':
+        # 每个文件解析完成即输出一行JSON (NDJSON)
+        failed = False
+        for result in iter_parse_many(expand_conf_paths(args.config_files), jobs=args.jobs, cache_dir=args.cache_dir):
+            failed = failed or 'error' in result
+            print(json.dumps(result, default=str), flush=True)
+        sys.exit(1 if failed else 0)
+
     elif args.command == 'validate':
         try:
-            nginx = NGINX(args.config_file)
+            nginx = NGINX(args.config_file, use_mmap=args.mmap)
             print(f"✓ Configuration is valid: {args.config_file}")
             print(f"  - Servers: {len(nginx.servers)}")
             print(f"  - Upstreams: {len(nginx.backend)}")
@@ -1396,28 +3381,43 @@ def main():
 
     elif args.command == 'query':
         try:
-            nginx = NGINX(args.config_file)
-            config = nginx.get_all_config()
+            nginx = NGINX(args.config_file, cache_dir=args.cache_dir, use_mmap=args.mmap, instrument=args.profile)
+            if args.output == 'ndjson':
+                # 逐个解析、过滤并输出server，不生成完整的配置
+                servers = (_to_plain(server) for server in nginx.iter_servers())
+            else:
+                # get_all_config的结果缓存在实例上，过滤时不修改它
+                servers = nginx.config_section('servers', [])
 
             # Filter by server if specified
             if args.server:
-                config['servers'] = [s for s in config['servers'] if args.server in s.get('server_name', '')]
+                servers = (s for s in servers if args.server in s.get('server_name', ''))
 
             # Filter by location if specified
             if args.location:
-                for server in config['servers']:
-                    server['backend'] = [l for l in server.get('backend', []) if args.location in l.get('path', '')]
+                servers = (dict(server, backend=[l for l in server.get('backend', []) if args.location in l.get('path', '')])
+                           for server in servers)
 
             # Query specific directive
             if args.directive:
-                result = {}
-                for server in config['servers']:
-                    if args.directive in server:
-                        result[server['server_name']] = server[args.directive]
-                print(json.dumps(result, indent=2))
+                if args.output == 'ndjson':
+                    for server in servers:
+                        if args.directive in server:
+                            print(json.dumps({'server_name': server['server_name'], args.directive: server[args.directive]},
+                                             default=str))
+                else:
+                    result = {}
+                    for server in servers:
+                        if args.directive in server:
+                            result[server['server_name']] = server[args.directive]
+                    print(json.dumps(result, indent=2))
+            elif args.output == 'ndjson':
+                for server in servers:
+                    print(json.dumps(server, default=str))
             else:
-                print(json.dumps(config, indent=2, default=str))
+                print(json.dumps(dict(nginx.get_all_config(), servers=list(servers)), indent=2, default=str))
 
+            print_profile(nginx)
             sys.exit(0)
         except Exception as e:
             print(f"Error querying configuration: {e}", file=sys.stderr)
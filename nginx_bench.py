@@ -0,0 +1,381 @@
+# coding: utf-8
+"""
+nginxparser基准测试
+
+生成不同规模的合成配置 (server数 × location数 × upstream数 × include文件数 × if块数)，
+分阶段测量解析的耗时、内存分配峰值 (tracemalloc) 和峰值RSS的增长，并与提交在仓库中的
+JSON基线比较，超出容差即视为性能回退。每个场景在单独的子进程中运行，峰值RSS互不影响。
+另有几个只计时的小基准 (KERNELS)，用来比较两种实现，比如合并的指令扫描器和逐条search。
+
+耗时在基线中保存为同一进程中校准工作量 (_calibration) 耗时的倍数 (relative)，不保存绝对秒数，
+基线在不同速度的机器上同样适用。
+
+    python -m nginx_bench                    # 与基线比较，有回退时退出码为1
+    python -m nginx_bench --update-baseline  # 重新生成基线
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from nginx import NGINX, clear_file_cache
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+# 名字 -> (server数, 每个server的location数, upstream数, include文件数, 第一个location中的if块数)
+SCENARIOS = {
+    'small': (10, 5, 5, 1, 0),
+    'medium': (200, 10, 50, 10, 0),
+    'large': (2000, 10, 200, 50, 0),
+    'wide_locations': (50, 200, 20, 5, 0),
+    'long_if_chain': (1, 2, 1, 1, 5000),
+}
+
+# 按解析顺序的阶段：load为include合并和构建配置树，其余阶段对应首次访问时触发的parse_*方法
+STAGES = [
+    ('load', lambda path: NGINX(path)),
+    ('parse_global_block', lambda nginx: nginx.global_config),
+    ('parse_events_block', lambda nginx: nginx.events_config),
+    ('parse_http_block', lambda nginx: nginx.http_config),
+    ('parse_backend_ip', lambda nginx: nginx.backend),
+    ('parse_server_block', lambda nginx: nginx.servers),
+    ('parse_modules', lambda nginx: nginx.parse_modules()),
+    ('validation', lambda nginx: nginx.validation()),
+]
+
+
+def generate_config(directory, servers, locations, upstreams, includes, ifs=0):
+    """在directory中生成合成配置，server平均分布到includes个被include的文件中，返回主配置路径
+
+    ifs大于0时在每个server的第一个location中加入ifs个if块，用于测量location的括号匹配。
+    """
+    os.makedirs(os.path.join(directory, 'conf.d'), exist_ok=True)
+    main = [
+        'user nginx;',
+        'worker_processes auto;',
+        'events {',
+        '    worker_connections 4096;',
+        '}',
+        'http {',
+        '    sendfile on;',
+        '    keepalive_timeout 65;',
+        '    limit_req_zone $binary_remote_addr zone=one:10m rate=10r/s;',
+        '    proxy_cache_path /var/cache/nginx levels=1:2 keys_zone=cache:10m max_size=1g;',
+    ]
+    for i in range(upstreams):
+        main.append(f'    upstream backend_{i} {{')
+        main.append('        least_conn;')
+        for j in range(3):
+            main.append(f'        server 10.{i // 250}.{i % 250}.{j}:8080 weight={j + 1} max_fails=3 fail_timeout=30s;')
+        main.append('    }')
+    main.append('    include conf.d/*.conf;')
+    main.append('}')
+    main_path = os.path.join(directory, 'nginx.conf')
+    with open(main_path, 'w') as fp:
+        fp.write('\n'.join(main) + '\n')
+
+    for n in range(includes):
+        site = []
+        for i in range(n, servers, includes):
+            site.append('server {')
+            site.append(f'    listen {8000 + i % 1000};')
+            site.append(f'    server_name site{i}.example.com www.site{i}.example.com;')
+            site.append(f'    root /var/www/site{i};')
+            site.append(f'    access_log /var/log/nginx/site{i}.log;')
+            site.append('    add_header X-Frame-Options "DENY" always;')
+            for j in range(locations):
+                site.append(f'    location /api/v{j} {{')
+                if upstreams:
+                    site.append(f'        proxy_pass http://backend_{(i + j) % upstreams};')
+                site.append('        proxy_set_header Host $host;')
+                site.append('        proxy_read_timeout 60s;')
+                if j == 0:
+                    site.extend(f'        if ($arg_{k}) {{ set $v{k} "{{{k}}}"; }}' for k in range(ifs))
+                site.append('    }')
+            site.append('    location ~* \\.(jpg|png|css|js)$ {')
+            site.append('        expires 30d;')
+            site.append('    }')
+            site.append('}')
+        with open(os.path.join(directory, 'conf.d', f'site{n}.conf'), 'w') as fp:
+            fp.write('\n'.join(site) + '\n')
+    return main_path
+
+
+def _peak_rss_kb():
+    """返回进程的峰值RSS (KB)，不支持时返回None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS上ru_maxrss的单位是字节
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _run_stages(path, trace):
+    """按顺序执行所有阶段，返回 {阶段: (秒, 分配峰值字节数, 峰值RSS增长KB)}
+
+    trace为True时每个阶段单独启停tracemalloc，分配峰值只包含该阶段分配的内存
+    (tracemalloc.reset_peak需要python 3.9)。峰值RSS单调不减，只有进程中第一次运行的增长有意义。
+    """
+    clear_file_cache()
+    results = {}
+    nginx = path
+    for stage, run in STAGES:
+        if trace:
+            tracemalloc.start()
+        rss = _peak_rss_kb()
+        start = time.perf_counter()
+        try:
+            value = run(nginx)
+            elapsed = time.perf_counter() - start
+            allocated = tracemalloc.get_traced_memory()[1] if trace else None
+        finally:
+            if trace:
+                tracemalloc.stop()
+        grown = None if rss is None else _peak_rss_kb() - rss
+        results[stage] = (elapsed, allocated, grown)
+        if stage == 'load':
+            nginx = value
+    return results
+
+
+def _measure(name, repeat, directory):
+    """在子进程中执行：生成配置并测量各阶段，耗时取repeat次中的最小值
+
+    峰值RSS取自第一次运行，内存分配单独跑一遍 (tracemalloc会拖慢计时，它自身也占用内存)。
+    """
+    servers, locations, upstreams, includes, ifs = SCENARIOS[name]
+    path = generate_config(directory, servers, locations, upstreams, includes, ifs)
+    timings = [_run_stages(path, trace=False) for _ in range(repeat)]
+    peak_rss_kb = _peak_rss_kb()
+    allocations = _run_stages(path, trace=True)
+    calibration = calibrate(repeat)
+
+    stages = {}
+    for stage, _ in STAGES:
+        seconds = min(run[stage][0] for run in timings)
+        stages[stage] = {
+            'seconds': round(seconds, 6),
+            'relative': round(seconds / calibration, 6),
+            'alloc_bytes': allocations[stage][1],
+            'rss_kb': timings[0][stage][2],
+        }
+    return {
+        'shape': {'servers': servers, 'locations': locations, 'upstreams': upstreams, 'includes': includes, 'ifs': ifs},
+        'stages': stages,
+        'total_seconds': round(sum(stage['seconds'] for stage in stages.values()), 6),
+        'calibration_seconds': round(calibration, 6),
+        'peak_rss_kb': peak_rss_kb,
+    }
+
+
+def run_scenario(name, repeat=3, directory=None):
+    """在新的子进程中测量一个场景，返回 {shape, stages, total_seconds, calibration_seconds, peak_rss_kb}"""
+    own_dir = directory is None
+    directory = directory or tempfile.mkdtemp(prefix=f'nginx_bench_{name}_')
+    try:
+        # spawn出的进程不继承当前进程的内存，峰值RSS只反映这个场景
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            return executor.submit(_measure, name, max(1, repeat), directory).result()
+    finally:
+        if own_dir:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+# 校准用的文本：与配置无关的单词和分号
+_CALIBRATION_TEXT = ' '.join(f'key{i} value_{i % 97};' for i in range(50000))
+
+
+def _calibration():
+    """校准用的固定工作量 (正则扫描、字符串和dict操作)，不调用nginx.py，耗时只反映机器和解释器的速度"""
+    counts = {}
+    for name, value in re.findall(r'(\w+)\s+(\w+);', _CALIBRATION_TEXT):
+        key = value.upper()
+        counts[key] = counts.get(key, 0) + len(name)
+    return counts
+
+
+def calibrate(repeat=3):
+    """返回校准工作量的耗时 (repeat次中的最小值)，基线中的耗时都是它的倍数"""
+    timings = []
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        _calibration()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+# 小基准用的server块，包含client和proxy两类指令
+_SCANNER_NAMES = ['client_max_body_size', 'client_body_timeout', 'client_header_timeout', 'send_timeout',
+                  'client_body_buffer_size', 'client_header_buffer_size', 'large_client_header_buffers',
+                  'proxy_connect_timeout', 'proxy_read_timeout', 'proxy_send_timeout', 'proxy_buffering',
+                  'proxy_buffer_size', 'proxy_buffers', 'proxy_busy_buffers_size']
+_SCANNER_BLOCKS = [f"server {{ listen 80; server_name site{i}.com; client_max_body_size {i}m; "
+                   f"proxy_read_timeout {i}s; location / {{ proxy_pass http://backend_{i}; }} }}" for i in range(2000)]
+
+
+def _directive_search():
+    """原实现：每个指令一次re.search，模式串每次都要经过re模块的缓存查找"""
+    for block in _SCANNER_BLOCKS:
+        for name in _SCANNER_NAMES:
+            re.search(r'%s\s+([^;]+);' % name, block)
+
+
+def _directive_scanner():
+    """合并的指令扫描器：每个块只扫描两遍 (client + proxy)"""
+    parser = NGINX.__new__(NGINX)
+    for block in _SCANNER_BLOCKS:
+        parser.parse_client_config(block)
+        parser.parse_proxy_config(block)
+
+
+# 名字 -> (参照的小基准, 函数)：有参照时不应比参照慢
+KERNELS = {
+    'directive_search': (None, _directive_search),
+    'directive_scanner': ('directive_search', _directive_scanner),
+}
+
+
+def run_kernel(name, repeat=3):
+    """测量一个小基准，返回 {seconds, relative, calibration_seconds, reference}，耗时取repeat次中的最小值"""
+    reference, run = KERNELS[name]
+    timings = []
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    seconds, calibration = min(timings), calibrate(repeat)
+    return {'seconds': round(seconds, 6), 'relative': round(seconds / calibration, 6),
+            'calibration_seconds': round(calibration, 6), 'reference': reference}
+
+
+def baseline_view(results, kernels):
+    """写入基线的内容：去掉只在本机有意义的绝对秒数，耗时只保留relative"""
+    scenarios = {}
+    for name, result in results.items():
+        stages = {stage: {k: v for k, v in metrics.items() if k != 'seconds'}
+                  for stage, metrics in result['stages'].items()}
+        scenarios[name] = {'shape': result['shape'], 'stages': stages, 'peak_rss_kb': result['peak_rss_kb']}
+    kernels = {name: {'relative': kernel['relative'], 'reference': kernel['reference']}
+               for name, kernel in kernels.items()}
+    return {'python': sys.version.split()[0], 'scenarios': scenarios, 'kernels': kernels}
+
+
+def compare(results, baseline, tolerance=0.25, min_seconds=0.02, min_bytes=64 * 1024, min_rss_kb=4096, kernels=None):
+    """与基线比较，返回回退列表
+
+    各阶段的耗时 (relative，校准工作量耗时的倍数)、内存分配和RSS增长，以及场景的峰值RSS
+    (stage为'total')，超过基线的 (1 + tolerance) 倍且绝对差值超过对应的下限时视为回退，
+    下限用于忽略很小的值的抖动，耗时的下限min_seconds按本次的校准耗时换算为倍数。
+    kernels为run_kernel的结果 {名字: 结果}，耗时同样与基线比较 (stage为'kernel')，
+    另外比参照的小基准慢时报告metric为'vs_reference'的回退。
+    """
+    regressions = []
+
+    def check(name, stage, metric, old, new, floor):
+        if old is None or new is None:
+            return
+        if new > old * (1 + tolerance) and new - old > floor:
+            regressions.append({
+                'scenario': name,
+                'stage': stage,
+                'metric': metric,
+                'baseline': old,
+                'current': new,
+                'ratio': round(new / old, 2) if old else None,
+            })
+
+    for name, result in results.items():
+        expected = baseline.get('scenarios', {}).get(name)
+        if expected is None:
+            continue
+        for stage, measured in result['stages'].items():
+            base = expected['stages'].get(stage)
+            if base is None:
+                continue
+            for metric, floor in (('relative', min_seconds / result['calibration_seconds']),
+                                  ('alloc_bytes', min_bytes), ('rss_kb', min_rss_kb)):
+                check(name, stage, metric, base.get(metric), measured.get(metric), floor)
+        check(name, 'total', 'peak_rss_kb', expected.get('peak_rss_kb'), result.get('peak_rss_kb'), min_rss_kb)
+
+    kernels = kernels or {}
+    for name, result in kernels.items():
+        expected = baseline.get('kernels', {}).get(name, {})
+        check(name, 'kernel', 'relative', expected.get('relative'), result['relative'],
+              min_seconds / result['calibration_seconds'])
+        reference = kernels.get(result['reference'])
+        if reference is not None and result['seconds'] > reference['seconds']:
+            regressions.append({
+                'scenario': name,
+                'stage': 'kernel',
+                'metric': 'vs_reference',
+                'baseline': reference['seconds'],
+                'current': result['seconds'],
+                'ratio': round(result['seconds'] / reference['seconds'], 2) if reference['seconds'] else None,
+            })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='nginx_bench', description='nginxparser benchmark suite')
+    parser.add_argument('--scenario', '-s', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run (repeatable, default: all)')
+    parser.add_argument('--kernel', '-k', action='append', choices=sorted(KERNELS),
+                        help='Micro benchmark to run (repeatable, default: all)')
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='Timing runs per scenario (default: 3)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline JSON file')
+    parser.add_argument('--tolerance', '-t', type=float, default=0.25,
+                        help='Allowed relative slowdown before failing (default: 0.25)')
+    parser.add_argument('--update-baseline', action='store_true', help='Write the results as the new baseline')
+    args = parser.parse_args(argv)
+
+    selected = args.scenario or args.kernel
+    results = {}
+    for name in args.scenario or ([] if selected else sorted(SCENARIOS)):
+        results[name] = run_scenario(name, repeat=args.repeat)
+        print(f"{name}: {results[name]['total_seconds']:.4f}s", file=sys.stderr)
+
+    # 参照的小基准总是一起运行
+    names = set(args.kernel or ([] if selected else KERNELS))
+    names.update([KERNELS[name][0] for name in names if KERNELS[name][0]])
+    kernels = {}
+    for name in sorted(names):
+        kernels[name] = run_kernel(name, repeat=args.repeat)
+        print(f"{name}: {kernels[name]['seconds']:.4f}s", file=sys.stderr)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as fp:
+            json.dump(baseline_view(results, kernels), fp, indent=2, sort_keys=True)
+            fp.write('\n')
+        print(f'Baseline written to {args.baseline}', file=sys.stderr)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --update-baseline first', file=sys.stderr)
+        print(json.dumps({'scenarios': results, 'kernels': kernels}, indent=2))
+        return 1
+
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    regressions = compare(results, baseline, tolerance=args.tolerance, kernels=kernels)
+    print(json.dumps({'scenarios': results, 'kernels': kernels, 'regressions': regressions}, indent=2))
+    for regression in regressions:
+        print("REGRESSION {scenario}/{stage} {metric}: {baseline} -> {current}".format(**regression), file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,7 +11,7 @@ import os
 import tempfile
 import shutil
 import json
-from nginx import NGINX
+from nginx import NGINX, parse_listen, detect_listen_conflicts
 
 
 class TestAllTasks(unittest.TestCase):
@@ -387,6 +387,124 @@ class TestAllTasks(unittest.TestCase):
         # Should detect insecure protocols and duplicate server
         self.assertGreater(len(conflicts), 0)
 
+    def test_server_name_list_and_index(self):
+        """Test that server_name values are split and indexed name by name"""
+        config = """
+        server {
+            listen 80;
+            server_name a.com b.com;
+        }
+        server {
+            listen 80;
+            server_name b.com a.com 10.0.0.1;
+        }
+        server {
+            listen 80;
+            server_name 10.0.0.2;
+        }
+        """
+        path = self._create_config(config)
+        nginx = NGINX(path)
+
+        self.assertEqual(len(nginx.servers), 2)
+        self.assertEqual(nginx.servers[0]['server_names'], ['a.com', 'b.com'])
+        self.assertEqual(nginx.servers[1]['server_names'], ['b.com', 'a.com'])
+        self.assertEqual(nginx.servers[1]['server_name'], 'b.com a.com 10.0.0.1')
+        self.assertEqual(nginx.servers_by_name['a.com'], nginx.servers)
+        self.assertNotIn('10.0.0.1', nginx.servers_by_name)
+        self.assertIs(nginx.find_server('b.com'), nginx.servers[0])
+
+        duplicates = [c for c in nginx.detect_conflicts() if c['type'] == 'duplicate_server']
+        self.assertEqual(sorted(c['server_name'] for c in duplicates), ['a.com', 'b.com'])
+        self.assertEqual(duplicates[0]['servers'], [0, 1])
+
+        # server_name不区分大小写，正则名字保持原样
+        path = self._create_config("""
+        server { listen 80; server_name Example.COM www.Example.com; }
+        server { listen 80; server_name example.com ~^(?<Sub>.+)\\.Example\\.com$; }
+        """)
+        nginx = NGINX(path)
+        self.assertEqual(nginx.servers[0]['server_names'], ['example.com', 'www.example.com'])
+        self.assertEqual(nginx.servers[1]['server_names'], ['example.com', '~^(?<Sub>.+)\\.Example\\.com$'])
+        self.assertEqual(nginx.servers_by_name['example.com'], nginx.servers)
+        self.assertIs(nginx.find_server('WWW.example.com'), nginx.servers[0])
+        duplicates = [c for c in nginx.detect_conflicts() if c['type'] == 'duplicate_server']
+        self.assertEqual([(c['server_name'], c['servers']) for c in duplicates], [('example.com', [0, 1])])
+
+    def test_listen_normalization_and_conflicts(self):
+        """Test that listen sockets are normalized before conflict detection"""
+        self.assertEqual(parse_listen('80')[0], [('*', 80)])
+        self.assertEqual(parse_listen('*:80')[0], [('*', 80)])
+        self.assertEqual(parse_listen('0.0.0.0:80 default_server')[0], [('*', 80)])
+        self.assertEqual(parse_listen('[::]:80 ipv6only=off')[0], [('[::]', 80), ('*', 80)])
+        self.assertEqual(parse_listen('[0:0::1]:8080 ssl'), ([('[::1]', 8080)], {'ssl'}))
+        self.assertEqual(parse_listen('127.0.0.1')[0], [('127.0.0.1', 80)])
+        self.assertEqual(parse_listen('unix:/run/nginx.sock')[0], [('unix:/run/nginx.sock', None)])
+
+        config = """
+        server {
+            listen 80 default_server;
+            server_name a.com;
+        }
+        server {
+            listen 0.0.0.0:80 default_server;
+            server_name a.com;
+        }
+        server {
+            listen [::]:80 ipv6only=off;
+            listen *:80;
+            server_name a.com;
+        }
+        server {
+            listen 10.0.0.1:80;
+            server_name a.com;
+        }
+        """
+        path = self._create_config(config)
+        nginx = NGINX(path)
+        conflicts = nginx.detect_conflicts()
+        by_type = {}
+        for conflict in conflicts:
+            by_type.setdefault(conflict['type'], []).append(conflict)
+
+        self.assertEqual([(c['listen'], c['servers']) for c in by_type['duplicate_server']],
+                         [('*:80', [0, 1, 2])])
+        self.assertEqual([(c['listen'], c['servers']) for c in by_type['duplicate_default_server']],
+                         [('*:80', [0, 1])])
+        self.assertEqual([(c['listen'], c['server']) for c in by_type['duplicate_listen']], [('*:80', 2)])
+
+        # 多个配置的server可以一起检查
+        combined = nginx.servers + NGINX(path).servers
+        duplicates = [c for c in detect_listen_conflicts(combined) if c['type'] == 'duplicate_server']
+        self.assertEqual([(c['listen'], c['servers']) for c in duplicates],
+                         [('*:80', [0, 1, 2, 4, 5, 6]), ('10.0.0.1:80', [3, 7]), ('[::]:80', [2, 6])])
+
+        # 没有server_name、server_name为_或只有IP的server块也参与检测
+        catch_all = NGINX(self._create_config("""
+        http {
+            server { listen 80 default_server; return 444; }
+            server { listen 80 default_server; server_name _; }
+            server { listen 80 default_server; server_name 10.0.0.1; }
+        }
+        """))
+        self.assertEqual([(c['type'], c['listen'], c['servers']) for c in catch_all.detect_conflicts()],
+                         [('duplicate_default_server', '*:80', [0, 1, 2])])
+
+        # 校验结果中的server序号都是server块的序号，没有名字的块也占一个序号
+        mixed = NGINX(self._create_config("""
+        http {
+            server { listen 80 default_server; return 444; }
+            server { listen 80; server_name a.com; ssl_protocols SSLv3 TLSv1.2; }
+            server { server_name a.com; location /x { } }
+        }
+        """))
+        validation = mixed.validation()
+        self.assertEqual([(c['type'], c.get('servers', c.get('server'))) for c in validation['conflicts']],
+                         [('duplicate_server', [1, 2]), ('insecure_protocol', 1)])
+        self.assertEqual([(i['type'], i['server']) for i in validation['missing_directives']],
+                         [('missing_directive', 2), ('missing_handler', 2)])
+        self.assertEqual(list(mixed.iter_indexed_servers()), list(zip([1, 2], mixed.servers)))
+
     # TASK #23: Detailed Error Messages
     def test_task_023_detailed_errors(self):
         """Test Task #23: Provide detailed error messages"""
@@ -502,6 +620,253 @@ class TestAllTasks(unittest.TestCase):
         self.assertIn('grpc_pass', grpc_locs[0])
         self.assertIn('grpc_headers', grpc_locs[0])
 
+    def test_upstream_name_index(self):
+        """Test that proxy_pass and grpc_pass resolve through upstreams_by_name"""
+        config = """
+        http {
+            upstream api {
+                server 10.0.0.1:8080;
+            }
+            upstream grpc_backend {
+                server 10.0.0.2:50051;
+            }
+            server {
+                listen 80;
+                server_name test.com;
+
+                location /api {
+                    proxy_pass http://api;
+                }
+
+                location /grpc {
+                    grpc_pass grpc://grpc_backend;
+                }
+
+                location /db {
+                    proxy_pass http://db;
+                }
+            }
+        }
+        stream {
+            upstream db {
+                server 10.0.0.3:3306;
+            }
+            server {
+                listen 3306;
+                proxy_pass db;
+            }
+        }
+        """
+        path = self._create_config(config)
+        nginx = NGINX(path)
+
+        # stream中的upstream与http的是两个命名空间
+        self.assertEqual(sorted(nginx.upstreams_by_name), ['api', 'grpc_backend'])
+        self.assertIs(nginx.upstreams_by_name['api'], nginx.backend[0])
+
+        full_config = nginx.get_all_config()
+        self.assertEqual(full_config['servers'][0]['backend'][0]['backend_ip'], '10.0.0.1:8080')
+        self.assertEqual(full_config['servers'][0]['backend'][2]['proxy_pass'], 'http://db')
+        self.assertNotIn('backend_ip', full_config['servers'][0]['backend'][2])
+        self.assertEqual(full_config['grpc_locations'][0]['backend_ip'], '10.0.0.2:50051')
+        self.assertEqual(full_config['stream']['servers'][0]['backend_ip'], '10.0.0.3:3306')
+
+    def test_location_routing(self):
+        """Test that URIs are routed to locations in nginx's order"""
+        config = """
+        http {
+            upstream api {
+                server 10.0.0.1:8080;
+            }
+            server {
+                listen 80;
+                server_name www.test.com test.com;
+
+                location = / {
+                    root /var/www/exact;
+                }
+                location / {
+                    root /var/www/html;
+                }
+                location /documents/ {
+                    root /var/www/docs;
+                }
+                location ^~ /images/ {
+                    root /var/www/images;
+                }
+                location ~* \\.(gif|jpg|jpeg)$ {
+                    root /var/www/media;
+                }
+                location /api/ {
+                    proxy_pass http://api;
+                }
+            }
+        }
+        """
+        path = self._create_config(config)
+        nginx = NGINX(path)
+
+        self.assertEqual(nginx.match('test.com', '/')['root'], '/var/www/exact')
+        self.assertEqual(nginx.match('test.com', '/index.html')['root'], '/var/www/html')
+        self.assertEqual(nginx.match('test.com', '/documents/document.html')['root'], '/var/www/docs')
+        self.assertEqual(nginx.match('test.com', '/images/1.gif')['root'], '/var/www/images')
+        self.assertEqual(nginx.match('test.com', '/documents/1.JPG')['root'], '/var/www/media')
+        self.assertEqual(nginx.match('www.test.com', '/api/v1/x?id=1')['backend_ip'], '10.0.0.1:8080')
+        self.assertIsNone(nginx.match('unknown.com', '/'))
+
+        compact = NGINX(path, compact=True)
+        self.assertEqual(compact.servers[0].match('/api/v1/x')['proxy_pass'], 'http://10.0.0.1:8080')
+        self.assertIs(compact.servers[0].router(), compact.servers[0].router())
+        self.assertNotIn('_router', compact.servers[0])
+        json.dumps(compact.get_all_config())
+
+        uris = ['/', '/index.html', '/images/1.gif', '/documents/1.JPG', b'/api/v1', '/index.html?x=1']
+        self.assertEqual(nginx.route_many('test.com', uris), [0, 1, 3, 4, 5, 1])
+        self.assertEqual(nginx.route_many('test.com', iter(uris[:2])), [0, 1])
+        self.assertEqual(nginx.route_many('unknown.com', uris[:2]), [None, None])
+        router = nginx.location_router('test.com')
+        self.assertEqual(router.match_many(uris), [router.match_index(u if isinstance(u, str) else u.decode()) for u in uris])
+
+    def test_nested_location_routing(self):
+        """Test that nested locations keep their own directives and are routed like nginx"""
+        config = """
+        http {
+            upstream api {
+                server 10.0.0.1:8080;
+            }
+            server {
+                listen 80;
+                server_name test.com;
+
+                location / {
+                    root /var/www/html;
+                    location /nested {
+                        proxy_pass http://api;
+                    }
+                    location ~ \\.php$ {
+                        fastcgi_pass 127.0.0.1:9000;
+                    }
+                }
+                location ~ \\.jpg$ {
+                    root /var/www/media;
+                }
+                location ^~ /static/ {
+                    root /var/www/static;
+                    location ~ \\.css$ {
+                        root /var/www/css;
+                    }
+                }
+            }
+        }
+        """
+        path = self._create_config(config)
+        nginx = NGINX(path)
+
+        outer = nginx.servers[0]['backend'][0]
+        self.assertEqual(len(nginx.servers[0]['backend']), 3)
+        self.assertEqual(outer['root'], '/var/www/html')
+        self.assertNotIn('proxy_pass', outer)
+        self.assertNotIn('backend_ip', outer)
+        self.assertEqual([l['path'] for l in outer['locations']], ['/nested', '\\.php$'])
+        self.assertEqual(outer['locations'][0]['backend_ip'], '10.0.0.1:8080')
+
+        self.assertEqual(nginx.match('test.com', '/nested/x')['backend_ip'], '10.0.0.1:8080')
+        self.assertEqual(nginx.match('test.com', '/index.html')['root'], '/var/www/html')
+        # 外层的正则优先于嵌套的前缀匹配，嵌套的正则优先于外层的前缀匹配
+        self.assertEqual(nginx.match('test.com', '/nested/1.jpg')['root'], '/var/www/media')
+        self.assertEqual(nginx.match('test.com', '/index.php')['fastcgi_pass'], '127.0.0.1:9000')
+        # ^~只跳过同一层的正则，其中嵌套的正则仍然匹配
+        self.assertEqual(nginx.match('test.com', '/static/1.jpg')['root'], '/var/www/static')
+        self.assertEqual(nginx.match('test.com', '/static/1.css')['root'], '/var/www/css')
+
+        # 序号为先序遍历中的序号
+        uris = ['/', '/nested/x', '/index.php', '/1.jpg', '/static/1.jpg', '/static/1.css', '/nested/1.jpg']
+        self.assertEqual(nginx.route_many('test.com', uris), [0, 1, 2, 3, 4, 5, 3])
+        router = nginx.location_router('test.com')
+        self.assertEqual(router.match_many(uris), [router.match_index(uri) for uri in uris])
+
+        compact = NGINX(path, compact=True)
+        self.assertEqual(compact.servers[0].match('/nested/x')['proxy_pass'], 'http://10.0.0.1:8080')
+        server = type(compact.servers[0]).from_dict(nginx.servers[0])
+        self.assertEqual(server.match('/static/1.css')['root'], '/var/www/css')
+        self.assertIs(type(server['backend'][0]['locations'][0]), type(server['backend'][0]))
+
+    def test_vhost_resolution(self):
+        """Test that Host headers resolve to servers in nginx's order"""
+        config = """
+        http {
+            server {
+                listen 80;
+                server_name first.com;
+            }
+            server {
+                listen 80 default_server;
+                server_name fallback.com;
+            }
+            server {
+                listen 80;
+                server_name example.com www.example.com;
+            }
+            server {
+                listen 80;
+                server_name *.example.com;
+            }
+            server {
+                listen 80;
+                server_name mail.*;
+            }
+            server {
+                listen 80;
+                server_name ~^(?<user>.+)\\.users\\.net$;
+            }
+            server {
+                listen 10.0.0.1:8080;
+                server_name internal.com;
+            }
+            server {
+                listen 8080;
+                server_name public.com;
+            }
+            server {
+                listen 8081;
+                server_name known.com;
+            }
+            server {
+                listen 8081 default_server;
+                return 444;
+            }
+            server {
+                listen 8081;
+                server_name ~^App\\S+\\.example\\.com$ 10.0.0.9;
+            }
+        }
+        """
+        path = self._create_config(config)
+        nginx = NGINX(path)
+
+        def resolve(host, port=80, address='*'):
+            server = nginx.resolve_vhost(host, port, address)
+            return server and server['server_name']
+
+        self.assertEqual(resolve('www.example.com'), 'example.com www.example.com')
+        self.assertEqual(resolve('WWW.Example.com:80'), 'example.com www.example.com')
+        self.assertEqual(resolve('api.example.com'), '*.example.com')
+        self.assertEqual(resolve('a.b.example.com'), '*.example.com')
+        self.assertEqual(resolve('mail.test.org'), 'mail.*')
+        self.assertEqual(resolve('bob.users.net'), '~^(?<user>.+)\\.users\\.net$')
+        self.assertEqual(resolve('unknown.org'), 'fallback.com')
+        self.assertEqual(resolve('internal.com', 8080, '10.0.0.1'), 'internal.com')
+        self.assertEqual(resolve('public.com', 8080, '10.0.0.1'), 'internal.com')
+        self.assertEqual(resolve('public.com', 8080), 'public.com')
+        self.assertIsNone(resolve('first.com', 443))
+        # 没有server_name的兜底server也参与选择；正则不转小写 (\S不会变成\s)，匹配不区分大小写
+        self.assertEqual(nginx.resolve_vhost('unknown.org', 8081), {'listen': ['8081 default_server'],
+                                                                    'server_name': '', 'server_names': []})
+        self.assertEqual(resolve('App1.example.com', 8081), '~^App\\S+\\.example\\.com$ 10.0.0.9')
+        self.assertEqual(resolve('app.example.com', 8081), '')
+        self.assertEqual(resolve('10.0.0.9', 8081), '~^App\\S+\\.example\\.com$ 10.0.0.9')
+        self.assertIs(nginx.vhost_index(), nginx.vhost_index())
+
     # TASK #34-36: CLI Tool
     def test_task_034_036_cli_tool(self):
         """Test Tasks #34-36: CLI tool functionality"""
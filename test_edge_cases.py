@@ -8,7 +8,7 @@ import unittest
 import tempfile
 import os
 import json
-from nginx import NGINX
+from nginx import NGINX, match_blocks, parse_tree
 
 
 class TestNGINXParserEdgeCases(unittest.TestCase):
@@ -611,6 +611,53 @@ http {
         # This test documents the current behavior
         self.assertEqual(len(server['backend']), 1)
 
+    def test_location_brace_matching(self):
+        """Test location extraction with arbitrary nesting, quoted braces and long if chains"""
+        content = 'location /a { if ($x) { location /b { if ($y) { return 200; } } } } location = /c { return 200 "}"; }'
+        blocks = match_blocks(content, 'location')
+        self.assertEqual([content[start:close + 1] for start, _, close in blocks],
+                         ['location /a { if ($x) { location /b { if ($y) { return 200; } } } }',
+                          'location = /c { return 200 "}"; }'])
+        self.assertEqual(match_blocks('location /open { if ($x) { }', 'location'), [(0, 15, 28)])
+
+        ifs = ''.join('            if ($arg_%d) { set $v %d; }\n' % (i, i) for i in range(5000))
+        config_content = """
+http {
+    server {
+        listen 80;
+        server_name test.com;
+        add_header Permissions-Policy "geolocation=(), camera=()";
+
+        location /outer {
+            location ~ ^/inner/(?<id>\\d+) {
+                if ($id) {
+                    if ($request_method = POST) { return 405; }
+                }
+                proxy_pass http://127.0.0.1:8080;
+            }
+%s        }
+
+        location = /exact {
+            return 200 "{ok}";
+            root /var/www;
+        }
+    }
+}
+""" % ifs
+        config_path = self.create_test_config('brace_matching', config_content)
+        # 耗时见nginx_bench的long_if_chain场景
+        server = NGINX(config_path).servers[0]
+
+        locations = [(loc['modifier'], loc['path']) for loc in server['backend']]
+        self.assertEqual(locations, [(None, '/outer'), ('=', '/exact')])
+        # 嵌套的location是外层location中单独的一项，proxy_pass不算作/outer的指令
+        outer = server['backend'][0]
+        self.assertNotIn('proxy_pass', outer)
+        self.assertNotIn('backend_ip', outer)
+        self.assertEqual([(loc['modifier'], loc['path']) for loc in outer['locations']], [('~', '^/inner/(?<id>\\d+)')])
+        self.assertEqual(outer['locations'][0]['backend_ip'], '127.0.0.1:8080')
+        self.assertEqual(server['backend'][1]['root'], '/var/www')
+
     def test_mixed_line_endings(self):
         """Test parsing with mixed line endings"""
         config_content = "worker_processes 1;\r\n\r\nevents {\r\n    worker_connections 1024;\n}\r\n\r\nhttp {\n    server {\r\n        listen 80;\n        server_name test.com;\r\n    }\n}"
@@ -784,6 +831,42 @@ http {
         # Should handle escaped characters
         self.assertEqual(nginx.servers[0]['server_name'], 'test\\.example\\.com')
 
+    def test_quote_and_escape_aware_lexer(self):
+        """Test braces and semicolons inside strings, escapes, ${var} and regex quantifiers"""
+        tree = parse_tree('set $a "x\\";y{"; set $b ${host}_1; location ~ ^/a{2,3}$ { return 200 \'{\\\'k\\\': 1}\'; }')
+        self.assertEqual([(d.name, d.args) for d in tree.walk()],
+                         [('set', ['$a', 'x";y{']), ('set', ['$b', '${host}_1']),
+                          ('location', ['~', '^/a{2,3}$']), ('return', ['200', "{'k': 1}"])])
+
+        config_content = """
+http {
+    log_format json escape=json '{"time": "$time_iso8601", "uri": "$uri", '
+                                '"status": $status}';
+    server {
+        listen 80;
+        server_name test.com;
+        location ~ ^/api/v{1,2}/(.*)$ {
+            return 200 "{\\"ok\\": true; }";
+        }
+        location /static {
+            root /var/www;
+        }
+    }
+}
+"""
+        config_path = self.create_test_config('lexer_quotes', config_content)
+        nginx = NGINX(config_path)
+        locations = [(loc['modifier'], loc['path']) for loc in nginx.servers[0]['backend']]
+        self.assertEqual(locations, [('~', '^/api/v{1,2}/(.*)$'), (None, '/static')])
+        self.assertEqual(nginx.validate_syntax(), {'valid': True, 'errors': [], 'warnings': []})
+
+        broken = config_content.replace('listen 80;', 'listen 80').replace('root /var/www;', 'root /var/www') + '}\n'
+        validation = NGINX(self.create_test_config('lexer_broken', broken)).validate_syntax()
+        self.assertEqual(validation['errors'][0]['message'], 'Mismatched braces: 4 opening, 5 closing')
+        self.assertEqual([(w['line'], w['message']) for w in validation['warnings']],
+                         [(6, 'Possible missing semicolon: listen 80'),
+                          (12, 'Possible missing semicolon: root /var/www')])
+
     def test_performance_with_many_locations(self):
         """Test performance with many location blocks"""
         config_parts = ["worker_processes 1;", "", "events {", "    worker_connections 1024;", "}", "", "http {", "    server {", "        listen 80;", "        server_name test.com;"]
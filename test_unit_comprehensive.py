@@ -7,8 +7,14 @@ Tests all PRD tasks and edge cases with 100% coverage
 import unittest
 import tempfile
 import os
+import io
 import json
-from nginx import NGINX
+import re
+import threading
+from contextlib import redirect_stdout, redirect_stderr
+from unittest import mock
+import nginx as nginx_module
+from nginx import NGINX, parse_tree, main, iter_parse_many, Server, Location, Upstream, UpstreamServer
 
 
 class TestNGINXParserUnit(unittest.TestCase):
@@ -516,6 +522,609 @@ server {
         # This test validates that the parser doesn't crash with includes
         self.assertIsNotNone(nginx)
 
+    def test_include_merging_in_memory(self):
+        """Test that includes are merged in memory without touching cwd or /tmp"""
+        main_config = """worker_processes 1;
+include upstreams.conf;
+http {
+    server {
+        listen 80;
+        server_name test.com;
+        location / {
+            proxy_pass http://app;
+        }
+    }
+}
+"""
+        upstreams_config = """# upstreams
+upstream app {
+    server 10.0.0.1:8080;
+}
+"""
+        main_path = self.create_test_config('main', main_config)
+        upstreams_path = os.path.join(self.temp_dir, 'upstreams.conf')
+        with open(upstreams_path, 'w') as f:
+            f.write(upstreams_config)
+
+        cwd = os.getcwd()
+        nginx = NGINX(main_path)
+        self.assertEqual(os.getcwd(), cwd)
+
+        self.assertEqual(nginx.backend[0]['poolname'], 'app')
+        self.assertEqual(nginx.servers[0]['backend'][0]['backend_ip'], '10.0.0.1:8080')
+        self.assertNotIn('# upstreams', nginx.content)
+        self.assertEqual([seg[0] for seg in nginx.segments], [main_path, upstreams_path, main_path])
+        for path, start, end in nginx.segments:
+            self.assertLess(start, end)
+
+    def test_recursive_glob_include(self):
+        """Test recursive, glob-aware include expansion and the file cache"""
+        main_config = """http {
+    include conf.d/*.conf;
+}
+"""
+        os.makedirs(os.path.join(self.temp_dir, 'conf.d'))
+        files = {
+            'conf.d/a.conf': "server {\n    listen 80;\n    server_name a.com;\n    include snippets/loc.conf;\n}\n",
+            'conf.d/b.conf': "server {\n    listen 80;\n    server_name b.com;\n}\ninclude conf.d/b.conf;\n",
+            'snippets/loc.conf': "location /a {\n    root /srv/a;\n}\n",
+        }
+        os.makedirs(os.path.join(self.temp_dir, 'snippets'))
+        for name, content in files.items():
+            with open(os.path.join(self.temp_dir, name), 'w') as f:
+                f.write(content)
+        main_path = self.create_test_config('main', main_config)
+
+        nginx = NGINX(main_path)
+        self.assertEqual([s['server_name'] for s in nginx.servers], ['a.com', 'b.com'])
+        self.assertEqual(nginx.servers[0]['backend'][0]['path'], '/a')
+
+        # Unchanged files are served from the cache without being reopened
+        with mock.patch('nginx.open', create=True, side_effect=AssertionError('file re-read')):
+            cached = NGINX(main_path)
+        self.assertEqual(cached.content, nginx.content)
+
+    def test_file_cache_is_bounded(self):
+        """Test the file cache: keyed by mtime and size, LRU-bounded by bytes, not cleared by parsing"""
+        paths = []
+        for name in ('a', 'b', 'c'):
+            paths.append(self.create_test_config(name, "server {\n    listen 80;\n    server_name %s.com;\n}\n" % name))
+        sizes = [os.path.getsize(path) for path in paths]
+
+        nginx_module.clear_file_cache()
+        with mock.patch.object(nginx_module, '_FILE_CACHE_LIMIT', sizes[0] + sizes[1]):
+            for path in paths[:2]:
+                NGINX(path)
+            # 解析完成后缓存仍然保留
+            self.assertEqual(list(nginx_module._file_cache), paths[:2])
+            nginx_module.load_conf_file(paths[0])
+            NGINX(paths[2])
+            # 超出上限时淘汰最久未使用的文件
+            self.assertEqual(list(nginx_module._file_cache), [paths[0], paths[2]])
+            self.assertLessEqual(nginx_module._file_cache_bytes, sizes[0] + sizes[1])
+
+        # 文件变化后 (mtime和大小) 重新读取
+        with open(paths[0], 'a') as f:
+            f.write("# changed\n")
+        self.assertEqual(NGINX(paths[0]).servers[0]['server_name'], 'a.com')
+        self.assertEqual(nginx_module._file_cache[paths[0]][0][1], os.path.getsize(paths[0]))
+        nginx_module.clear_file_cache()
+        self.assertEqual((len(nginx_module._file_cache), nginx_module._file_cache_bytes), (0, 0))
+
+    def test_source_positions(self):
+        """Test mapping merged offsets back to the original file, line, column and byte offset"""
+        main_config = "# main\r\nworker_processes 1;\r\n\r\n# http\r\nhttp {\r\n    include sites/*.conf;\r\n}\r\n"
+        site_config = "# 站点\nserver {\n    # listen\n    listen 80\n    server_name 中文.com;\n}\n"
+        main_path = os.path.join(self.temp_dir, 'main.conf')
+        site_path = os.path.join(self.temp_dir, 'sites', 'a.conf')
+        os.makedirs(os.path.dirname(site_path))
+        with open(main_path, 'wb') as f:
+            f.write(main_config.encode('utf-8'))
+        with open(site_path, 'wb') as f:
+            f.write(site_config.encode('utf-8'))
+
+        for use_mmap in (False, True):
+            nginx = NGINX(main_path, use_mmap=use_mmap)
+            positions = {}
+            for node in nginx.tree.walk():
+                path, line, column, offset = nginx.source_position(node.start)
+                with open(path, 'rb') as f:
+                    raw = f.read()
+                self.assertTrue(raw[offset:].startswith(node.name.encode()))
+                positions[node.name] = (os.path.basename(path), line, column)
+            self.assertEqual(positions, {
+                'worker_processes': ('main.conf', 2, 1),
+                'http': ('main.conf', 5, 1),
+                'server': ('a.conf', 2, 1),
+                'listen': ('a.conf', 4, 5),  # 缺少分号，与下一行合并为一条指令
+            })
+
+            # 语法检查的行号是原文件中的行号
+            warning = nginx.validate_syntax()['warnings'][0]
+            self.assertEqual((warning['file'], warning['line'], warning['column']), (site_path, 4, 14))
+
+    def test_refresh_reparses_only_changed_blocks(self):
+        """Test incremental re-parse after a single include file changes"""
+        main_config = """http {
+    upstream app {
+        server 10.0.0.1:8080;
+    }
+    include vhosts/*.conf;
+}
+"""
+        os.makedirs(os.path.join(self.temp_dir, 'vhosts'))
+        a_path = os.path.join(self.temp_dir, 'vhosts', 'a.conf')
+        b_path = os.path.join(self.temp_dir, 'vhosts', 'b.conf')
+        with open(a_path, 'w') as f:
+            f.write("server {\n    listen 80;\n    server_name a.com;\n}\n")
+        with open(b_path, 'w') as f:
+            f.write("server {\n    listen 80;\n    server_name b.com;\n}\n")
+        main_path = self.create_test_config('main', main_config)
+
+        def signature(tree):
+            return [(d.name, d.start, d.end, d.value_start, d.value_end, d.block is None) for d in tree.walk()]
+
+        nginx = NGINX(main_path)
+        server_a, server_b = nginx.servers
+        node_a = next(nginx.iter_server_nodes())
+        upstream = nginx.backend[0]
+        self.assertFalse(nginx.refresh())
+
+        with open(b_path, 'w') as f:
+            f.write("server {\n    listen 8080;\n    server_name b.example.com;\n}\n")
+        self.assertTrue(nginx.refresh())
+
+        self.assertIs(nginx.servers[0], server_a)
+        self.assertIs(nginx.backend[0], upstream)
+        self.assertIsNot(nginx.servers[1], server_b)
+        self.assertEqual(nginx.servers[1]['server_name'], 'b.example.com')
+        self.assertEqual(nginx.servers[1]['listen'], ['8080'])
+
+        # 只重新扫描变化的文件，拼接后的配置树与重新构建的相同，未变化的server块节点保持不变
+        self.assertIs(next(nginx.iter_server_nodes()), node_a)
+        self.assertEqual(signature(nginx.tree), signature(parse_tree(nginx.content)))
+
+        # 修改前面的文件，之后的节点整体平移
+        with open(a_path, 'w') as f:
+            f.write("server {\n    listen 80;\n    server_name a.com www.a.com;\n}\n")
+        self.assertTrue(nginx.refresh())
+        self.assertEqual(nginx.servers[0]['server_names'], ['a.com', 'www.a.com'])
+        self.assertEqual(nginx.servers[1]['server_name'], 'b.example.com')
+        self.assertEqual(signature(nginx.tree), signature(parse_tree(nginx.content)))
+        self.assertEqual(nginx.get_all_config(), NGINX(main_path).get_all_config())
+
+        # 变化破坏了块结构时重新构建整个配置树
+        with open(b_path, 'w') as f:
+            f.write("server {\n    listen 8080;\n    server_name b.example.com;\n")
+        self.assertTrue(nginx.refresh())
+        self.assertEqual(signature(nginx.tree), signature(parse_tree(nginx.content)))
+        self.assertEqual(nginx.get_all_config(), NGINX(main_path).get_all_config())
+
+    def test_identical_server_blocks(self):
+        """Test that identical server blocks get their own parse results"""
+        block = "    server {\n        listen 80;\n        server_name same.com;\n        location / { root /a; }\n    }\n"
+        config_path = self.create_test_config('identical', "http {\n" + block + block + "}\n")
+        nginx = NGINX(config_path)
+        first, second = nginx.servers
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        first['backend'][0]['root'] = '/changed'
+        self.assertEqual(second['backend'][0]['root'], '/a')
+
+        with open(config_path, 'a') as f:
+            f.write("events { worker_connections 512; }\n")
+        self.assertTrue(nginx.refresh())
+        self.assertIs(nginx.servers[0], first)
+        self.assertIsNot(nginx.servers[1], nginx.servers[0])
+
+    def test_persistent_parse_cache(self):
+        """Test that get_all_config results are reused from the cache directory"""
+        config_content = """
+http {
+    upstream app {
+        server 10.0.0.1:8080;
+    }
+    server {
+        listen 80;
+        server_name cached.com;
+        location / {
+            proxy_pass http://app;
+        }
+    }
+}
+"""
+        config_path = self.create_test_config('cached', config_content)
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+
+        config = NGINX(config_path, cache_dir=cache_dir).get_all_config()
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        with mock.patch('nginx.parse_tree', side_effect=AssertionError('config re-parsed')):
+            cached = NGINX(config_path, cache_dir=cache_dir)
+        self.assertEqual(cached.servers[0]['server_name'], 'cached.com')
+        self.assertEqual(cached.get_all_config(), config)
+
+        # 需要配置树的方法在缓存命中时按需构建配置树
+        self.assertEqual(len(list(cached.iter_server_nodes())), 1)
+        self.assertIn('server_name cached.com;', cached.find_server_block_content('cached.com'))
+        self.assertIn('proxy_pass http://10.0.0.1:8080;', cached.serverBlock[0])
+        cached.parse_server_block()
+        self.assertEqual(cached.servers, config['servers'])
+
+        # ndjson输出同样写入缓存
+        other_dir = os.path.join(self.temp_dir, 'cache_ndjson')
+        records = list(NGINX(config_path, cache_dir=other_dir).iter_records())
+        self.assertEqual(len(os.listdir(other_dir)), 1)
+        self.assertEqual(list(NGINX(config_path, cache_dir=other_dir).iter_records()), records)
+        self.assertEqual(NGINX(config_path, cache_dir=other_dir).get_all_config(), config)
+
+        # A changed config gets its own cache entry
+        with open(config_path, 'a') as f:
+            f.write("worker_processes 2;\n")
+        changed = NGINX(config_path, cache_dir=cache_dir)
+        self.assertEqual(changed.global_config['worker_processes'], '2')
+
+        # 合并内容相同，但注释行使行号不同的配置不共用缓存，警告中的位置来自各自的文件
+        broken = "http {\n    server {\n        listen 80\n        server_name broken.com;\n    }\n}\n"
+        first = self.create_test_config('broken_a', broken)
+        second = self.create_test_config('broken_b', "# comment\n# comment\n" + broken)
+        warnings = [NGINX(path, cache_dir=cache_dir).get_all_config()['validation']['syntax']['warnings']
+                    for path in (first, second)]
+        self.assertEqual([(w['file'], w['line']) for w in warnings[0]], [(first, 3)])
+        self.assertEqual([(w['file'], w['line']) for w in warnings[1]], [(second, 5)])
+
+    def test_get_all_config_memoized(self):
+        """Test that get_all_config and validation run once per parse"""
+        config_content = """
+http {
+    proxy_cache_path /var/cache levels=1:2 keys_zone=app:10m;
+    server {
+        listen 80;
+        server_name memo.com;
+    }
+}
+"""
+        config_path = self.create_test_config('memo', config_content)
+        nginx = NGINX(config_path)
+
+        config = nginx.get_all_config()
+        with mock.patch.object(NGINX, 'parse_caching', side_effect=AssertionError('re-scanned')):
+            self.assertIs(nginx.get_all_config(), config)
+            self.assertEqual(nginx.config_section('caching')['proxy_cache_path']['keys_zone_name'], 'app')
+        self.assertIsNone(nginx.config_section('stream'))
+        self.assertIs(nginx.validate_syntax(), config['validation']['syntax'])
+
+        # 只有refresh发现配置变化时才重新计算
+        self.assertFalse(nginx.refresh())
+        self.assertIs(nginx.get_all_config(), config)
+        with open(config_path, 'a') as f:
+            f.write("worker_processes 2;\n")
+        self.assertTrue(nginx.refresh())
+        self.assertEqual(nginx.config_section('global'), {'worker_processes': '2'})
+        self.assertIsNot(nginx.validate_syntax(), config['validation']['syntax'])
+
+    def test_mmap_mode_matches_text_mode(self):
+        """Test that the mmap/bytes lexer produces the same result as text mode"""
+        main_config = """# generated
+worker_processes 2;
+http {
+    upstream app {
+        server 10.0.0.1:8080 weight=2;
+    }
+    include site.conf;
+}
+"""
+        site_config = """server {
+    listen 80;
+    server_name café.example.com;
+    # location /disabled { }
+    location / {
+        proxy_pass http://app;
+    }
+}
+"""
+        main_path = self.create_test_config('main', main_config)
+        with open(os.path.join(self.temp_dir, 'site.conf'), 'w', encoding='utf-8') as f:
+            f.write(site_config)
+
+        text_mode = NGINX(main_path)
+        mmap_mode = NGINX(main_path, use_mmap=True)
+        self.assertIsInstance(mmap_mode.content, bytes)
+        self.assertEqual(mmap_mode.global_config, text_mode.global_config)
+        self.assertEqual(mmap_mode.backend, text_mode.backend)
+        self.assertEqual(mmap_mode.servers, text_mode.servers)
+        self.assertEqual(mmap_mode.servers[0]['server_name'], 'café.example.com')
+        self.assertEqual(len(mmap_mode.servers[0]['backend']), 1)
+        self.assertFalse(mmap_mode.refresh())
+        self.assertEqual(mmap_mode.validate_syntax(), text_mode.validate_syntax())
+
+        # 构造之后不再引用映射: 截断文件后仍可访问已加载的内容，原地修改的同长度内容能被refresh发现
+        solo_path = self.create_test_config('solo', "http {\n    server {\n        listen 80;\n        server_name solo;\n    }\n}\n")
+        solo = NGINX(solo_path, use_mmap=True)
+        with open(solo_path, 'r+b') as f:
+            data = f.read()
+            f.seek(data.index(b'80'))
+            f.write(b'81')
+        self.assertTrue(solo.refresh())
+        self.assertEqual(solo.servers[0]['listen'], ['81'])
+        solo = NGINX(solo_path, use_mmap=True)
+        open(solo_path, 'w').close()
+        self.assertEqual(solo.servers[0]['listen'], ['81'])
+        self.assertEqual(solo.validate_syntax()['errors'], [])
+
+        outputs = []
+        for flags in ([], ['--mmap']):
+            output = io.StringIO()
+            with mock.patch('sys.argv', ['nginxparser', 'query', main_path, '--output', 'ndjson'] + flags), \
+                    redirect_stdout(output), self.assertRaises(SystemExit):
+                main()
+            outputs.append(output.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(json.loads(outputs[1])['server_name'], 'café.example.com')
+
+    def test_compact_records(self):
+        """Test the __slots__ data model and its dict-compatible shape"""
+        config_content = """
+http {
+    upstream app {
+        server 10.0.0.1:8080 weight=2 backup;
+    }
+    server {
+        listen 80;
+        server_name compact.com;
+        location /api {
+            proxy_pass http://app;
+        }
+    }
+}
+"""
+        config_path = self.create_test_config('compact', config_content)
+        plain = NGINX(config_path)
+        compact = NGINX(config_path, compact=True)
+
+        server = compact.servers[0]
+        self.assertIsInstance(server, Server)
+        self.assertIsInstance(server.backend[0], Location)
+        self.assertIsInstance(compact.backend[0], Upstream)
+        self.assertIsInstance(compact.backend[0].servers[0], UpstreamServer)
+        self.assertFalse(hasattr(server, '__dict__'))
+
+        self.assertEqual(server.server_name, 'compact.com')
+        self.assertEqual(server['backend'][0]['backend_ip'], '10.0.0.1:8080')
+        self.assertNotIn('fastcgi_pass', server.backend[0])
+        self.assertIsNone(server.backend[0].get('fastcgi_pass'))
+        self.assertEqual(list(compact.backend[0].servers[0]), ['address', 'weight', 'backup'])
+
+        self.assertEqual(server.to_dict(), plain.servers[0])
+        self.assertEqual(compact.servers, plain.servers)
+        self.assertEqual(compact.get_all_config(), plain.get_all_config())
+        self.assertEqual(Server.from_dict(plain.servers[0]), server)
+        json.dumps(compact.get_all_config())
+
+    def test_parallel_server_parsing(self):
+        """Test that workers=N parses server blocks in a process pool, in order"""
+        config_parts = ["http {", "    upstream app { server 10.0.0.1:8080; }"]
+        for i in range(12):
+            config_parts.append(f"    server {{ listen 80; server_name site{i}.com; "
+                                f"location / {{ proxy_pass http://app; }} allow 10.0.0.{i}; }}")
+        config_parts.append("    server { listen 80; server_name 127.0.0.1; }")
+        config_parts.append("}")
+        config_path = self.create_test_config('parallel', "\n".join(config_parts))
+
+        serial = NGINX(config_path)
+        parallel = NGINX(config_path, workers=2)
+        self.assertEqual(parallel.servers, serial.servers)
+        self.assertEqual([s['server_name'] for s in parallel.servers], [f'site{i}.com' for i in range(12)])
+        self.assertEqual(parallel.servers[3]['backend'][0]['backend_ip'], '10.0.0.1:8080')
+
+        compact = NGINX(config_path, workers=2, compact=True)
+        self.assertIsInstance(compact.servers[0], Server)
+        self.assertEqual(compact.servers, serial.servers)
+
+    def test_iter_servers(self):
+        """Test the streaming server iterator"""
+        config_content = """
+http {
+    upstream app { server 10.0.0.1:8080; }
+    server { listen 80; server_name first.com; location / { proxy_pass http://app; } }
+    server { listen 80; server_name 10.0.0.2; }
+    server { listen 443 ssl; server_name second.com; root /var/www; }
+}
+"""
+        config_path = self.create_test_config('iter_servers', config_content)
+        nginx = NGINX(config_path)
+
+        servers = nginx.iter_servers()
+        self.assertNotIsInstance(servers, list)
+        self.assertEqual(list(servers), nginx.servers)
+        self.assertEqual(next(nginx.iter_servers())['backend'][0]['backend_ip'], '10.0.0.1:8080')
+
+        # 逐个展开server块，不构建完整的配置树
+        streamed = NGINX(config_path)
+        self.assertEqual(list(streamed.iter_servers()), nginx.servers)
+        self.assertNotIn('tree', streamed.__dict__)
+
+    def test_lazy_sections(self):
+        """Test that sections are parsed on first access only"""
+        config_content = """
+events {
+    worker_connections 2048;
+}
+http {
+    upstream app { server 10.0.0.1:8080; }
+    server { listen 80; server_name lazy.com; location / { proxy_pass http://app; } }
+}
+"""
+        config_path = self.create_test_config('lazy', config_content)
+        with mock.patch.object(NGINX, 'parse_server_block') as parse_servers, \
+                mock.patch.object(NGINX, 'parse_backend_ip') as parse_upstreams:
+            nginx = NGINX(config_path)
+            self.assertEqual(nginx.events_config['worker_connections'], '2048')
+            parse_servers.assert_not_called()
+            parse_upstreams.assert_not_called()
+
+        nginx = NGINX(config_path)
+        self.assertNotIn('backend', vars(nginx))
+        # server解析依赖upstream索引，会先触发upstream解析
+        self.assertEqual(nginx.servers[0]['backend'][0]['backend_ip'], '10.0.0.1:8080')
+        self.assertIn('backend', vars(nginx))
+        self.assertIs(nginx.servers, nginx.servers)
+
+    def test_parse_many_cli(self):
+        """Test parse-many streaming one JSON result per line"""
+        for i in range(3):
+            self.create_test_config(f'host{i}', f"http {{ server {{ listen 80; server_name host{i}.com; }} }}")
+        pattern = os.path.join(self.temp_dir, 'host*.conf')
+        missing = os.path.join(self.temp_dir, 'missing.conf')
+
+        for jobs in ('1', '2'):
+            output = io.StringIO()
+            with mock.patch('sys.argv', ['nginxparser', 'parse-many', pattern, missing, '--jobs', jobs]), \
+                    redirect_stdout(output), self.assertRaises(SystemExit) as exit_info:
+                main()
+            self.assertEqual(exit_info.exception.code, 1)
+
+            results = {os.path.basename(r['file']): r for r in map(json.loads, output.getvalue().splitlines())}
+            self.assertEqual(sorted(results), ['host0.conf', 'host1.conf', 'host2.conf', 'missing.conf'])
+            self.assertEqual(results['host1.conf']['config']['servers'][0]['server_name'], 'host1.com')
+            self.assertIn('error', results['missing.conf'])
+
+    def test_iter_parse_many_window(self):
+        """Test that parse-many only keeps a bounded number of files in flight"""
+        paths = [self.create_test_config(f'window{i}', f"http {{ server {{ listen 80; server_name w{i}.com; }} }}")
+                 for i in range(8)]
+        consumed = []
+
+        def lazy_paths():
+            for path in paths:
+                consumed.append(path)
+                yield path
+
+        results = iter_parse_many(lazy_paths(), jobs=2, window=1)
+        first = next(results)
+        # 第一个结果生成时最多提交了jobs * window个文件
+        self.assertLessEqual(len(consumed), 2)
+        names = [first['config']['servers'][0]['server_name']]
+        names.extend(result['config']['servers'][0]['server_name'] for result in results)
+        self.assertEqual(sorted(names), sorted(f'w{i}.com' for i in range(8)))
+
+    def test_ndjson_records(self):
+        """Test that NDJSON records stream the same data as get_all_config"""
+        config_content = """
+worker_processes 2;
+http {
+    upstream app { server 10.0.0.1:8080; }
+    proxy_cache_path /var/cache levels=1:2 keys_zone=app:10m;
+    server {
+        listen 80;
+        server_name one.com;
+        location / { proxy_pass http://app; }
+        location /static { root /var/www; }
+    }
+    server { listen 80; server_name two.com; }
+    server { server_name old.com; ssl_protocols SSLv3 TLSv1.2; location /x { } }
+    server { listen 80 default_server; return 444; }
+    server { listen 80 default_server; server_name 10.0.0.1; }
+}
+"""
+        config_path = self.create_test_config('ndjson', config_content)
+        nginx = NGINX(config_path)
+        records = list(nginx.iter_records())
+        # 边解析边输出，不保留解析后的server，也不构建完整的配置树
+        self.assertNotIn('servers', nginx.__dict__)
+        self.assertNotIn('tree', nginx.__dict__)
+        validation = records[-1]['data']
+        self.assertTrue(validation['missing_directives'])
+        self.assertEqual({c['type'] for c in validation['conflicts']}, {'insecure_protocol', 'duplicate_default_server'})
+
+        # 从记录重建完整配置
+        rebuilt = {'upstreams': [], 'servers': []}
+        for record in records:
+            if record['type'] == 'upstream':
+                rebuilt['upstreams'].append(record['data'])
+            elif record['type'] == 'server':
+                rebuilt['servers'].append(dict(record['data'], backend=[]))
+            elif record['type'] == 'location':
+                rebuilt['servers'][record['server']]['backend'].append(record['data'])
+            else:
+                rebuilt[record['type']] = record['data']
+        self.assertEqual(rebuilt, NGINX(config_path).get_all_config())
+        self.assertEqual([r['type'] for r in records[:4]], ['global', 'events', 'http', 'upstream'])
+
+        output = io.StringIO()
+        with mock.patch('sys.argv', ['nginxparser', 'parse', config_path, '--output', 'ndjson']), \
+                redirect_stdout(output), self.assertRaises(SystemExit):
+            main()
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(lines, json.loads(json.dumps(records, default=str)))
+
+        # query的ndjson输出与json输出中的servers一致
+        outputs = {}
+        for fmt in ('json', 'ndjson'):
+            output = io.StringIO()
+            with mock.patch('sys.argv', ['nginxparser', 'query', config_path, '--location', '/', '--output', fmt]), \
+                    redirect_stdout(output), self.assertRaises(SystemExit):
+                main()
+            outputs[fmt] = output.getvalue()
+        self.assertEqual([json.loads(line) for line in outputs['ndjson'].splitlines()],
+                         json.loads(outputs['json'])['servers'])
+
+    def test_instrumented_stats(self):
+        """Test per-stage and per-block statistics collected with instrument=True"""
+        config_content = """
+http {
+    upstream app { server 10.0.0.1:8080; }
+    server {
+        listen 80;
+        server_name one.com;
+        location / { proxy_pass http://app; }
+    }
+    server { listen 80; server_name two.com; }
+}
+"""
+        config_path = self.create_test_config('instrument', config_content)
+        self.assertEqual(NGINX(config_path).stats, {'stages': {}, 'blocks': []})
+
+        nginx = NGINX(config_path, instrument=True)
+        config = nginx.get_all_config()
+        self.assertEqual(config, NGINX(config_path).get_all_config())
+
+        stages = nginx.stats['stages']
+        for stage in ('merge_conf', 'parse', 'parse_server_block', 'parse_modules', 'detect_conflicts'):
+            self.assertIn(stage, stages)
+        self.assertEqual(stages['parse_server']['calls'], 2)
+        # 完整的配置树在解析全部server时构建
+        self.assertGreaterEqual(stages['parse_server_block']['bytes'], len(nginx.content))
+        self.assertGreater(stages['parse_locations']['regex_calls'], 0)
+        # 嵌套调用的统计包含在外层阶段中
+        self.assertGreaterEqual(stages['get_all_config']['regex_calls'], stages['parse_modules']['regex_calls'])
+
+        blocks = [(b['stage'], b['block'], b['file']) for b in nginx.stats['blocks']]
+        self.assertEqual(blocks, [('parse_upstream', 'upstream app', config_path),
+                                  ('parse_server', 'server one.com', config_path),
+                                  ('parse_server', 'server two.com', config_path)])
+        # 共用的正则不会被替换，多个线程同时instrument时各自计数
+        self.assertTrue(all(isinstance(pattern, type(re.compile(''))) for pattern in nginx_module._PATTERNS.values()))
+        expected = stages['get_all_config']['regex_calls']
+        parsers = [NGINX(config_path, instrument=True) for _ in range(4)]
+        threads = [threading.Thread(target=parser.get_all_config) for parser in parsers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([parser.stats['stages']['get_all_config']['regex_calls'] for parser in parsers], [expected] * 4)
+        self.assertIsInstance(nginx_module._PATTERNS['ipv4'], type(re.compile('')))
+        # 没有线程instrument时正则表是普通dict，取正则不经过计数视图
+        self.assertIs(type(nginx_module._PATTERNS), dict)
+        self.assertIs(type(nginx_module._SCANNERS), dict)
+
+        errors = io.StringIO()
+        with mock.patch('sys.argv', ['nginxparser', 'parse', config_path, '--profile']), \
+                redirect_stdout(io.StringIO()), redirect_stderr(errors), self.assertRaises(SystemExit):
+            main()
+        self.assertIn('parse_server_block', errors.getvalue())
+        self.assertIn('server one.com', errors.getvalue())
+
     def test_comment_removal(self):
         """Test TASK_032: Comment removal"""
         config_content = """
@@ -757,6 +1366,88 @@ http {
         self.assertEqual(location['path'], '/empty')
         self.assertIsNone(location.get('modifier'))
 
+    def test_parse_tree_structure(self):
+        """Test the single-pass directive tree"""
+        tree = parse_tree("""
+worker_processes 4;
+http {
+    log_format json '{"uri":"$uri"}';
+    server {
+        listen 80;
+        location / { return 200; }
+    }
+}
+""")
+        self.assertEqual(tree.find('worker_processes').value, '4')
+        http = tree.find('http')
+        self.assertEqual(http.find('log_format').args, ['json', '{"uri":"$uri"}'])
+        server = http.find('server')
+        self.assertEqual(server.find('listen').args, ['80'])
+        self.assertEqual([d.name for d in server.walk()], ['listen', 'location', 'return'])
+
+    def test_parse_tree_unclosed_block(self):
+        """Test that unclosed blocks and stray braces do not break the tree"""
+        content = "events {\n    worker_connections 1024\n}\n}\nhttp {\n    gzip on;\n"
+        tree = parse_tree(content)
+        self.assertEqual(tree.find('events').find('worker_connections').value, '1024')
+        http = tree.find('http')
+        self.assertEqual(http.find('gzip').value, 'on')
+        self.assertEqual(http.end, len(content))
+
+    def test_parse_tree_depth(self):
+        """Test the outline tree and expanding its blocks by offset range"""
+        content = """
+worker_processes 4;
+http {
+    gzip on;
+    server { listen 80; location / { set $a "}"; return 200; } }
+    server { listen 81;
+"""
+        tree = parse_tree(content)
+        outline = parse_tree(content, depth=2)
+        self.assertEqual(outline.find('worker_processes').value, '4')
+        http = outline.find('http')
+        self.assertEqual(http.find('gzip').value, 'on')
+
+        servers = http.find_all('server')
+        full = tree.find('http').find_all('server')
+        self.assertEqual([s.block for s in servers], [[], []])
+        self.assertEqual([(s.start, s.end) for s in servers], [(s.start, s.end) for s in full])
+        for shell, node in zip(servers, full):
+            expanded = parse_tree(content, shell.start, shell.end).block[0]
+            self.assertEqual([(d.name, d.value, d.start, d.end) for d in expanded.walk()],
+                             [(d.name, d.value, d.start, d.end) for d in node.walk()])
+
+    def test_modules_from_tree(self):
+        """Test that module parsing only sees real directives, not quoted text"""
+        config_path = self.create_test_config('modules', """
+http {
+    log_format main 'stream { limit_req zone=fake; } proxy_read_timeout 1s;';
+    upstream pool { server 10.0.0.1:80; }
+    limit_req_zone $binary_remote_addr zone=one:10m rate=1r/s;
+    server {
+        listen 80;
+        location /api { limit_req zone=one; proxy_read_timeout 30s; }
+        location /g { grpc_pass grpc://pool; grpc_read_timeout 5s; }
+    }
+}
+stream {
+    upstream tcp { server 10.0.0.2:53 weight=3; server 10.0.0.3:53; }
+    server { listen 53 udp; proxy_pass tcp; proxy_timeout "1}s"; }
+}
+""")
+        modules = NGINX(config_path).parse_modules()
+
+        self.assertEqual(modules['rate_limiting']['requests'], [{'zone': 'one'}])
+        self.assertEqual(modules['proxy']['proxy_timeouts'], {'read': '30s'})
+        self.assertEqual(modules['stream']['upstreams'], [
+            {'name': 'tcp', 'servers': [{'address': '10.0.0.2:53', 'weight': 3}, {'address': '10.0.0.3:53'}]}
+        ])
+        self.assertEqual(modules['stream']['servers'], [{
+            'listen': '53 udp', 'proxy_pass': 'tcp', 'backend_ip': '10.0.0.2:53 10.0.0.3:53', 'proxy_timeout': '"1}s"'
+        }])
+        self.assertEqual([l['path'] for l in modules['grpc_locations']], ['/g'])
+
 
 if __name__ == '__main__':
     # Run all tests